@@ -10,18 +10,62 @@ Where
     the callable is a variable in this file that knows how to handle requests:
         app = falcon.API()
 """
+import itertools
 import json
+import os
+import zlib
 
 import falcon
+import gevent.queue
 
+from digaas import events
+from digaas import hedging
+from digaas import images
 from digaas import model
+from digaas import notify
+from digaas import pacing
 from digaas import poll
+from digaas import retention
+from digaas import shards
 from digaas import stats
 from digaas import storage
 from digaas import graphite
+from digaas import workqueue
 from digaas.config import CONFIG
+from digaas.consts import Status
 
 graphite.setup(CONFIG.graphite_host, CONFIG.graphite_port)
+if CONFIG.poll_processes:
+    shards.start(CONFIG.poll_processes)
+elif CONFIG.poll_queue == 'redis':
+    workqueue.start(poll.get_scheduler())
+if events.is_distributed():
+    events.start_subscriber()
+if CONFIG.notify_port:
+    notify.start(CONFIG.notify_address, CONFIG.notify_port, poll.receive_notify)
+if CONFIG.retention_seconds or CONFIG.image_storage_max_bytes:
+    retention.start()
+
+# the longest we'll hold a GET /poll_requests/{id}?wait=<seconds>
+MAX_WAIT = 60
+# the number of events buffered per /poll_requests/events stream before
+# we start dropping them
+EVENT_STREAM_BUFFER_SIZE = 10000
+# send an SSE comment this often so proxies don't close an idle stream
+EVENT_STREAM_KEEPALIVE = 15
+# the most events sent in one write to a /poll_requests/events stream
+EVENT_STREAM_BATCH_SIZE = 100
+# the most lines per page of GET /stats-file
+MAX_STATS_FILE_LIMIT = 100000
+# the datapoints of every nameserver, in GET /stats-file. None is the
+# nameserver of the datapoints stored before they had one.
+ANY_NAMESERVER = object()
+# the number of poll requests per page of GET /poll_requests?<filters>, by
+# default and at most
+DEFAULT_FIND_LIMIT = 100
+MAX_FIND_LIMIT = 10000
+# how long clients may cache images from the image store (a year)
+IMAGE_MAX_AGE = 31536000
 
 
 def make_error_body(message):
@@ -41,9 +85,87 @@ def _parse_json(req, resp):
         resp.body = make_error_body(err_msg)
         return
 
+def _stream_json_array(items, batch_size=1000):
+    """Encode the items as a JSON array, a batch of items per chunk"""
+    yield '['
+    batch = []
+    sep = ''
+    for item in items:
+        batch.append(json.dumps(item))
+        if len(batch) >= batch_size:
+            yield sep + ','.join(batch)
+            batch = []
+            sep = ','
+    if batch:
+        yield sep + ','.join(batch)
+    yield ']'
+
+def _lookup_poll_requests(ids, statuses=None):
+    """Yield the dict for each poll request id, in order. Ids that weren't
+    found are reported with a message.
+
+    :param statuses: if given, only yield poll requests with these statuses
+    """
+    for id, poll_req in storage.get_poll_requests(ids):
+        if poll_req is None:
+            if not statuses:
+                yield dict(id=id, message="Poll request id {0} not found".format(id))
+        elif not statuses or poll_req.status in statuses:
+            yield poll_req.to_dict()
+
 class PollRequestCollection(object):
     route = '/poll_requests'
 
+    def on_get(self, req, resp):
+        """Handle GET /poll_requests?id=<id>&id=<id>...&status=<status>
+
+        Without ids, find the poll requests matching the filters instead, in
+        start_time order.
+
+        Optional url parameters:
+            nameserver=<ip>
+            status=<status>: or several of them
+            condition=<condition>: match conditions starting with this, so
+                condition=data= matches every data= condition
+            query_name=<name>
+            since=<epoch>, until=<epoch>: the range of start_time to search
+            limit=<n>: return at most n requests. If there may be more, the
+                X-Next-Cursor header is a cursor to get the rest.
+            cursor=<cursor>: carry on from an X-Next-Cursor
+        """
+        resp.content_type = 'application/json'
+        ids = req.get_param_as_list('id')
+        statuses = req.get_param_as_list('status')
+        if ids:
+            resp.status = falcon.HTTP_200
+            resp.stream = _stream_json_array(_lookup_poll_requests(ids, statuses))
+            return
+
+        filters = dict(
+            nameserver=req.get_param('nameserver'),
+            statuses=statuses,
+            condition=req.get_param('condition'),
+            query_name=req.get_param('query_name'),
+        )
+        try:
+            since = float(req.get_param('since') or 0)
+            until = float(req.get_param('until') or 'inf')
+            limit = int(req.get_param('limit') or DEFAULT_FIND_LIMIT)
+            if not 1 <= limit <= MAX_FIND_LIMIT:
+                raise ValueError("limit must be from 1 to {0}".format(MAX_FIND_LIMIT))
+            cursor = storage.find_poll_requests_cursor(since, req.get_param('cursor'))
+        except ValueError as e:
+            resp.status = falcon.HTTP_400
+            resp.body = make_error_body(str(e))
+            return
+
+        poll_reqs = list(itertools.islice(
+            storage.find_poll_requests(since, until, cursor=cursor, **filters), limit))
+        if len(poll_reqs) == limit:
+            resp.set_header('X-Next-Cursor', str(cursor))
+        resp.status = falcon.HTTP_200
+        resp.stream = _stream_json_array(poll_req.to_dict() for poll_req in poll_reqs)
+
     def on_post(self, req, resp):
         """Handle POST /poll_requests"""
         resp.content_type = 'application/json'
@@ -72,20 +194,174 @@ class PollRequestCollection(object):
         resp.body = json.dumps(poll_req.to_dict())
 
 
+def _parse_bulk_json(req, resp):
+    """Parse a request body holding a JSON array, or one JSON document per line
+    (NDJSON). Set resp.status and resp.body on failure.
+
+    :returns: a list with one item per document. A line that failed to parse
+        is replaced by the ValueError.
+    """
+    body = req.stream.read()
+    if body.lstrip().startswith('['):
+        try:
+            return json.loads(body)
+        except ValueError as e:
+            resp.status = falcon.HTTP_400
+            resp.body = make_error_body(str(e) + ': ' + body)
+            return
+
+    items = []
+    for line in body.splitlines():
+        if not line.strip():
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError as e:
+            items.append(ValueError(str(e) + ': ' + line))
+    return items
+
+
+class PollRequestBulkCollection(object):
+    route = '/poll_requests/bulk'
+
+    def on_post(self, req, resp):
+        """Handle POST /poll_requests/bulk
+
+        Responds with one item per poll request, in order. That's {"id": <id>}
+        if it was accepted, or {"message": <error>} if it was invalid.
+        """
+        resp.content_type = 'application/json'
+        items = _parse_bulk_json(req, resp)
+        if items is None:
+            return
+
+        results = []
+        poll_reqs = []
+        for data in items:
+            try:
+                if isinstance(data, ValueError):
+                    raise data
+                if not isinstance(data, dict):
+                    raise ValueError("Expected a JSON object, got {0}".format(data))
+                model.PollRequest.validate(data)
+                poll_req = model.PollRequest.from_dict(data)
+            except Exception as e:
+                results.append(dict(message=str(e)))
+                continue
+            results.append(dict(id=poll_req.id))
+            poll_reqs.append(poll_req)
+
+        if poll_reqs:
+            poll.receive_many(poll_reqs)
+        resp.status = falcon.HTTP_202
+        resp.body = json.dumps(results)
+
+
+class PollRequestLookup(object):
+    route = '/poll_requests/lookup'
+
+    def on_post(self, req, resp):
+        """Handle POST /poll_requests/lookup
+
+        The body is {"ids": [<id>, ...]}, with an optional "status" list to
+        only return poll requests with those statuses.
+        """
+        resp.content_type = 'application/json'
+        data = _parse_json(req, resp)
+        if data is None:
+            return
+
+        ids = data.get('ids') if isinstance(data, dict) else None
+        if not isinstance(ids, list):
+            resp.status = falcon.HTTP_400
+            resp.body = make_error_body('Expected a list of "ids"')
+            return
+        statuses = data.get('status')
+        if isinstance(statuses, basestring):
+            statuses = [statuses]
+
+        resp.status = falcon.HTTP_200
+        resp.stream = _stream_json_array(_lookup_poll_requests(ids, statuses))
+
+
+def _stream_events(subscription):
+    """Yield server-sent events for a subscription until the client goes away"""
+    try:
+        while True:
+            try:
+                poll_req = subscription.queue.get(timeout=EVENT_STREAM_KEEPALIVE)
+            except gevent.queue.Empty:
+                yield ": keepalive\n\n"
+                continue
+            # send whatever else is waiting along with it
+            poll_reqs = [poll_req]
+            while len(poll_reqs) < EVENT_STREAM_BATCH_SIZE and not subscription.queue.empty():
+                poll_reqs.append(subscription.queue.get_nowait())
+            chunks = ["event: finished\ndata: {0}\n\n".format(json.dumps(poll_req.to_dict()))
+                      for poll_req in poll_reqs]
+            # report drops with every batch, so a consumer that stays behind
+            # hears about them without waiting for the buffer to empty
+            dropped = subscription.take_dropped()
+            if dropped:
+                chunks.append("event: dropped\ndata: {0}\n\n"
+                              .format(json.dumps(dict(dropped=dropped))))
+            yield "".join(chunks)
+    finally:
+        events.unsubscribe(subscription)
+
+
+class PollRequestEvents(object):
+    route = '/poll_requests/events'
+
+    def on_get(self, req, resp):
+        """Handle GET /poll_requests/events?nameserver=<ip>&condition=<condition>
+
+        A server-sent event stream with a "finished" event for every poll
+        request as it finishes. If this client falls behind, events are
+        dropped and reported in a "dropped" event with the number lost.
+        """
+        subscription = events.subscribe(
+            EVENT_STREAM_BUFFER_SIZE,
+            nameserver=req.get_param('nameserver'),
+            condition=req.get_param('condition'))
+        resp.content_type = 'text/event-stream'
+        resp.set_header('Cache-Control', 'no-cache')
+        resp.status = falcon.HTTP_200
+        resp.stream = _stream_events(subscription)
+
+
 class PollRequestResource(object):
     route = "/poll_requests/{id}"
 
     def on_get(self, req, resp, id):
-        """Handle GET /poll_requests/{id}"""
+        """Handle GET /poll_requests/{id}
+
+        With ?wait=<seconds>, block until the poll request is no longer
+        ACCEPTED, or the wait is over.
+        """
         resp.content_type = 'application/json'
+        try:
+            wait = min(float(req.get_param('wait') or 0), MAX_WAIT)
+        except ValueError as e:
+            resp.status = falcon.HTTP_400
+            resp.body = make_error_body(str(e))
+            return
+
+        # start watching before the lookup, so we can't miss the completion
+        finished = events.watch(id)
         try:
             poll_req = storage.get_poll_request(id)
             if poll_req is None:
                 raise Exception("Poll request id {0} not found".format(id))
+            if wait > 0 and poll_req.status == Status.ACCEPTED:
+                # wait() returns None if the wait is over first
+                poll_req = finished.wait(wait) or poll_req
         except Exception as e:
             resp.status = falcon.HTTP_404  # could be bad request in some cases?
             resp.body = make_error_body(str(e))
             return
+        finally:
+            events.unwatch(id, finished)
 
         resp.status = falcon.HTTP_200
         resp.body = json.dumps(poll_req.to_dict())
@@ -144,8 +420,31 @@ class ImageResource(object):
     route = '/images/{id}'
 
     def on_get(self, req, resp, id):
-        """Handle GET /images/{id}"""
+        """Handle GET /images/{id}
+
+        Images from the image store are named for their contents, so they're
+        sent with an ETag and cached for good. The file is handed to the server
+        to send (uwsgi uses sendfile, or an offload thread if configured).
+        """
+        if images.is_digest(id):
+            f = images.open_image(id)
+            if f is None:
+                resp.status = falcon.HTTP_404
+                return
+            resp.set_header('ETag', '"{0}"'.format(id))
+            resp.set_header('Cache-Control', 'public, max-age={0}, immutable'
+                                             .format(IMAGE_MAX_AGE))
+            if_none_match = req.get_header('If-None-Match') or ''
+            if if_none_match.strip() == '*' or '"{0}"'.format(id) in if_none_match:
+                f.close()
+                resp.status = falcon.HTTP_304
+                return
+            resp.content_type = 'image/png'
+            resp.status = falcon.HTTP_200
+            resp.set_stream(f, os.fstat(f.fileno()).st_size)
+            return
 
+        # an image stored in redis before the image store
         image_data = storage.get_image_bytes(id)
         if image_data is None:
             resp.status = falcon.HTTP_404
@@ -165,7 +464,19 @@ class StatsFileResource(object):
     route = '/stats-file'
 
     def on_get(self, req, resp):
-        """Handle GET /stats-files"""
+        """Handle GET /stats-files
+
+        The data is streamed, in start_time order, one line per datapoint. It's
+        gzipped if the client accepts that.
+
+        Optional url parameters:
+            nameserver=<ip>: only the data for this nameserver
+            group_by=nameserver: one block of data per nameserver, separated
+                by two blank lines (a gnuplot "index")
+            limit=<n>: return at most n lines. If there may be more, the
+                X-Next-Cursor header is a cursor to get the rest.
+            cursor=<cursor>: carry on from an X-Next-Cursor
+        """
 
         if 'start_time' not in req.params:
             resp.status = falcon.HTTP_400
@@ -179,14 +490,130 @@ class StatsFileResource(object):
         try:
             start_time = float(req.params['start_time'])
             end_time = float(req.params['end_time'])
+            limit = req.get_param('limit')
+            if limit is not None:
+                limit = int(limit)
+                if not 1 <= limit <= MAX_STATS_FILE_LIMIT:
+                    raise ValueError("limit must be from 1 to {0}".format(MAX_STATS_FILE_LIMIT))
+            cursor = req.get_param('cursor')
+            if cursor is not None:
+                cursor = storage.TimeRangeCursor.parse(cursor)
         except ValueError as e:
             resp.status = falcon.HTTP_400
             resp.body = make_error_body(str(e))
             return
-        data = storage.select_time_range(start_time, end_time)
+        group_by = req.get_param('group_by')
+        if group_by is not None and group_by not in model.StatsRequest.GROUP_BY:
+            resp.status = falcon.HTTP_400
+            resp.body = make_error_body("Invalid group_by '{0}'. Valid values: {1}"
+                                        .format(group_by, model.StatsRequest.GROUP_BY))
+            return
+        if group_by is not None and (limit is not None or cursor is not None):
+            resp.status = falcon.HTTP_400
+            resp.body = make_error_body("limit and cursor don't apply with group_by")
+            return
+
+        nameserver = req.get_param('nameserver')
+        if group_by == 'nameserver':
+            lines = _group_by_nameserver(start_time, end_time, nameserver)
+        else:
+            if cursor is None:
+                cursor = storage.TimeRangeCursor.starting_at(start_time)
+            lines = _stats_file_lines(
+                start_time, end_time,
+                ANY_NAMESERVER if nameserver is None else nameserver, cursor)
+            if limit is not None:
+                # a page is at most MAX_STATS_FILE_LIMIT lines, so hold it to
+                # know the cursor for the header
+                lines = list(itertools.islice(lines, limit))
+                if len(lines) == limit:
+                    resp.set_header('X-Next-Cursor', str(cursor))
+
         resp.content_type = 'text/plain'
         resp.status = falcon.HTTP_200
-        resp.body = "\n".join(data)
+        chunks = _join_lines(lines)
+        if 'gzip' in (req.get_header('Accept-Encoding') or ''):
+            resp.set_header('Content-Encoding', 'gzip')
+            chunks = _gzip_chunks(chunks)
+        resp.stream = chunks
+
+
+def _stats_file_lines(start_time, end_time, nameserver=ANY_NAMESERVER, cursor=None):
+    """Yield the text of each datapoint, optionally just for one nameserver"""
+    for item in storage.iter_time_range(start_time, end_time, cursor):
+        if nameserver is ANY_NAMESERVER \
+                or storage.parse_time_range_item(item)[3] == nameserver:
+            yield storage.time_range_item_text(item)
+
+
+def _group_by_nameserver(start_time, end_time, nameserver=None):
+    """Yield a "# <nameserver>" line and then the data for each nameserver,
+    with two blank lines between them. This reads the data once to find the
+    nameservers, and then once per nameserver, to avoid holding it all."""
+    nameservers = set()
+    for item in storage.iter_time_range(start_time, end_time):
+        nameservers.add(storage.parse_time_range_item(item)[3])
+    if nameserver is not None:
+        nameservers &= set([nameserver])
+    for i, ns in enumerate(sorted(nameservers)):
+        if i:
+            yield "\n"
+        yield "# {0}".format(ns)
+        for line in _stats_file_lines(start_time, end_time, ns):
+            yield line
+
+
+def _join_lines(lines, batch_size=1000):
+    """Join the lines into chunks of a batch of lines each"""
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) >= batch_size:
+            batch.append('')
+            yield "\n".join(batch)
+            batch = []
+    if batch:
+        batch.append('')
+        yield "\n".join(batch)
+
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class PacingResource(object):
+    route = '/pacing'
+
+    def on_get(self, req, resp):
+        """Handle GET /pacing"""
+        resp.content_type = 'application/json'
+        resp.status = falcon.HTTP_200
+        resp.body = json.dumps(pacing.get_reports())
+
+
+class HedgingResource(object):
+    route = '/hedging'
+
+    def on_get(self, req, resp):
+        """Handle GET /hedging"""
+        resp.content_type = 'application/json'
+        resp.status = falcon.HTTP_200
+        resp.body = json.dumps(hedging.get_reports())
+
+
+class StorageResource(object):
+    route = '/storage'
+
+    def on_get(self, req, resp):
+        """Handle GET /storage"""
+        resp.content_type = 'application/json'
+        resp.status = falcon.HTTP_200
+        resp.body = json.dumps(storage.get_write_report())
 
 
 # the uWSGI callable
@@ -197,11 +624,17 @@ def add_resource(class_name):
     app.add_route(resource.route, resource)
 
 add_resource(PollRequestCollection)
+add_resource(PollRequestBulkCollection)
+add_resource(PollRequestLookup)
+add_resource(PollRequestEvents)
 add_resource(PollRequestResource)
 add_resource(StatsCollection)
 add_resource(StatsResource)
 add_resource(ImageResource)
 add_resource(StatsFileResource)
+add_resource(PacingResource)
+add_resource(HedgingResource)
+add_resource(StorageResource)
 
 def catch_all(req, resp):
     resp.status = falcon.HTTP_200
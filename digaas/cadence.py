@@ -0,0 +1,108 @@
+"""
+Adaptive probe cadence for poll requests that opt in with "adaptive": true.
+
+A fixed frequency trades query load against measurement error: the recorded
+duration can be late by up to one interval. Instead, we learn the distribution
+of propagation times per (nameserver, condition) from completed requests, and
+spend the request's query budget where the change is most likely to show up.
+Probes are placed at evenly spaced quantiles of the learned distribution, so
+they are sparse early on and dense around the expected completion window. A
+few probes are held back to cover the tail between the slowest time we've
+seen and the request's timeout.
+"""
+import bisect
+import time
+
+from monotonic import monotonic
+
+from digaas import storage
+from digaas.consts import Condition
+
+# don't trust the history until we've seen this many completions
+MIN_SAMPLES = 20
+# the number of durations we remember per (nameserver, condition)
+MAX_SAMPLES = 1000
+# reload the history from storage this often, to pick up other nodes' results
+REFRESH_INTERVAL = 60
+# never plan two probes closer together than this
+MIN_SPACING = 0.05
+# the fraction of the query budget reserved for the tail of the distribution
+TAIL_FRACTION = 0.2
+
+# (nameserver, condition) -> (loaded_at, sorted list of durations)
+_history = {}
+
+
+def history_key(nameserver, condition):
+    # the expected data doesn't matter, only the kind of condition
+    return (nameserver, Condition.kind(condition))
+
+
+def get_samples(key):
+    """Return a sorted list of the propagation times seen for the key"""
+    entry = _history.get(key)
+    if entry is None or monotonic() - entry[0] > REFRESH_INTERVAL:
+        samples = sorted(storage.get_propagation_times(*key))
+        entry = _history[key] = (monotonic(), samples)
+    return entry[1]
+
+
+def record(poll_req):
+    """Remember the durations of a finished poll request, for each nameserver
+    that saw the change"""
+    for nameserver, duration in poll_req.get_durations():
+        if duration is None:
+            continue
+        key = history_key(nameserver, poll_req.condition)
+        storage.add_propagation_time(key[0], key[1], duration, MAX_SAMPLES)
+        entry = _history.get(key)
+        if entry is not None and len(entry[1]) < MAX_SAMPLES:
+            bisect.insort(entry[1], duration)
+
+
+def default_budget(poll_req):
+    """The number of queries the fixed cadence would send before timing out"""
+    return int(poll_req.timeout / poll_req.frequency) + 1
+
+
+def plan(poll_req, now, nameserver=None):
+    """Return the monotonic times to probe at, in ascending order, or None if
+    there isn't enough history to do better than the fixed cadence.
+
+    The first probe is always sent immediately, in case the change is already
+    there. There are never more probes than the request's query budget.
+
+    :param now: the current monotonic time
+    :param nameserver: the nameserver to plan for, if not the request's own
+    """
+    elapsed = time.time() - poll_req.start_time
+    samples = get_samples(history_key(nameserver or poll_req.nameserver,
+                                      poll_req.condition))
+    # we already know the change took longer than the elapsed time
+    lo = bisect.bisect_right(samples, elapsed)
+    hi = bisect.bisect_right(samples, poll_req.timeout)
+    samples = samples[lo:hi]
+    if len(samples) < MIN_SAMPLES:
+        return None
+
+    # the first probe counts against the budget, and the tail only gets
+    # probes once the body has one
+    budget = poll_req.query_budget or default_budget(poll_req)
+    remaining = budget - 1
+    n_tail = min(max(1, int(budget * TAIL_FRACTION)), remaining - 1) if remaining > 1 else 0
+    n_body = remaining - n_tail
+
+    offsets = []
+    for i in xrange(1, n_body + 1):
+        index = int(round(float(i) * (len(samples) - 1) / n_body))
+        offsets.append(samples[index])
+    tail_start = samples[-1]
+    tail_step = (poll_req.timeout - tail_start) / (n_tail + 1)
+    offsets.extend(tail_start + tail_step * i for i in xrange(1, n_tail + 1))
+
+    times = [now]
+    for offset in offsets:
+        t = now + offset - elapsed
+        if t - times[-1] >= MIN_SPACING:
+            times.append(t)
+    return times
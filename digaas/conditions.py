@@ -0,0 +1,115 @@
+"""
+Record conditions, compiled into predicates on the records of an answer.
+
+A poll request's condition is parsed once, when the request is created, rather
+than on every probe. The predicates take the set of rdatas of the queried
+type, in canonical text (see canonical_rdatas), so one probe's answer is
+canonicalized once and then checked against every request waiting on it.
+
+    data=<rdata>                   the records include the rdata
+    rrset=<rdata>|<rdata>|...      the records are exactly these rdatas
+    absent                         there are no records of the type
+
+The rdatas are written the way they are in a zone file, like "10 mail" for an
+MX or "0 5 5060 sip" for an SRV. Relative names are taken to be absolute.
+"""
+import dns.exception
+import dns.name
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+
+from digaas.consts import Condition
+
+# the record types that conditions can check
+RDATATYPES = ('A', 'AAAA', 'NS', 'CNAME', 'PTR', 'MX', 'TXT', 'SRV')
+
+# the types whose rdata text has something other than names to compare case
+# sensitively (the rest only have names, numbers and addresses)
+_CASE_SENSITIVE = frozenset([dns.rdatatype.TXT])
+
+
+class Contains(object):
+    __slots__ = ('key', 'rdata')
+
+    def __init__(self, rdata):
+        self.key = (Condition.DATA_EQUALS, rdata)
+        self.rdata = rdata
+
+    def matches(self, rdatas):
+        return self.rdata in rdatas
+
+
+class RRsetEquals(object):
+    __slots__ = ('key', 'rdatas')
+
+    def __init__(self, rdatas):
+        self.key = (Condition.RRSET_EQUALS, rdatas)
+        self.rdatas = rdatas
+
+    def matches(self, rdatas):
+        return rdatas == self.rdatas
+
+
+class Absent(object):
+    __slots__ = ('key',)
+
+    def __init__(self):
+        self.key = (Condition.ABSENT,)
+
+    def matches(self, rdatas):
+        return not rdatas
+
+
+def compile(condition, rdatatype):
+    """Return the predicate for a record condition, or None for a condition on
+    the zone's SOA. Raises ValueError if the rdatas don't parse.
+
+    Predicates have a key, which is the same for any two predicates that match
+    the same records, and a matches(rdatas) method.
+    """
+    if condition.startswith(Condition.DATA_EQUALS):
+        return Contains(canonical(rdatatype, condition[len(Condition.DATA_EQUALS):]))
+    elif condition.startswith(Condition.RRSET_EQUALS):
+        texts = condition[len(Condition.RRSET_EQUALS):].split('|')
+        return RRsetEquals(frozenset(canonical(rdatatype, text) for text in texts))
+    elif condition == Condition.ABSENT:
+        return Absent()
+    return None
+
+
+def canonical(rdatatype, text):
+    """Return the canonical text of the rdata, written as text"""
+    if isinstance(rdatatype, basestring):
+        rdatatype = dns.rdatatype.from_text(rdatatype)
+    if isinstance(text, unicode):
+        # conditions come from json as unicode, which dnspython won't tokenize
+        text = text.encode('utf-8')
+    try:
+        rdata = dns.rdata.from_text(dns.rdataclass.IN, rdatatype, text.strip(),
+                                    origin=dns.name.root, relativize=False)
+        # the round trip through the wire format normalizes the addresses
+        wire = rdata.to_digestable(dns.name.root)
+        rdata = dns.rdata.from_wire(dns.rdataclass.IN, rdatatype, wire, 0, len(wire))
+    except (dns.exception.DNSException, ValueError) as e:
+        raise ValueError("Invalid {0} data '{1}'{2}".format(
+            dns.rdatatype.to_text(rdatatype), text, ': {0}'.format(e) if str(e) else ''))
+    return canonical_text(rdatatype, rdata.to_text())
+
+
+def canonical_rdatas(rdatatype, texts):
+    """Return the canonical text of the rdatas in an answer, as a frozenset.
+
+    :param texts: the rdatas as dnspython writes them, which is already
+        canonical but for the case of the names
+    """
+    if isinstance(rdatatype, basestring):
+        rdatatype = dns.rdatatype.from_text(rdatatype)
+    if rdatatype in _CASE_SENSITIVE:
+        return frozenset(texts)
+    return frozenset(text.lower() for text in texts)
+
+
+def canonical_text(rdatatype, text):
+    """Return the canonical text of one rdata as dnspython writes it"""
+    return text if rdatatype in _CASE_SENSITIVE else text.lower()
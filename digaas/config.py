@@ -1,5 +1,10 @@
 import json
 import os
+import sys
+
+from digaas.consts import Transport
+
+STORAGE_BACKENDS = ('redis', 'memory', 'sqlite')
 
 class Config(object):
 
@@ -18,12 +23,90 @@ class Config(object):
         self.set_config_items(data)
 
     def set_config_items(self, data):
+        # "redis", or "memory" or "sqlite" for a single process without a
+        # redis server (see digaas.storage)
+        self.storage_backend = data.get('storage_backend') or 'redis'
+        if self.storage_backend not in STORAGE_BACKENDS:
+            raise Exception('Invalid storage_backend %r (valid values: %s)'
+                            % (self.storage_backend, ', '.join(STORAGE_BACKENDS)))
+        # where digaas keeps the files it stores, unless told otherwise below
+        self.data_dir = data.get('data_dir') or '/var/lib/digaas'
+        # the database file for the sqlite backend. None for "digaas.db" in
+        # the data_dir
+        self.sqlite_path = data.get('sqlite_path') or os.path.join(self.data_dir, 'digaas.db')
         self.redis_host = data.get('redis_host')
         self.redis_port = self.get_config_item_as_type(data, 'redis_port', int)
         self.redis_password = data.get('redis_password')
+        # the most redis connections open at once. Greenlets wait for a free one.
+        self.redis_max_connections = self.get_config_item_as_type(
+            data, 'redis_max_connections', int) or 64
+        # writes are sent to redis in batches of up to this many, or after
+        # this many seconds (see digaas.writebehind)
+        self.redis_write_batch = self.get_config_item_as_type(
+            data, 'redis_write_batch', int) or 500
+        self.redis_write_interval = self.get_config_item_as_type(
+            data, 'redis_write_interval', float) or 0.002
         self.graphite_host = data.get('graphite_host')
         self.graphite_port = self.get_config_item_as_type(data, 'graphite_port', int)
         self.dns_query_timeout = self.get_config_item_as_type(data, 'dns_query_timeout', float)
+        # the most duplicates to send of a udp query that's going unanswered
+        hedges = self.get_config_item_as_type(data, 'dns_query_hedges', int)
+        self.dns_query_hedges = 1 if hedges is None else hedges
+        # the most time a zone transfer may take
+        self.zone_transfer_timeout = self.get_config_item_as_type(
+            data, 'zone_transfer_timeout', float) or 10.0
+        # listen for DNS NOTIFY messages on this port, if set
+        self.notify_port = self.get_config_item_as_type(data, 'notify_port', int)
+        self.notify_address = data.get('notify_address') or '0.0.0.0'
+        # the number of long-lived UDP sockets to share per nameserver
+        self.udp_sockets_per_nameserver = self.get_config_item_as_type(
+            data, 'udp_sockets_per_nameserver', int) or 4
+        # the number of persistent tcp connections per nameserver probed over tcp
+        self.tcp_connections_per_nameserver = self.get_config_item_as_type(
+            data, 'tcp_connections_per_nameserver', int) or 2
+        # nameserver ip (or "default") -> "udp" or "tcp", for requests that
+        # don't choose a transport
+        self.nameserver_transport = dict(data.get('nameserver_transport') or {})
+        for nameserver, transport in self.nameserver_transport.items():
+            if transport not in Transport.ALL:
+                raise Exception(
+                    'Invalid transport %r for nameserver %s in nameserver_transport'
+                    % (transport, nameserver))
+        # keep finished requests, their stats datapoints and the plots for
+        # this many seconds. None keeps them forever (see digaas.retention)
+        self.retention_seconds = self.get_config_item_as_type(data, 'retention_seconds', int)
+        # the most bytes of plot images to keep. None for no limit
+        self.image_storage_max_bytes = self.get_config_item_as_type(
+            data, 'image_storage_max_bytes', int)
+        self.compact_interval = self.get_config_item_as_type(
+            data, 'compact_interval', float) or 60.0
+        # where plot images are stored (see digaas.images). None for an
+        # "images" dir in the data_dir
+        self.image_dir = data.get('image_dir') or os.path.join(self.data_dir, 'images')
+        self.poll_workers = self.get_config_item_as_type(data, 'poll_workers', int) or 1000
+        # the number of poller processes to shard polling across. 0 polls in
+        # the http front end's process (see digaas.shards)
+        self.poll_processes = self.get_config_item_as_type(data, 'poll_processes', int) or 0
+        # the python interpreter the poller processes run on. Under uwsgi,
+        # sys.executable is the uwsgi binary, so None means the python in the
+        # same environment as digaas
+        self.poll_process_python = data.get('poll_process_python') or os.path.join(
+            sys.exec_prefix, 'bin', 'python')
+        # "local" polls in this process. "redis" shares a durable queue with
+        # every other digaas node using the same redis (see digaas.workqueue)
+        self.poll_queue = data.get('poll_queue') or 'local'
+        if self.storage_backend != 'redis' and (self.poll_processes or self.poll_queue != 'local'):
+            raise Exception('storage_backend %r only works with "poll_processes": 0 and '
+                            '"poll_queue": "local"' % self.storage_backend)
+        self.poll_lease_seconds = self.get_config_item_as_type(
+            data, 'poll_lease_seconds', float) or 30.0
+        self.poll_queue_max_claimed = self.get_config_item_as_type(
+            data, 'poll_queue_max_claimed', int) or 50000
+        # nameserver ip (or "default") -> max queries per second
+        self.nameserver_qps = dict(
+            (nameserver, float(qps))
+            for nameserver, qps in (data.get('nameserver_qps') or {}).items()
+            if qps is not None)
 
     def get_config_item_as_type(self, data, key, type=None):
         value = data.get(key)
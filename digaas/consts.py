@@ -10,12 +10,42 @@ class Condition:
     SERIAL_NOT_LOWER = "serial_not_lower"
     ZONE_REMOVED     = "zone_removed"
     DATA_EQUALS      = "data="
+    RRSET_EQUALS     = "rrset="
+    ABSENT           = "absent"
 
-    ALL = (SERIAL_NOT_LOWER, ZONE_REMOVED, DATA_EQUALS)
+    ALL = (SERIAL_NOT_LOWER, ZONE_REMOVED, DATA_EQUALS, RRSET_EQUALS, ABSENT)
 
     @classmethod
     def validate_condition(cls, c):
-        return c.startswith(cls.DATA_EQUALS) \
+        return cls.is_record_condition(c) \
             or c == cls.SERIAL_NOT_LOWER \
             or c == cls.ZONE_REMOVED
 
+    @classmethod
+    def is_record_condition(cls, c):
+        """Whether the condition is on the records of a name and rdatatype,
+        rather than the zone's SOA (see digaas.conditions)"""
+        return c.startswith(cls.DATA_EQUALS) \
+            or c.startswith(cls.RRSET_EQUALS) \
+            or c == cls.ABSENT
+
+    @classmethod
+    def is_removal(cls, c):
+        return c == cls.ZONE_REMOVED or c == cls.ABSENT
+
+    @classmethod
+    def kind(cls, c):
+        """The condition without its expected data, so data= for every
+        data= condition"""
+        for prefix in (cls.DATA_EQUALS, cls.RRSET_EQUALS):
+            if c.startswith(prefix):
+                return prefix
+        return c
+
+
+class Transport:
+    """How the dns probes are sent"""
+    UDP = "udp"
+    TCP = "tcp"
+
+    ALL = (UDP, TCP)
@@ -1,16 +1,69 @@
+import socket
+import struct
 import time
 
 import dns
 import dns.exception
+import dns.flags
+import dns.ipv6
+import dns.message
+import dns.opcode
 import dns.query
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
 
+import conditions
 import graphite
+import hedging
+import tcpmux
+from consts import Transport
+
+# the most query templates we cache before starting over
+MAX_CACHED_QUERIES = 100000
+
+# (name, rdatatype) -> the wire format of a query with a message id of zero
+_query_cache = {}
+
+
+class Answer(object):
+    """The parts of a dns response that polling cares about"""
+    __slots__ = ('rcode', 'count', 'rdatas', 'serial')
+
+    def __init__(self, rcode, count, rdatas, serial):
+        """
+        :param count: the number of records in the answer section, of any type
+        :param rdatas: the text of each answer record of the queried type, like
+            '1.2.3.4' or 'ns1.example.com.'
+        :param serial: the serial of the first SOA record in the answer, if any
+        """
+        self.rcode = rcode
+        self.count = count
+        self.rdatas = rdatas
+        self.serial = serial
+
+
+class _Unusual(Exception):
+    """The fast parser can't handle this response, so use dnspython"""
+
 
 def prepare_query(zone_name, rdatatype):
     dns_message = dns.message.make_query(zone_name, rdatatype)
     dns_message.set_opcode(dns.opcode.QUERY)
     return dns_message
 
+def get_query_wire(name, rdatatype):
+    """Return the cached wire format of a query, with a message id of zero"""
+    key = (name, rdatatype)
+    wire = _query_cache.get(key)
+    if wire is None:
+        if len(_query_cache) >= MAX_CACHED_QUERIES:
+            _query_cache.clear()
+        query = prepare_query(name, rdatatype)
+        query.id = 0
+        wire = _query_cache[key] = query.to_wire()
+    return wire
+
 def dig(zone_name, nameserver, rdatatype, timeout):
     query = prepare_query(zone_name, rdatatype)
     start = time.time()
@@ -18,38 +71,294 @@ def dig(zone_name, nameserver, rdatatype, timeout):
     graphite.push_query_time(nameserver, time.time() - start)
     return result
 
+def query(name, nameserver, rdatatype, timeout, transport=Transport.UDP):
+    """Send a query and parse just the answer we need from the response.
+
+    Possibly raises dns.exception.Timeout or dns.query.BadResponse.
+
+    :param transport: Transport.UDP or Transport.TCP
+    """
+    if isinstance(rdatatype, basestring):
+        rdatatype = dns.rdatatype.from_text(rdatatype)
+    wire = get_query_wire(name, rdatatype)
+
+    start = time.time()
+    # these pick the message id
+    if transport == Transport.TCP:
+        resp = tcpmux.query(nameserver, wire, timeout)
+    else:
+        resp = hedging.query(nameserver, wire, timeout)
+    graphite.push_query_time(nameserver, time.time() - start)
+    return parse_answer(resp, rdatatype)
+
+def parse_answer(wire, rdatatype):
+    """Return an Answer for the response, parsed straight from the wire format
+    where possible"""
+    try:
+        return _parse_fast(wire, rdatatype)
+    except _Unusual:
+        return _parse_dnspython(wire, rdatatype)
+
+def _parse_dnspython(wire, rdatatype):
+    resp = dns.message.from_wire(wire)
+    rdatas = []
+    serial = None
+    count = 0
+    for rrset in resp.answer:
+        count += len(rrset)
+        for rdata in rrset:
+            if rdata.rdtype == rdatatype:
+                rdatas.append(rdata.to_text())
+            if rdata.rdtype == dns.rdatatype.SOA and serial is None:
+                serial = rdata.serial
+    return Answer(resp.rcode(), count, rdatas, serial)
+
+# the rdatatypes whose data is a single domain name
+_NAME_TYPES = (dns.rdatatype.NS, dns.rdatatype.CNAME, dns.rdatatype.PTR)
+_FAST_TYPES = _NAME_TYPES + (dns.rdatatype.A, dns.rdatatype.AAAA, dns.rdatatype.SOA)
+# the length of the rdata of the address types
+_ADDRESS_LENGTHS = {dns.rdatatype.A: 4, dns.rdatatype.AAAA: 16}
+
+def _parse_fast(wire, rdatatype):
+    """Parse the response without dnspython. Anything dnspython would reject,
+    or that this can't be sure to read the same way, raises _Unusual."""
+    if rdatatype not in _FAST_TYPES:
+        raise _Unusual()
+    try:
+        _, flags, qdcount, ancount, nscount, arcount = struct.unpack_from('!HHHHHH', wire)
+    except struct.error:
+        raise _Unusual()
+    if not flags & dns.flags.QR or flags & dns.flags.TC \
+            or dns.opcode.from_flags(flags) != dns.opcode.QUERY:
+        raise _Unusual()
+
+    try:
+        offset = 12
+        for _ in xrange(qdcount):
+            offset = _skip_name(wire, offset) + 4
+        if offset > len(wire):
+            raise _Unusual()
+
+        rdatas = []
+        serial = None
+        # dnspython merges duplicate answer records, which changes the count,
+        # so when there's more than one, watch for them
+        seen = set() if ancount > 1 else None
+        # the authority and additional records are read too, to check them,
+        # but only the answer is kept
+        for i in xrange(ancount + nscount + arcount):
+            owner = [] if seen is not None and i < ancount else None
+            offset = _skip_name(wire, offset, labels=owner)
+            rdtype, rdclass, _, rdlength = struct.unpack_from('!HHIH', wire, offset)
+            offset += 10
+            end = offset + rdlength
+            if end > len(wire) or rdclass != dns.rdataclass.IN:
+                raise _Unusual()
+            wanted = i < ancount and rdtype == rdatatype
+            if owner is not None:
+                key = (_name_key(owner), rdtype, _rdata_key(wire, offset, end, rdtype))
+                if key in seen:
+                    raise _Unusual()
+                seen.add(key)
+
+            if rdtype == dns.rdatatype.SOA:
+                rname_offset = _skip_name(wire, offset, end)
+                times_offset = _skip_name(wire, rname_offset, end)
+                if end - times_offset != 20:
+                    raise _Unusual()
+                times = struct.unpack_from('!IIIII', wire, times_offset)
+                if i < ancount and serial is None:
+                    serial = times[0]
+                if wanted:
+                    rdatas.append(' '.join(
+                        [_read_name(wire, offset, end), _read_name(wire, rname_offset, end)]
+                        + [str(t) for t in times]))
+            elif rdtype in _ADDRESS_LENGTHS:
+                if rdlength != _ADDRESS_LENGTHS[rdtype]:
+                    raise _Unusual()
+                if not wanted:
+                    pass
+                elif rdtype == dns.rdatatype.A:
+                    rdatas.append(socket.inet_ntoa(wire[offset:end]))
+                else:
+                    rdatas.append(dns.ipv6.inet_ntoa(wire[offset:end]))
+            elif rdtype in _NAME_TYPES:
+                if _skip_name(wire, offset, end) != end:
+                    raise _Unusual()
+                if wanted:
+                    rdatas.append(_read_name(wire, offset, end))
+            else:
+                # dnspython checks each type's rdata its own way
+                raise _Unusual()
+            offset = end
+    except (struct.error, IndexError, socket.error, ValueError):
+        raise _Unusual()
+    if offset != len(wire):
+        raise _Unusual()
+    return Answer(flags & 0xf, ancount, rdatas, serial)
+
+def _skip_name(wire, offset, limit=None, labels=None):
+    """Return the offset just past the (possibly compressed) name at offset,
+    checking it the way dnspython does.
+
+    :param limit: the offset the name must not be read past, like the end of
+        the rdata it's in
+    :param labels: a list to append the labels of the name to
+    """
+    if limit is None:
+        limit = len(wire)
+    end = None
+    # pointers must point back before the last place they pointed
+    earliest = offset
+    length = 1
+    while True:
+        if offset >= limit:
+            raise _Unusual()
+        label_length = ord(wire[offset])
+        if label_length == 0:
+            return end if end is not None else offset + 1
+        if label_length >= 0xc0:
+            if offset + 1 >= limit:
+                raise _Unusual()
+            pointer = struct.unpack_from('!H', wire, offset)[0] & 0x3fff
+            if pointer >= earliest:
+                raise _Unusual()
+            if end is None:
+                end = offset + 2
+            earliest = offset = pointer
+            continue
+        if label_length >= 0x40 or offset + 1 + label_length > limit:
+            raise _Unusual()
+        length += label_length + 1
+        if length > 255:
+            raise _Unusual()
+        if labels is not None:
+            labels.append(wire[offset + 1:offset + 1 + label_length])
+        offset += label_length + 1
+
+def _name_key(labels):
+    # names compare without regard to case
+    return tuple(label.lower() for label in labels)
+
+def _rdata_key(wire, offset, end, rdtype):
+    """Return something equal for rdatas dnspython would take as the same"""
+    if rdtype not in _NAME_TYPES and rdtype != dns.rdatatype.SOA:
+        return wire[offset:end]
+    key = []
+    while True:
+        labels = []
+        offset = _skip_name(wire, offset, end, labels)
+        key.append(_name_key(labels))
+        if rdtype in _NAME_TYPES or len(key) == 2:
+            return tuple(key) + (wire[offset:end],)
+
+def _read_name(wire, offset, limit=None):
+    """Return the text of the (possibly compressed) name at offset, like
+    dnspython would write it"""
+    labels = []
+    _skip_name(wire, offset, limit, labels)
+    for label in labels:
+        # leave anything that would need escaping to dnspython
+        if not label.replace('-', '').replace('_', '').isalnum():
+            raise _Unusual()
+    return '.'.join(labels) + '.'
+
 def get_serial(zone_name, nameserver, timeout=1):
     """Possibly raises dns.exception.Timeout or dns.query.BadResponse.
     Possibly returns None if, e.g., the answer section is empty."""
-    resp = dig(zone_name, nameserver, dns.rdatatype.SOA, timeout=timeout)
-    if not resp.answer:
-        return None
-    rdataset = resp.answer[0].to_rdataset()
-    if not rdataset:
-        return None
-    return rdataset[0].serial
+    return query(zone_name, nameserver, dns.rdatatype.SOA, timeout).serial
 
 def zone_exists(zone_name, nameserver, timeout=1):
     """Return True if the zone is found on the nameserver. False otherwise."""
-    resp = dig(zone_name, nameserver, dns.rdatatype.SOA, timeout=timeout)
-    return bool(resp.answer)
+    return query(zone_name, nameserver, dns.rdatatype.SOA, timeout).count > 0
 
 def get_record_data(name, nameserver, rdatatype, timeout=1):
     """Return the data field for the given record, or None"""
-    resp = dig(name, nameserver, rdatatype, timeout=timeout)
-    if not resp.answer:
-        return None
-    rdataset = resp.answer[0].to_rdataset()
-    if not rdataset:
-        return None
-    rdata = rdataset[0]
-
-    # dnspython stores data in different attributes depending on the record type...
-    if hasattr(rdata, 'address'):  # for an A record
-        return str(rdata.address)
-    elif hasattr(rdata, 'target'): # for an NS record
-        return str(rdata.target)
-    else:
-        print "WARNING: failed to find data for %s record type non-empty resp:" % rdatatype
-        print resp
-    return None
+    rdatas = query(name, nameserver, rdatatype, timeout).rdatas
+    return rdatas[0] if rdatas else None
+
+def transfer(zone_name, nameserver, records=None, serial=None, timeout=None):
+    """Fetch the records in the zone.
+
+    If we have the records as of a serial, ask for an IXFR of what changed
+    since then, and fall back to an AXFR of the whole zone if the nameserver
+    won't do that.
+
+    :param records: (name, rdatatype) -> set of canonical rdata text (see
+        digaas.conditions), as returned by an earlier call. An IXFR updates it in place.
+    :param serial: the serial of the zone the records are from
+    :returns: (serial, records)
+    """
+    if records is not None and serial is not None:
+        try:
+            rrs = _xfr(zone_name, nameserver, dns.rdatatype.IXFR, serial, timeout)
+            _check_starts_with_soa(rrs, dns.rdatatype.IXFR)
+        except dns.exception.FormError as e:
+            print "IXFR of {0} from {1} failed ({2}). Trying AXFR".format(
+                zone_name, nameserver, e)
+        else:
+            new_serial = rrs[0][2].serial
+            if len(rrs) == 1:
+                # we're up to date
+                return new_serial, records
+            if rrs[1][1] == dns.rdatatype.SOA:
+                _apply_ixfr(records, rrs)
+                return new_serial, records
+            # the nameserver sent the whole zone instead
+            return new_serial, _axfr_records(rrs)
+    rrs = _xfr(zone_name, nameserver, dns.rdatatype.AXFR, 0, timeout)
+    _check_starts_with_soa(rrs, dns.rdatatype.AXFR)
+    return rrs[0][2].serial, _axfr_records(rrs)
+
+def _check_starts_with_soa(rrs, rdatatype):
+    """Raise FormError unless the transfer starts with the zone's SOA"""
+    if not rrs or rrs[0][1] != dns.rdatatype.SOA:
+        raise dns.exception.FormError("{0} didn't start with a SOA".format(
+            dns.rdatatype.to_text(rdatatype)))
+
+def _xfr(zone_name, nameserver, rdatatype, serial, timeout):
+    """Return the records of a zone transfer, in order, as a list of
+    (name, rdatatype, rdata)"""
+    start = time.time()
+    rrs = []
+    for message in dns.query.xfr(nameserver, zone_name, rdatatype, serial=serial,
+                                 relativize=False, timeout=timeout, lifetime=timeout):
+        if message.rcode() != dns.rcode.NOERROR:
+            raise dns.exception.FormError("{0} refused with {1}".format(
+                dns.rdatatype.to_text(rdatatype), dns.rcode.to_text(message.rcode())))
+        for rrset in message.answer:
+            name = rrset.name.to_text().lower()
+            for rdata in rrset:
+                rrs.append((name, rrset.rdtype, rdata))
+    graphite.push_query_time(nameserver, time.time() - start)
+    return rrs
+
+def _axfr_records(rrs):
+    records = {}
+    # the last record repeats the SOA
+    for name, rdatatype, rdata in rrs[:-1]:
+        records.setdefault((name, rdatatype), set()).add(
+            conditions.canonical_text(rdatatype, rdata.to_text()))
+    return records
+
+def _apply_ixfr(records, rrs):
+    """Apply the differences in an IXFR to the records. Between the first and
+    last SOA, each SOA starts a list of deletions or additions, alternately."""
+    origin = rrs[0][0]
+    deleting = False
+    for name, rdatatype, rdata in rrs[1:-1]:
+        if rdatatype == dns.rdatatype.SOA and name == origin:
+            deleting = not deleting
+            continue
+        key = (name, rdatatype)
+        text = conditions.canonical_text(rdatatype, rdata.to_text())
+        if deleting:
+            rdatas = records.get(key)
+            if rdatas is not None:
+                rdatas.discard(text)
+                if not rdatas:
+                    del records[key]
+        else:
+            records.setdefault(key, set()).add(text)
+    records[(origin, dns.rdatatype.SOA)] = set([
+        conditions.canonical_text(dns.rdatatype.SOA, rrs[0][2].to_text())])
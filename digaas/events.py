@@ -0,0 +1,127 @@
+"""
+Notifications of finished poll requests, for the clients waiting on them.
+
+Requests finished in this process notify their waiters directly from the
+polling path. When the polling happens elsewhere (in poller processes, or on
+any node consuming the redis queue), finished requests are published on a
+redis channel instead, and each front end runs one subscriber greenlet that
+relays them to its local waiters.
+
+Streams (see Subscription) get every finished request matching their filters.
+"""
+import gevent
+import gevent.queue
+from gevent.event import AsyncResult
+
+from digaas.config import CONFIG as config
+from digaas import storage
+from digaas.consts import Condition
+
+# id -> list of AsyncResults, set to the finished PollRequest
+_waiters = {}
+_subscriptions = set()
+_subscriber = None
+
+
+class Subscription(object):
+    """A bounded buffer of finished poll requests for one stream consumer.
+
+    When the buffer is full, new events are dropped and counted instead, so a
+    slow consumer can never hold up the poller.
+    """
+
+    def __init__(self, maxsize, nameserver=None, condition=None):
+        """
+        :param condition: only match conditions starting with this, so that
+            "data=" matches every data= condition
+        """
+        self.queue = gevent.queue.Queue(maxsize)
+        self.nameserver = nameserver
+        self.condition = condition
+        self.dropped = 0
+
+    def matches(self, poll_req):
+        if self.nameserver is not None \
+                and self.nameserver not in poll_req.get_nameservers():
+            return False
+        if self.condition is not None and not poll_req.condition.startswith(self.condition):
+            return False
+        return True
+
+    def offer(self, poll_req):
+        try:
+            self.queue.put_nowait(poll_req)
+        except gevent.queue.Full:
+            self.dropped += 1
+
+    def take_dropped(self):
+        """Return the number of events dropped since the last call"""
+        dropped, self.dropped = self.dropped, 0
+        return dropped
+
+
+def is_distributed():
+    """Return True if requests may finish in some other process"""
+    return bool(config.poll_processes) or config.poll_queue == 'redis'
+
+
+def watch(id):
+    """Start watching for the poll request to finish. Returns an AsyncResult
+    that gets the finished PollRequest. Call unwatch() when done with it."""
+    result = AsyncResult()
+    _waiters.setdefault(id, []).append(result)
+    return result
+
+
+def unwatch(id, result):
+    results = _waiters.get(id)
+    if results and result in results:
+        results.remove(result)
+        if not results:
+            del _waiters[id]
+
+
+def subscribe(maxsize, nameserver=None, condition=None):
+    """Start a stream of finished poll requests. Call unsubscribe() when done."""
+    subscription = Subscription(maxsize, nameserver, condition)
+    _subscriptions.add(subscription)
+    return subscription
+
+
+def unsubscribe(subscription):
+    _subscriptions.discard(subscription)
+
+
+def notify(poll_req):
+    """Wake everyone in this process waiting on the poll request"""
+    for result in _waiters.pop(poll_req.id, ()):
+        result.set(poll_req)
+    for subscription in _subscriptions:
+        if subscription.matches(poll_req):
+            subscription.offer(poll_req)
+
+
+def finished(poll_req):
+    """Called from the polling path once a request has finished"""
+    if is_distributed():
+        # our own subscriber relays it back to us, along with everyone else's
+        storage.publish_finished_poll_request(poll_req)
+    else:
+        notify(poll_req)
+
+
+def start_subscriber():
+    """Relay requests finished in other processes to this one's waiters"""
+    global _subscriber
+    if _subscriber is None:
+        _subscriber = gevent.spawn(_subscribe_forever)
+
+
+def _subscribe_forever():
+    while True:
+        try:
+            for poll_req in storage.subscribe_finished_poll_requests():
+                notify(poll_req)
+        except Exception as e:
+            print "events: lost the redis subscription: %s" % e
+            gevent.sleep(1)
@@ -81,3 +81,42 @@ def push_error_data():
     timestamp = int(time.time())
     message = "digaas.errors {0} {1}\n".format(1, timestamp)
     graphite_queue.put(message)
+
+
+def push_hedging_data(nameserver, hedge_rate, hedge_win_rate, timeout_rate):
+    if graphite_queue is None:
+        return
+    nameserver = nameserver.replace('.', '-')
+    timestamp = int(time.time())
+    message = "digaas.hedging.hedge_rate.{0} {1} {2}\n".format(
+        nameserver, hedge_rate, timestamp)
+    message += "digaas.hedging.hedge_win_rate.{0} {1} {2}\n".format(
+        nameserver, hedge_win_rate, timestamp)
+    message += "digaas.hedging.timeout_rate.{0} {1} {2}\n".format(
+        nameserver, timeout_rate, timestamp)
+    graphite_queue.put(message)
+
+
+def push_pacing_data(nameserver, qps, avg_queue_delay, max_queue_delay):
+    if graphite_queue is None:
+        return
+    nameserver = nameserver.replace('.', '-')
+    timestamp = int(time.time())
+    message = "digaas.pacing.qps.{0} {1} {2}\n".format(
+        nameserver, qps, timestamp)
+    message += "digaas.pacing.avg_queue_delay.{0} {1} {2}\n".format(
+        nameserver, avg_queue_delay, timestamp)
+    message += "digaas.pacing.max_queue_delay.{0} {1} {2}\n".format(
+        nameserver, max_queue_delay, timestamp)
+    graphite_queue.put(message)
+
+
+def push_storage_data(mean_batch, max_batch, mean_latency, max_latency):
+    if graphite_queue is None:
+        return
+    timestamp = int(time.time())
+    message = "digaas.storage.mean_batch {0} {1}\n".format(mean_batch, timestamp)
+    message += "digaas.storage.max_batch {0} {1}\n".format(max_batch, timestamp)
+    message += "digaas.storage.mean_flush_latency {0} {1}\n".format(mean_latency, timestamp)
+    message += "digaas.storage.max_flush_latency {0} {1}\n".format(max_latency, timestamp)
+    graphite_queue.put(message)
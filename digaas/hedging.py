@@ -0,0 +1,168 @@
+"""
+Hedged udp queries.
+
+A dropped packet used to cost a whole probe: nothing was learned until the
+next tick, which could add a full interval of error to the measured duration.
+Instead, when a udp query isn't answered within a short deadline, a duplicate
+is sent (with its own message id, on another of the nameserver's sockets) and
+whichever response arrives first is used.
+
+The hedge deadline adapts to each nameserver the way a tcp retransmission
+timeout does (RFC 6298): srtt + 4 * rttvar of the observed response times.
+Each copy has its own message id, unique among all the nameserver's sockets,
+so we always know which one was answered and every response gives a clean rtt
+sample.
+"""
+import struct
+
+import gevent
+import gevent.event
+import dns.exception
+from monotonic import monotonic
+
+from digaas.config import CONFIG as config
+from digaas import graphite
+from digaas import udpmux
+
+# how often the hedge rates are pushed to graphite
+REPORT_INTERVAL = 10
+# never hedge sooner than this, in seconds
+MIN_HEDGE_DELAY = 0.01
+
+
+class RttEstimator(object):
+    """The smoothed round trip time to a nameserver and its variation"""
+    __slots__ = ('srtt', 'rttvar')
+
+    ALPHA = 1 / 8.0
+    BETA = 1 / 4.0
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+
+    def hedge_delay(self, timeout):
+        """How long to wait for a response before sending a duplicate. Until
+        there's a sample, hedge halfway to the timeout."""
+        if self.srtt is None:
+            return timeout / 2
+        return min(max(self.srtt + 4 * self.rttvar, MIN_HEDGE_DELAY), timeout)
+
+
+class _Window(object):
+    """Counts queries, hedges and timeouts for one nameserver between reports"""
+    __slots__ = ('queries', 'hedges', 'hedge_wins', 'timeouts')
+
+    def __init__(self):
+        self.queries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.timeouts = 0
+
+
+_estimators = {}  # nameserver -> RttEstimator
+_windows = {}     # nameserver -> _Window
+_reports = {}     # nameserver -> the last report, as a dict
+_reporter = None
+
+
+def get_estimator(nameserver):
+    estimator = _estimators.get(nameserver)
+    if estimator is None:
+        estimator = _estimators[nameserver] = RttEstimator()
+    return estimator
+
+
+def query(nameserver, wire, timeout, port=53):
+    """Send a udp query, plus up to dns_query_hedges duplicates while it goes
+    unanswered, and return the wire format of the first response. Raises
+    dns.exception.Timeout if nothing is answered within the timeout."""
+    global _reporter
+    if _reporter is None:
+        _reporter = gevent.spawn(_report_forever)
+
+    window = _windows.get(nameserver)
+    if window is None:
+        window = _windows[nameserver] = _Window()
+    window.queries += 1
+
+    estimator = get_estimator(nameserver)
+    delay = estimator.hedge_delay(timeout)
+    deadline = monotonic() + timeout
+    result = gevent.event.AsyncResult()
+    sent = []  # (socket, key, send time), in the order sent
+    try:
+        _send(nameserver, port, wire, deadline, result, sent)
+        for _ in xrange(config.dns_query_hedges):
+            hedge_at = min(sent[-1][2] + delay, deadline)
+            result.wait(max(0.0, hedge_at - monotonic()))
+            if result.ready() or monotonic() >= deadline:
+                break
+            window.hedges += 1
+            _send(nameserver, port, wire, deadline, result, sent)
+            # back off, in case it's the nameserver that's slow
+            delay *= 2
+        resp = result.get()
+    except dns.exception.Timeout:
+        window.timeouts += 1
+        raise
+    finally:
+        for sock, key, _ in sent:
+            sock.cancel(key)
+
+    qid = struct.unpack('!H', resp[:2])[0]
+    for i, (_, key, sent_at) in enumerate(sent):
+        if key[0] == qid:
+            estimator.sample(monotonic() - sent_at)
+            if i > 0:
+                window.hedge_wins += 1
+            break
+    return resp
+
+
+def _send(nameserver, port, wire, deadline, result, sent):
+    # successive copies go out on different sockets of the pool
+    sock = udpmux.get_socket(nameserver, port)
+    key = sock.send(wire, deadline, result)
+    sent.append((sock, key, monotonic()))
+
+
+def get_reports():
+    """Return the latest hedging report for each nameserver"""
+    return dict(_reports)
+
+
+def _report_forever():
+    while True:
+        gevent.sleep(REPORT_INTERVAL)
+        _report()
+
+
+def _report():
+    for nameserver, window in _windows.items():
+        _windows[nameserver] = _Window()
+        queries = float(window.queries) or 1.0
+        estimator = get_estimator(nameserver)
+        report = dict(
+            queries=window.queries,
+            hedges=window.hedges,
+            hedge_wins=window.hedge_wins,
+            timeouts=window.timeouts,
+            hedge_rate=window.hedges / queries,
+            hedge_win_rate=window.hedge_wins / queries,
+            timeout_rate=window.timeouts / queries,
+            srtt=estimator.srtt,
+            rttvar=estimator.rttvar,
+            hedge_delay=estimator.hedge_delay(config.dns_query_timeout),
+        )
+        _reports[nameserver] = report
+        graphite.push_hedging_data(nameserver, report['hedge_rate'],
+                                   report['hedge_win_rate'], report['timeout_rate'])
@@ -0,0 +1,92 @@
+"""
+Plot images, stored as files named for the sha256 of their contents.
+
+Only the metadata (when each image was stored, and its size) is kept in redis,
+so big plots don't take up redis memory, and the api can hand the open file to
+the server to send, rather than reading it into memory. Since an image's name
+is its contents' hash, the contents at a name never change, so clients may
+cache them for good.
+
+Images live in "image_dir" from the config. When several api nodes serve
+images, that should be a directory they all share.
+"""
+import errno
+import hashlib
+import os
+import re
+import shutil
+
+from digaas.config import CONFIG
+
+_DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+_image_dir = None
+
+
+def get_image_dir():
+    global _image_dir
+    if _image_dir is None:
+        image_dir = CONFIG.image_dir
+        if not os.path.exists(image_dir):
+            os.makedirs(image_dir)
+        print "USING IMAGE_DIR = %s" % image_dir
+        _image_dir = image_dir
+    return _image_dir
+
+
+def is_digest(id):
+    return _DIGEST.match(id) is not None
+
+
+def get_path(digest):
+    return os.path.join(get_image_dir(), digest[:2], digest + '.png')
+
+
+def store(filename):
+    """Move the file into the image store.
+
+    :returns: the digest and size of the image
+    """
+    sha = hashlib.sha256()
+    size = 0
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(65536), ''):
+            sha.update(block)
+            size += len(block)
+    digest = sha.hexdigest()
+
+    path = get_path(digest)
+    if os.path.exists(path):
+        # the same plot is already stored
+        os.remove(filename)
+        return digest, size
+    if not os.path.exists(os.path.dirname(path)):
+        try:
+            os.mkdir(os.path.dirname(path))
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    # move it in under a temporary name first, so the image is never seen
+    # half written
+    tmp_path = '{0}.{1}.tmp'.format(path, os.getpid())
+    shutil.move(filename, tmp_path)
+    os.rename(tmp_path, path)
+    return digest, size
+
+
+def open_image(digest):
+    """Return the image file opened for reading, or None if it's not stored"""
+    try:
+        return open(get_path(digest), 'rb')
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return None
+        raise
+
+
+def delete(digest):
+    try:
+        os.remove(get_path(digest))
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
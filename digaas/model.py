@@ -1,13 +1,45 @@
 import uuid
 
+from digaas import conditions
 from digaas import consts
 
+# a PollRequest's predicate before it's compiled
+_NOT_COMPILED = object()
+# the longest string, in utf-8 bytes, and the most nameservers a poll request
+# can have. Storage writes their lengths in two bytes (see digaas.storage).
+MAX_FIELD_LENGTH = 0xfffe
+
 class PollRequest(object):
 
+    # there's one of these per pending poll request, so avoid a __dict__
+    __slots__ = ('query_name', 'nameserver', 'rdatatype', 'serial', 'start_time',
+                 'duration', 'id', 'status', 'condition', 'timeout', 'frequency',
+                 'adaptive', 'query_budget', 'transport', 'nameservers', 'quorum',
+                 'results', 'first_duration', 'quorum_duration', 'zone', '_predicate')
+
     def __init__(self, query_name, nameserver, serial, start_time, condition,
-                 timeout, frequency, rdatatype=None, duration=None, id=None, status=None):
+                 timeout, frequency, rdatatype=None, duration=None, id=None, status=None,
+                 adaptive=False, query_budget=None, transport=None, nameservers=None,
+                 quorum=None, results=None, first_duration=None, quorum_duration=None,
+                 zone=None):
         """
         :param id: if None, generate a uuid.
+        :param adaptive: if True, learn when to probe from past requests to
+            the same nameserver (see digaas.cadence)
+        :param query_budget: the max number of probes in adaptive mode
+        :param transport: "udp" or "tcp". If None, use the nameserver's
+            configured transport.
+        :param nameservers: poll all of these nameservers, instead of the one
+            nameserver. The duration is then the time they had all seen the
+            change.
+        :param quorum: the number of nameservers that make up a quorum. If
+            None, a majority.
+        :param results: nameserver -> duration (or None if it timed out), for
+            each of the nameservers
+        :param first_duration: the time the first of the nameservers saw it
+        :param quorum_duration: the time a quorum of the nameservers saw it
+        :param zone: the zone containing the query_name of a data= request. If
+            given, the request is checked from transfers of the zone.
         """
         self.query_name = query_name
         self.nameserver = nameserver
@@ -20,30 +52,130 @@ class PollRequest(object):
         self.condition = condition
         self.timeout = int(timeout)
         self.frequency = float(frequency)
+        self.adaptive = bool(adaptive)
+        self.query_budget = int(query_budget) if query_budget is not None else None
+        self.transport = transport
+        self.nameservers = list(nameservers) if nameservers else None
+        self.quorum = int(quorum) if quorum is not None else None
+        self.results = results
+        self.first_duration = float(first_duration) if first_duration is not None else None
+        self.quorum_duration = float(quorum_duration) if quorum_duration is not None else None
+        self.zone = zone
+        self._predicate = _NOT_COMPILED
+
+    @property
+    def predicate(self):
+        """The compiled record condition, or None for a condition on the
+        zone's SOA. It's compiled once, when the request is first polled,
+        rather than on every probe or every read from storage. Raises
+        ValueError if the rdatas don't parse."""
+        if self._predicate is _NOT_COMPILED:
+            self._predicate = conditions.compile(self.condition, self.rdatatype)
+        return self._predicate
+
+    def get_nameservers(self):
+        return self.nameservers or [self.nameserver]
+
+    def get_quorum(self):
+        if self.quorum is not None:
+            return self.quorum
+        return len(self.get_nameservers()) // 2 + 1
+
+    def get_durations(self):
+        """Return a (nameserver, duration) pair for each nameserver polled"""
+        if self.nameservers:
+            results = self.results or {}
+            return [(nameserver, results.get(nameserver))
+                    for nameserver in self.nameservers]
+        return [(self.nameserver, self.duration)]
 
     @classmethod
     def validate(cls, data):
-        keys = ('query_name', 'nameserver', 'start_time', 'serial', 'condition',
-                'timeout', 'frequency')
+        keys = ('query_name', 'start_time', 'serial', 'condition', 'timeout',
+                'frequency')
         for key in keys:
             if key not in data:
                 raise ValueError("Missing '{0}' from {1}. Expecting keys {2}"
                                  .format(key, data, keys))
 
+        for key in ('query_name', 'nameserver', 'rdatatype', 'condition', 'transport', 'zone'):
+            if _encoded_length(data.get(key)) > MAX_FIELD_LENGTH:
+                raise ValueError("'{0}' is longer than {1} bytes".format(key, MAX_FIELD_LENGTH))
+
+        nameservers = data.get('nameservers')
+        if nameservers is None:
+            if 'nameserver' not in data:
+                raise ValueError("Missing 'nameserver' (or 'nameservers') from {0}"
+                                 .format(data))
+        else:
+            if not isinstance(nameservers, list) or not nameservers \
+                    or not all(isinstance(ns, basestring) and ns for ns in nameservers):
+                raise ValueError("'nameservers' must be a list of nameserver ips (got {0})"
+                                 .format(nameservers))
+            if len(nameservers) > MAX_FIELD_LENGTH or any(
+                    _encoded_length(ns) > MAX_FIELD_LENGTH for ns in nameservers):
+                raise ValueError("'nameservers' may have at most {0} nameservers of at most "
+                                 "{0} bytes each".format(MAX_FIELD_LENGTH))
+            if len(set(nameservers)) != len(nameservers):
+                raise ValueError("'nameservers' has duplicates: {0}".format(nameservers))
+            if data.get('nameserver') is not None:
+                raise ValueError("Provide one of 'nameserver' and 'nameservers', not both")
+
+        quorum = data.get('quorum')
+        if quorum is not None:
+            if nameservers is None:
+                raise ValueError("'quorum' only applies with 'nameservers'")
+            if not isinstance(quorum, int) or not 1 <= quorum <= len(nameservers):
+                raise ValueError("'quorum' must be an integer from 1 to {0} (got {1})"
+                                 .format(len(nameservers), quorum))
+
         condition = data['condition']
         if not consts.Condition.validate_condition(condition):
             raise ValueError("Invalid condition '{0}'. Valid conditions: {1}"
                              .format(condition, consts.Condition.ALL))
 
-        if condition.startswith(consts.Condition.DATA_EQUALS):
+        if consts.Condition.is_record_condition(condition):
             rdatatype = data.get('rdatatype')
             if not rdatatype:
                 raise ValueError("Must provide 'rdatatype' field with '{0}' condition"
                                  .format(condition))
-            valid_record_types = ('NS', 'A', 'AAAA')
-            if not rdatatype.upper() in valid_record_types:
+            if not rdatatype.upper() in conditions.RDATATYPES:
                 raise ValueError("rdatatype {0} is not supported. Valid record types: {1}"
-                                 .format(rdatatype, valid_record_types))
+                                 .format(rdatatype, conditions.RDATATYPES))
+            conditions.compile(condition, rdatatype)
+
+        zone = data.get('zone')
+        if zone is not None:
+            if not consts.Condition.is_record_condition(condition):
+                raise ValueError("'zone' only applies with the '{0}', '{1}' and '{2}' conditions"
+                                 .format(consts.Condition.DATA_EQUALS,
+                                         consts.Condition.RRSET_EQUALS,
+                                         consts.Condition.ABSENT))
+            if not isinstance(zone, basestring) or not zone:
+                raise ValueError("'zone' must be a zone name (got {0})".format(zone))
+            name = data['query_name'].lower().rstrip('.')
+            origin = zone.lower().rstrip('.')
+            if name != origin and not name.endswith('.' + origin):
+                raise ValueError("query_name {0} is not in zone {1}"
+                                 .format(data['query_name'], zone))
+
+        adaptive = data.get('adaptive')
+        if adaptive is not None and not isinstance(adaptive, bool):
+            raise ValueError("'adaptive' must be true or false (got {0})".format(adaptive))
+
+        query_budget = data.get('query_budget')
+        if query_budget is not None:
+            if not adaptive:
+                raise ValueError("'query_budget' only applies with 'adaptive': true")
+            if not isinstance(query_budget, int) or isinstance(query_budget, bool) \
+                    or query_budget < 1:
+                raise ValueError("'query_budget' must be a positive integer (got {0})"
+                                 .format(query_budget))
+
+        transport = data.get('transport')
+        if transport is not None and transport not in consts.Transport.ALL:
+            raise ValueError("Invalid transport '{0}'. Valid transports: {1}"
+                             .format(transport, consts.Transport.ALL))
 
     @classmethod
     def from_dict(cls, data):
@@ -57,7 +189,16 @@ class PollRequest(object):
                            status=data.get('status'),
                            condition=data.get('condition'),
                            timeout=data.get('timeout'),
-                           frequency=data.get('frequency'))
+                           frequency=data.get('frequency'),
+                           adaptive=data.get('adaptive', False),
+                           query_budget=data.get('query_budget'),
+                           transport=data.get('transport'),
+                           nameservers=data.get('nameservers'),
+                           quorum=data.get('quorum'),
+                           results=data.get('results'),
+                           first_duration=data.get('first_duration'),
+                           quorum_duration=data.get('quorum_duration'),
+                           zone=data.get('zone'))
 
     def to_dict(self):
         return dict(query_name=self.query_name,
@@ -70,17 +211,43 @@ class PollRequest(object):
                     status=self.status,
                     condition=self.condition,
                     timeout=self.timeout,
-                    frequency=self.frequency)
+                    frequency=self.frequency,
+                    adaptive=self.adaptive,
+                    query_budget=self.query_budget,
+                    transport=self.transport,
+                    nameservers=self.nameservers,
+                    quorum=self.quorum,
+                    results=self.results,
+                    first_duration=self.first_duration,
+                    quorum_duration=self.quorum_duration,
+                    zone=self.zone)
+
+
+def _encoded_length(s):
+    """The length of the string as storage writes it, or 0 if it isn't one"""
+    if isinstance(s, unicode):
+        return len(s.encode('utf-8'))
+    if isinstance(s, str):
+        return len(s)
+    return 0
 
 
 class StatsRequest(object):
 
-    def __init__(self, start_time, end_time, status=None, id=None, image_id=None):
+    # the ways the plotted data can be grouped
+    GROUP_BY = ('nameserver',)
+
+    def __init__(self, start_time, end_time, status=None, id=None, image_id=None,
+                 group_by=None):
+        """
+        :param group_by: if "nameserver", plot each nameserver separately
+        """
         self.id = id if id is not None else str(uuid.uuid4())
         self.start_time = float(start_time) if start_time is not None else None
         self.end_time = float(end_time)
         self.image_id = image_id
         self.status = status
+        self.group_by = group_by
 
     @classmethod
     def validate(cls, data):
@@ -96,6 +263,11 @@ class StatsRequest(object):
             raise ValueError("End time {0} must come after the start time {1}"
                              .format(end_time, start_time))
 
+        group_by = data.get('group_by')
+        if group_by is not None and group_by not in cls.GROUP_BY:
+            raise ValueError("Invalid group_by '{0}'. Valid values: {1}"
+                             .format(group_by, cls.GROUP_BY))
+
 
     @classmethod
     def from_dict(cls, data):
@@ -105,6 +277,7 @@ class StatsRequest(object):
             end_time=data.get('end_time'),
             id=data.get('id'),
             image_id=data.get('image_id'),
+            group_by=data.get('group_by'),
         )
 
     def to_dict(self):
@@ -114,4 +287,5 @@ class StatsRequest(object):
             end_time=self.end_time,
             id=self.id,
             image_id=self.image_id,
+            group_by=self.group_by,
         )
@@ -0,0 +1,65 @@
+"""
+A listener for DNS NOTIFY messages (RFC 1996).
+
+Nameservers send a NOTIFY to their secondaries as soon as a zone's serial
+changes. If digaas is listed as a secondary (and notify_port is set in the
+config), a NOTIFY from a nameserver we're polling finishes the pending
+serial_not_lower requests for that zone at the time the NOTIFY arrived,
+instead of at the next probe. The watcher sends one SOA query right away to
+confirm the serial before anything is finished.
+"""
+import time
+
+import gevent.server
+import dns.exception
+import dns.flags
+import dns.message
+import dns.opcode
+import dns.rdatatype
+
+
+class NotifyServer(gevent.server.DatagramServer):
+    """Acknowledges every NOTIFY and hands it to the handler"""
+
+    def __init__(self, listener, handler):
+        """
+        :param handler: called with (zone_name, nameserver, serial,
+            received_at) for each NOTIFY. The serial is None if the NOTIFY
+            didn't include the SOA.
+        """
+        super(NotifyServer, self).__init__(listener)
+        self.handler = handler
+
+    def handle(self, data, address):
+        received_at = time.time()
+        try:
+            message = dns.message.from_wire(data)
+        except dns.exception.DNSException:
+            return
+        if message.opcode() != dns.opcode.NOTIFY or message.flags & dns.flags.QR \
+                or len(message.question) != 1:
+            return
+        question = message.question[0]
+        if question.rdtype != dns.rdatatype.SOA:
+            return
+
+        serial = None
+        for rrset in message.answer:
+            if rrset.rdtype == dns.rdatatype.SOA and rrset.name == question.name:
+                serial = rrset[0].serial
+
+        # the nameserver retries until we acknowledge it
+        response = dns.message.make_response(message)
+        response.flags |= dns.flags.AA
+        self.socket.sendto(response.to_wire(), address)
+
+        print "notify: {0} serial {1} from {2}".format(question.name, serial, address[0])
+        self.handler(question.name.to_text(), address[0], serial, received_at)
+
+
+def start(address, port, handler):
+    """Start listening for NOTIFY messages in the background"""
+    server = NotifyServer((address, port), handler)
+    server.start()
+    print "notify: listening on {0}:{1}".format(address, port)
+    return server
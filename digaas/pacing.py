@@ -0,0 +1,151 @@
+"""
+Per-nameserver query pacing.
+
+A burst of poll requests would otherwise probe the nameserver in lockstep,
+and a nameserver that drops or rate-limits the spike distorts the very times
+we're trying to measure. Queries to a nameserver with a budget in the
+"nameserver_qps" config option take a token from a token bucket first, and
+new watchers for it start at a random phase of their interval.
+
+We keep track of the achieved qps and of how long queries waited for a token,
+so we can confirm the pacing didn't add latency to the measurements.
+"""
+import random
+
+import gevent
+from monotonic import monotonic
+
+from digaas.config import CONFIG as config
+from digaas import graphite
+
+# how often the achieved rates are pushed to graphite
+REPORT_INTERVAL = 10
+# the bucket holds enough tokens for this many seconds worth of queries
+BURST_SECONDS = 0.1
+
+
+class TokenBucket(object):
+    """Hands out tokens at a fixed rate, allowing short bursts.
+
+    Tokens are reserved rather than waited for, so callers are served in the
+    order they asked and no one has to loop.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = monotonic()
+
+    def reserve(self):
+        """Take a token. Return how long to wait before it may be used."""
+        now = monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class _Window(object):
+    """Counts queries and token waits for one nameserver between reports"""
+    __slots__ = ('start', 'count', 'total_delay', 'max_delay')
+
+    def __init__(self):
+        self.start = monotonic()
+        self.count = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+
+
+# the fraction of each nameserver's budget this process may use
+_share = 1.0
+_buckets = {}   # nameserver -> TokenBucket, or None if unpaced
+_windows = {}   # nameserver -> _Window
+_reports = {}   # nameserver -> the last report, as a dict
+_reporter = None
+
+
+def get_qps(nameserver):
+    """Return the configured qps budget for the nameserver, or None"""
+    qps = config.nameserver_qps
+    return qps.get(nameserver, qps.get('default'))
+
+
+def set_share(share):
+    """Use only this fraction of each budget, when several processes poll"""
+    global _share
+    _share = share
+    _buckets.clear()
+
+
+def get_bucket(nameserver):
+    if nameserver not in _buckets:
+        qps = get_qps(nameserver)
+        if qps:
+            qps *= _share
+            _buckets[nameserver] = TokenBucket(qps, max(1.0, qps * BURST_SECONDS))
+        else:
+            _buckets[nameserver] = None
+    return _buckets[nameserver]
+
+
+def phase_offset(nameserver, interval):
+    """Return a delay for the first probe of a new watcher, spread across the
+    interval so that a burst of requests doesn't probe in lockstep. Unpaced
+    nameservers are probed immediately, as they always were."""
+    if get_bucket(nameserver) is None:
+        return 0.0
+    return random.uniform(0, interval)
+
+
+def acquire(nameserver):
+    """Wait until we may send a query to the nameserver.
+
+    :return: the time spent waiting, in seconds
+    """
+    global _reporter
+    if _reporter is None:
+        _reporter = gevent.spawn(_report_forever)
+
+    bucket = get_bucket(nameserver)
+    delay = bucket.reserve() if bucket is not None else 0.0
+    if delay > 0:
+        gevent.sleep(delay)
+
+    window = _windows.get(nameserver)
+    if window is None:
+        window = _windows[nameserver] = _Window()
+    window.count += 1
+    window.total_delay += delay
+    window.max_delay = max(window.max_delay, delay)
+    return delay
+
+
+def get_reports():
+    """Return the latest pacing report for each nameserver"""
+    return dict(_reports)
+
+
+def _report_forever():
+    while True:
+        gevent.sleep(REPORT_INTERVAL)
+        _report()
+
+
+def _report():
+    now = monotonic()
+    for nameserver, window in _windows.items():
+        _windows[nameserver] = _Window()
+        elapsed = now - window.start
+        report = dict(
+            qps=window.count / elapsed if elapsed > 0 else 0.0,
+            qps_limit=get_qps(nameserver),
+            queries=window.count,
+            avg_queue_delay=window.total_delay / window.count if window.count else 0.0,
+            max_queue_delay=window.max_delay,
+        )
+        _reports[nameserver] = report
+        graphite.push_pacing_data(nameserver, report['qps'],
+                                  report['avg_queue_delay'], report['max_queue_delay'])
@@ -1,25 +1,594 @@
+import heapq
+import itertools
 import time
 
 import gevent
+import gevent.event
+import gevent.pool
 import dns.exception
+import dns.rcode
+import dns.rdatatype
+from monotonic import monotonic
 
+from digaas import cadence
+from digaas import conditions
 from digaas import digdig
+from digaas import events
 from digaas.config import CONFIG as config
 from digaas import storage
 from digaas import graphite
+from digaas import pacing
+from digaas import shards
+from digaas import workqueue
 
-from consts import Status, Condition
+from consts import Status, Condition, Transport
+
+
+# tie-breaker for heap entries, so we never compare the objects themselves
+_counter = itertools.count()
+
+
+class _PollTask(object):
+    """The state for one pending poll request. There can be a lot of these, so
+    keep them small."""
+    __slots__ = ('poll_req', 'deadline', 'next_due', 'plan', 'done', 'fanout')
+
+    def __init__(self, poll_req, now, deadline, nameserver, fanout=None):
+        """
+        :param nameserver: the nameserver this task polls
+        :param fanout: the _FanOut this task reports to, for a request with
+            several nameservers
+        """
+        self.poll_req = poll_req
+        self.deadline = deadline
+        self.fanout = fanout
+        # only adaptive requests have their own probe times. The rest follow
+        # their watcher's fixed cadence.
+        self.next_due = None
+        self.plan = None
+        self.done = False
+        if poll_req.adaptive:
+            times = cadence.plan(poll_req, now, nameserver)
+            if times:
+                self.next_due = times[0]
+                # the rest of the plan, reversed so we can pop() off the end
+                self.plan = times[:0:-1]
+
+    def advance(self, now):
+        """Move next_due to the next planned probe time after now"""
+        while self.plan and self.plan[-1] <= now:
+            self.plan.pop()
+        # once the plan is used up, we only wait for the deadline
+        self.next_due = self.plan.pop() if self.plan else float('inf')
+
+
+class _FanOut(object):
+    """Collects the per-nameserver results of a poll request with several
+    nameservers. The request is polled by one task per nameserver, each in
+    that nameserver's watcher, and it's finished once they all are."""
+    __slots__ = ('poll_req', 'remaining')
+
+    def __init__(self, poll_req):
+        self.poll_req = poll_req
+        self.remaining = len(poll_req.nameservers)
+        poll_req.results = {}
+
+    def finish(self, nameserver, end_time):
+        poll_req = self.poll_req
+        if end_time is not None:
+            poll_req.results[nameserver] = end_time - poll_req.start_time
+        else:
+            poll_req.results[nameserver] = None
+        self.remaining -= 1
+        if self.remaining:
+            return
+        durations = poll_req.results.values()
+        if None in durations:
+            _complete(poll_req, None)
+        else:
+            _complete(poll_req, poll_req.start_time + max(durations))
+
+
+class Watcher(object):
+    """Probes one (query_name, nameserver, rdatatype, transport) on behalf of
+    every poll request that is waiting on it.
+
+    Each probe is a single dns query, and every request that the answer
+    satisfies is finished from it. Requests are indexed by what they're
+    waiting for: serial_not_lower requests are in a min-heap on the target
+    serial, record requests (data=, rrset=, absent) are grouped by their
+    compiled predicate so each distinct expectation is checked once per
+    answer, and zone_removed requests all finish together on an empty answer.
+
+    The watcher probes on a fixed cadence at the smallest frequency of its
+    requests, plus whenever an adaptive request's plan calls for a probe, and
+    right after a NOTIFY for the zone (see digaas.notify). A probe that
+    confirms the notified serial finishes requests at the time of the NOTIFY.
+
+    Tasks are removed lazily from the heaps: a finished task is only marked
+    done and is skipped when it reaches the top.
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.query_name, self.nameserver, self.rdatatype, self.transport = key
+        self.size = 0
+        self.running = False
+        self.scheduled_at = None
+        self._tick = None        # the next fixed cadence probe
+        self._frequencies = []   # (frequency, seq, task)
+        self._planned = []       # (next_due, seq, task) for adaptive tasks
+        self._deadlines = []     # (deadline, seq, task)
+        self._serials = []       # (serial, seq, task)
+        self._data = {}          # predicate key -> (predicate, set of tasks)
+        self._removed = set()
+        self._notified = None    # (received_at, serial) of the last NOTIFY
+        self._confirm = False    # whether to probe now, to confirm a NOTIFY
+
+    def add(self, task, now):
+        poll_req = task.poll_req
+        seq = next(_counter)
+        if task.plan is None:
+            heapq.heappush(self._frequencies, (poll_req.frequency, seq, task))
+            first = now + pacing.phase_offset(self.nameserver, poll_req.frequency)
+            if self._tick is None or first < self._tick:
+                self._tick = first
+        else:
+            heapq.heappush(self._planned, (task.next_due, seq, task))
+        heapq.heappush(self._deadlines, (task.deadline, seq, task))
+        self._index(task, seq)
+        self.size += 1
+
+    def _index(self, task, seq):
+        """Index the task by what it's waiting for"""
+        poll_req = task.poll_req
+        if poll_req.condition == Condition.SERIAL_NOT_LOWER:
+            heapq.heappush(self._serials, (poll_req.serial, seq, task))
+        elif poll_req.condition == Condition.ZONE_REMOVED:
+            self._removed.add(task)
+        else:
+            _add_to_group(self._data, poll_req.predicate, task)
+
+    def _unindex(self, task):
+        poll_req = task.poll_req
+        if poll_req.condition == Condition.ZONE_REMOVED:
+            self._removed.discard(task)
+        elif poll_req.predicate is not None:
+            _remove_from_group(self._data, poll_req.predicate, task)
+
+    @property
+    def next_due(self):
+        """The next time this watcher needs to run, or None if it's empty"""
+        if not self.size:
+            return None
+        _drop_done(self._deadlines)
+        due = self._deadlines[0][0]
+        if self._tick is not None:
+            due = min(due, self._tick)
+        _drop_done(self._planned)
+        if self._planned:
+            due = min(due, self._planned[0][0])
+        if self._confirm:
+            due = min(due, monotonic())
+        return due
+
+    def notified(self, serial, received_at):
+        """Note a NOTIFY for the zone, and ask for a probe to confirm it.
+
+        :param serial: the serial in the NOTIFY, or None
+        :return: True if any of our requests are waiting on a serial
+        """
+        _drop_done(self._serials)
+        if not self._serials:
+            return False
+        self._notified = (received_at, serial)
+        self._confirm = True
+        return True
+
+    def probe(self):
+        now = monotonic()
+        self._expire(now)
+        if not self.size:
+            return
+
+        due = False
+        _drop_done(self._frequencies)
+        if not self._frequencies:
+            self._tick = None
+        elif self._tick <= now:
+            # skip any ticks we've missed rather than firing them all at once
+            frequency = self._frequencies[0][0]
+            self._tick += frequency
+            if self._tick < now:
+                missed = int((now - self._tick) / frequency) + 1
+                self._tick += missed * frequency
+            due = True
+
+        _drop_done(self._planned)
+        while self._planned and self._planned[0][0] <= now:
+            _, seq, task = heapq.heappop(self._planned)
+            task.advance(now)
+            heapq.heappush(self._planned, (task.next_due, seq, task))
+            due = True
+
+        if self._confirm:
+            self._confirm = False
+            due = True
+
+        if not due:
+            return
+
+        # a NOTIFY only counts for the probe that follows it
+        notified, self._notified = self._notified, None
+        pacing.acquire(self.nameserver)
+        self._check(notified)
+
+    def _check(self, notified):
+        """Send the probe, and finish whatever it satisfies"""
+        try:
+            answer = digdig.query(self.query_name, self.nameserver, self.rdatatype,
+                                  config.dns_query_timeout, self.transport)
+        except dns.exception.Timeout as e:
+            print 'dns.query.{0} timed out'.format(self.transport)
+            if self._notified is None:
+                self._notified = notified
+            return
+        except Exception as e:
+            print e
+            for _, _, task in list(self._deadlines):
+                self._finish(task, None)
+            return
+        self._resolve(answer, time.time(), notified)
+
+    def _resolve(self, answer, end_time, notified=None):
+        """Finish every request that is satisfied by the answer
+
+        :param notified: (received_at, serial) of a NOTIFY received before the
+            query. Requests for a serial it covers finish when it arrived.
+        """
+        if self.rdatatype == 'SOA':
+            serial = answer.serial
+            if serial is not None:
+                while self._serials and self._serials[0][0] <= serial:
+                    target, _, task = heapq.heappop(self._serials)
+                    if notified is not None and (notified[1] is None or target <= notified[1]) \
+                            and notified[0] >= task.poll_req.start_time:
+                        self._finish(task, notified[0])
+                    else:
+                        self._finish(task, end_time)
+            if not answer.count:
+                for task in list(self._removed):
+                    self._finish(task, end_time)
+        elif answer.rcode in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+            # each distinct expectation is checked once, however many requests
+            # are waiting on it
+            rdatas = conditions.canonical_rdatas(self.rdatatype, answer.rdatas)
+            for predicate, tasks in self._data.values():
+                if predicate.matches(rdatas):
+                    for task in list(tasks):
+                        self._finish(task, end_time)
+
+    def _expire(self, now):
+        """Give up on any requests that have passed their timeout"""
+        while self._deadlines and self._deadlines[0][0] <= now:
+            _, _, task = heapq.heappop(self._deadlines)
+            self._finish(task, None)
+
+    def _finish(self, task, end_time):
+        if task.done:
+            return
+        task.done = True
+        self.size -= 1
+        self._unindex(task)
+        if task.fanout is not None:
+            task.fanout.finish(self.nameserver, end_time)
+        else:
+            _complete(task.poll_req, end_time)
+
+
+class ZoneWatcher(Watcher):
+    """Evaluates the record requests for any records in one zone on one
+    nameserver from zone transfers, instead of querying each record.
+
+    Each probe is a single SOA query. Only when the serial changes is the zone
+    transferred (by IXFR from the last serial we saw, falling back to AXFR),
+    and then every pending request is checked, in one pass, against the
+    transferred records of its name and type. Requests added since the last
+    probe are checked against the records we already have, whatever the
+    serial. A failed query or transfer is retried at the next probe, until
+    the requests time out.
+    """
+
+    def __init__(self, key):
+        super(ZoneWatcher, self).__init__(key)
+        self._serial = None      # the serial of the zone we last transferred
+        self._records = None     # (name, rdatatype) -> set of rdata text
+        # (name, rdatatype) -> predicate key -> (predicate, set of tasks)
+        self._pending = {}
+        self._fresh = []         # tasks added since the last probe
+
+    def _index(self, task, seq):
+        _add_to_group(self._pending.setdefault(_record_key(task.poll_req), {}),
+                      task.poll_req.predicate, task)
+        self._fresh.append(task)
+
+    def _unindex(self, task):
+        key = _record_key(task.poll_req)
+        groups = self._pending.get(key)
+        if groups is None:
+            return
+        _remove_from_group(groups, task.poll_req.predicate, task)
+        if not groups:
+            del self._pending[key]
+
+    def notified(self, serial, received_at):
+        if not self.size:
+            return False
+        self._notified = (received_at, serial)
+        self._confirm = True
+        return True
+
+    def _check(self, notified):
+        try:
+            answer = digdig.query(self.query_name, self.nameserver, 'SOA',
+                                  config.dns_query_timeout, self.transport)
+            if answer.serial is None:
+                return
+            if answer.serial == self._serial:
+                self._check_fresh(time.time())
+                return
+            end_time = time.time()
+            self._serial, self._records = digdig.transfer(
+                self.query_name, self.nameserver, self._records, self._serial,
+                config.zone_transfer_timeout)
+        except Exception as e:
+            # like a timeout, whatever went wrong (a refused transfer, a
+            # broken connection) may not happen next time, so keep trying
+            # until the requests time out
+            if isinstance(e, dns.exception.Timeout):
+                print 'zone check of {0} on {1} timed out'.format(self.query_name, self.nameserver)
+            else:
+                print 'zone check of {0} on {1} failed: {2!r}'.format(
+                    self.query_name, self.nameserver, e)
+            if self._notified is None:
+                self._notified = notified
+            return
+
+        # a NOTIFY for the serial we transferred is when the change arrived
+        if notified is not None and notified[1] not in (None, self._serial):
+            notified = None
+        self._fresh = []
+        for key, groups in self._pending.items():
+            records = self._records.get(key, frozenset())
+            for predicate, tasks in groups.values():
+                if not predicate.matches(records):
+                    continue
+                for task in list(tasks):
+                    if notified is not None and notified[0] >= task.poll_req.start_time:
+                        self._finish(task, notified[0])
+                    else:
+                        self._finish(task, end_time)
+
+    def _check_fresh(self, end_time):
+        """Finish the tasks added since the last probe that the records we
+        already transferred satisfy"""
+        fresh, self._fresh = self._fresh, []
+        for task in fresh:
+            if task.done:
+                continue
+            records = self._records.get(_record_key(task.poll_req), frozenset())
+            if task.poll_req.predicate.matches(records):
+                self._finish(task, end_time)
+
+
+def _add_to_group(groups, predicate, task):
+    """Add the task to groups, which maps predicate key -> (predicate, set of
+    tasks)"""
+    group = groups.get(predicate.key)
+    if group is None:
+        group = groups[predicate.key] = (predicate, set())
+    group[1].add(task)
+
+
+def _remove_from_group(groups, predicate, task):
+    group = groups.get(predicate.key)
+    if group is not None:
+        group[1].discard(task)
+        if not group[1]:
+            del groups[predicate.key]
+
+
+def _record_key(poll_req):
+    name = poll_req.query_name.lower()
+    if not name.endswith('.'):
+        name += '.'
+    return (name, dns.rdatatype.from_text(poll_req.rdatatype))
+
+
+def _drop_done(heap):
+    while heap and heap[0][2].done:
+        heapq.heappop(heap)
+
+
+class Scheduler(object):
+    """Sends the probes for every pending poll request.
+
+    Requests are grouped into one Watcher per (query_name, nameserver,
+    rdatatype, transport), except that record requests that name their zone
+    share one ZoneWatcher per (zone, nameserver, transport). The watchers' due
+    times are kept in a heap keyed on a monotonic clock, and a single greenlet
+    pops whatever is due and hands it to a bounded pool of workers. So the
+    number of greenlets, timers and dns queries doesn't grow with the number of
+    pending requests. Each request is probed at a fixed cadence of start + n *
+    frequency, no matter how long the queries take.
+    """
+
+    def __init__(self, pool_size):
+        self._heap = []
+        self._watchers = {}
+        # (zone, nameserver) -> set of SOA watchers, to match NOTIFYs
+        self._zones = {}
+        self._wakeup = gevent.event.Event()
+        self._pool = gevent.pool.Pool(pool_size)
+        self._runner = None
+
+    def add(self, poll_req, accepted_at=None):
+        """Start polling for the request.
+
+        :param accepted_at: the wall clock time the request was accepted, if
+            that was before now. The request's timeout counts from then.
+        """
+        try:
+            poll_req.predicate
+        except ValueError as e:
+            # a request stored before its condition was checked this strictly
+            print "can't poll for {0}: {1}".format(poll_req.id, e)
+            _complete(poll_req, None)
+            return
+        # record requests in a given zone are all checked from zone transfers
+        if poll_req.zone and poll_req.predicate is not None:
+            query_name, rdatatype = poll_req.zone, 'AXFR'
+        elif poll_req.predicate is not None:
+            query_name, rdatatype = poll_req.query_name, poll_req.rdatatype.upper()
+        else:
+            query_name, rdatatype = poll_req.query_name, 'SOA'
+        now = monotonic()
+        deadline = now + poll_req.timeout
+        if accepted_at is not None:
+            deadline -= max(0, time.time() - accepted_at)
+
+        # a request with several nameservers gets a task in each one's watcher
+        fanout = _FanOut(poll_req) if poll_req.nameservers else None
+        for nameserver in poll_req.get_nameservers():
+            key = (query_name, nameserver, rdatatype,
+                   get_transport(poll_req, nameserver))
+            watcher = self._watchers.get(key)
+            if watcher is None:
+                if rdatatype == 'AXFR':
+                    watcher = self._watchers[key] = ZoneWatcher(key)
+                else:
+                    watcher = self._watchers[key] = Watcher(key)
+                if rdatatype in ('SOA', 'AXFR'):
+                    self._zones.setdefault(_zone_key(query_name, nameserver),
+                                           set()).add(watcher)
+            watcher.add(_PollTask(poll_req, now, deadline, nameserver, fanout), now)
+            self._schedule(watcher)
+
+    def notify(self, zone_name, nameserver, serial, received_at):
+        """Confirm a NOTIFY for the zone from the nameserver, in any watchers
+        waiting on its serial.
+
+        :return: the number of watchers that were waiting
+        """
+        matched = 0
+        for watcher in list(self._zones.get(_zone_key(zone_name, nameserver), ())):
+            if watcher.notified(serial, received_at):
+                matched += 1
+                self._schedule(watcher)
+        return matched
+
+    def _schedule(self, watcher):
+        """Put the watcher on the heap, unless it's already there for an earlier
+        time. A running watcher is rescheduled when its probe finishes."""
+        if watcher.running:
+            return
+        due = watcher.next_due
+        if due is None:
+            if self._watchers.pop(watcher.key, None) is not None \
+                    and watcher.rdatatype in ('SOA', 'AXFR'):
+                zone_key = _zone_key(watcher.query_name, watcher.nameserver)
+                watchers = self._zones.get(zone_key)
+                if watchers is not None:
+                    watchers.discard(watcher)
+                    if not watchers:
+                        del self._zones[zone_key]
+            return
+        if watcher.scheduled_at is not None and watcher.scheduled_at <= due:
+            return
+        watcher.scheduled_at = due
+        heapq.heappush(self._heap, (due, next(_counter), watcher))
+
+        if self._runner is None:
+            self._runner = gevent.spawn(self._run)
+        elif self._heap[0][2] is watcher:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = None
+            if self._heap:
+                due, _, watcher = self._heap[0]
+                timeout = due - monotonic()
+                if timeout <= 0:
+                    heapq.heappop(self._heap)
+                    # skip stale entries for watchers that were rescheduled
+                    if watcher.scheduled_at == due and not watcher.running:
+                        watcher.scheduled_at = None
+                        watcher.running = True
+                        # this blocks while all the workers are busy
+                        self._pool.spawn(self._probe, watcher)
+                    continue
+            self._wakeup.wait(timeout)
+
+    def _probe(self, watcher):
+        try:
+            watcher.probe()
+        finally:
+            watcher.running = False
+            self._schedule(watcher)
+
+
+def get_transport(poll_req, nameserver):
+    """Return the transport the request asked for, or else the configured
+    transport for the nameserver"""
+    if poll_req.transport:
+        return poll_req.transport
+    transports = config.nameserver_transport
+    return transports.get(nameserver, transports.get('default', Transport.UDP))
+
+
+def _zone_key(zone_name, nameserver):
+    # zone names match without regard to case or a trailing dot
+    return (zone_name.lower().rstrip('.'), nameserver)
+
+
+SCHEDULER = None
+def get_scheduler():
+    global SCHEDULER
+    if SCHEDULER is None:
+        SCHEDULER = Scheduler(config.poll_workers)
+    return SCHEDULER
 
 
 def receive(poll_req):
-    poll_req.status = Status.ACCEPTED
-    storage.create_poll_request(poll_req)
-    if poll_req.condition.startswith(Condition.DATA_EQUALS):
-        gevent.spawn(_handle_poll_request, poll_req, _data_equals_check)
-    elif poll_req.condition == Condition.SERIAL_NOT_LOWER:
-        gevent.spawn(_handle_poll_request, poll_req, _serial_not_lower_check)
-    elif poll_req.condition == Condition.ZONE_REMOVED:
-        gevent.spawn(_handle_poll_request, poll_req, _zone_removed_check)
+    receive_many([poll_req])
+
+
+def receive_many(poll_reqs):
+    """Accept a batch of poll requests, storing them in one round trip"""
+    accepted_at = time.time()
+    for poll_req in poll_reqs:
+        poll_req.status = Status.ACCEPTED
+    if config.poll_queue == 'redis':
+        storage.enqueue_poll_requests(poll_reqs, accepted_at)
+    elif config.poll_processes:
+        storage.create_poll_requests(poll_reqs)
+        shards.dispatch(poll_reqs, accepted_at)
+    else:
+        storage.create_poll_requests(poll_reqs)
+        scheduler = get_scheduler()
+        for poll_req in poll_reqs:
+            scheduler.add(poll_req)
+
+
+def receive_notify(zone_name, nameserver, serial, received_at):
+    """Handle a NOTIFY for the zone from the nameserver, in whichever processes
+    are polling"""
+    if config.poll_processes:
+        shards.notify(zone_name, nameserver, serial, received_at)
+    else:
+        get_scheduler().notify(zone_name, nameserver, serial, received_at)
 
 
 def finish_request(poll_req, end_time):
@@ -29,62 +598,35 @@ def finish_request(poll_req, end_time):
     else:
         poll_req.status = Status.ERROR
         poll_req.duration = None
+    if poll_req.results is not None:
+        # the nameservers that never saw the change have no duration
+        durations = sorted(d for d in poll_req.results.values() if d is not None)
+        quorum = poll_req.get_quorum()
+        poll_req.first_duration = durations[0] if durations else None
+        poll_req.quorum_duration = durations[quorum - 1] if len(durations) >= quorum else None
 
 
 def publish_datapoint(poll_req):
     if poll_req.status == Status.INTERNAL_ERROR:
         graphite.push_error_data()
-    elif poll_req.status != Status.COMPLETED:
-        graphite.push_timeout_data(poll_req.nameserver)
-    elif poll_req.condition == Condition.ZONE_REMOVED:
-        graphite.push_delete_data(poll_req.nameserver, poll_req.duration)
-    else:
-        graphite.push_update_data(poll_req.nameserver, poll_req.duration)
+        return
+    for nameserver, duration in poll_req.get_durations():
+        if duration is None:
+            graphite.push_timeout_data(nameserver)
+        elif Condition.is_removal(poll_req.condition):
+            graphite.push_delete_data(nameserver, duration)
+        else:
+            graphite.push_update_data(nameserver, duration)
 
 
-def _handle_poll_request(poll_req, function):
-    """
-    :param function: a function that returns True when we're done polling.
-        this function accepts the PollRequest as a parameter.
+def _complete(poll_req, end_time):
+    """Record the outcome of a poll request.
+
+    :param end_time: the time the condition was seen, or None if we gave up
     """
-    end_time = None
-    start = time.time()
-    while time.time() - start < poll_req.timeout:
-        try:
-            if function(poll_req):
-                end_time = time.time()
-                break
-        except dns.exception.Timeout as e:
-            print 'dns.query.udp timed out'
-        except Exception as e:
-            print e
-            break
-        gevent.sleep(seconds=poll_req.frequency)
     finish_request(poll_req, end_time)
     storage.update_poll_request(poll_req)
+    workqueue.release(poll_req.id)
+    events.finished(poll_req)
+    cadence.record(poll_req)
     publish_datapoint(poll_req)
-
-
-def _serial_not_lower_check(poll_req):
-    """Return True if the zone's serial is not lower than poll_req's value"""
-    serial = digdig.get_serial(poll_req.query_name, poll_req.nameserver,
-        config.dns_query_timeout
-    )
-    return serial is not None and serial >= poll_req.serial
-
-
-def _zone_removed_check(poll_req):
-    """Return True if the zone is absent from the nameserver"""
-    zone_found = digdig.zone_exists(poll_req.query_name,
-        poll_req.nameserver, config.dns_query_timeout
-    )
-    return not zone_found
-
-
-def _data_equals_check(poll_req):
-    """Return True if the record's data matches the poll_req's value"""
-    expected_data = poll_req.condition.lstrip(Condition.DATA_EQUALS)
-    record_data = digdig.get_record_data(poll_req.query_name,
-        poll_req.nameserver, poll_req.rdatatype, config.dns_query_timeout
-    )
-    return record_data == expected_data
@@ -0,0 +1,87 @@
+"""
+Expire old data, so that weeks of soak tests don't fill up redis.
+
+With "retention_seconds" in the config, finished poll requests and stats
+requests are stored with that ttl, and a background compactor removes what
+redis can't expire by itself: the datapoints in the time range sorted sets and
+the entries in the poll request indexes for requests that started before the
+retention window, and plot images stored before it. Images are also evicted,
+oldest first, whenever they add up to more than "image_storage_max_bytes".
+With the memory and sqlite storage backends, it also deletes the requests whose
+ttl ran out, which redis does by itself.
+
+The compactor works in chunks of COMPACT_CHUNK members, each removed by one
+short script, and yields between them, so redis is never blocked for long. It
+reads the names of the poll request indexes a page at a time, too.
+"""
+import itertools
+import time
+
+import gevent
+
+from digaas.config import CONFIG as config
+from digaas import storage
+
+# the most members removed per round trip
+COMPACT_CHUNK = 500
+
+_compactor = None
+
+
+def start():
+    """Start compacting in the background, every compact_interval seconds"""
+    global _compactor
+    if _compactor is None:
+        _compactor = gevent.spawn(_compact_forever)
+
+
+def compact(now=None):
+    """Remove everything older than the retention window, and evict images
+    over the size limit.
+
+    :returns: the number of datapoints and index entries trimmed, images
+        evicted and requests expired
+    """
+    now = time.time() if now is None else now
+    trimmed = 0
+    expired = 0
+    if config.retention_seconds:
+        before = now - config.retention_seconds
+        set_names = itertools.chain(storage.TIME_RANGE_SET_NAMES,
+                                    storage.iter_poll_index_names())
+        for set_name in set_names:
+            trimmed += _in_chunks(storage.trim_time_range, set_name, before)
+            gevent.sleep(0)
+        # forget the indexes nothing has been added to since, which are empty
+        _in_chunks(storage.trim_time_range, storage.POLL_INDEXES_SET_NAME, before)
+        expired = _in_chunks(storage.expire_values, now)
+    else:
+        before = 0
+    evicted = _in_chunks(storage.evict_images, before)
+    return trimmed, evicted, expired
+
+
+def _in_chunks(remove, *args):
+    """Call remove with the args and a count of COMPACT_CHUNK until it removes
+    less than a chunk, and return the total removed"""
+    total = 0
+    while True:
+        n = remove(*(args + (COMPACT_CHUNK,)))
+        total += n
+        if n < COMPACT_CHUNK:
+            return total
+        # let everything else have a turn at redis
+        gevent.sleep(0)
+
+
+def _compact_forever():
+    while True:
+        gevent.sleep(config.compact_interval)
+        try:
+            trimmed, evicted, expired = compact()
+        except Exception as e:
+            print "retention: failed to compact: %s" % e
+            continue
+        if trimmed or evicted or expired:
+            print "retention: trimmed %s entries, evicted %s images and expired %s requests" \
+                % (trimmed, evicted, expired)
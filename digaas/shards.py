@@ -0,0 +1,230 @@
+"""
+Spread polling across several poller processes, so it isn't limited to the
+one core the http front end runs on.
+
+With "poll_processes": N in the config, the front end starts N child processes
+running this module. Poll requests are sharded across them by a hash of
+(nameserver, query_name), or (nameserver, zone) for requests that name their
+zone, which keeps every request for a watcher in the same process, and handed
+off one line per request over the child's stdin. The children write results to
+storage themselves.
+
+With "poll_queue": "redis" the children consume the shared work queue
+instead, and the front end doesn't poll at all.
+
+A child that dies is restarted. The front end remembers the requests it handed
+each child until their timeouts have passed, and replays the ones that are
+still ACCEPTED to the restarted child, along with whatever was sent while it
+was down.
+
+NOTIFY messages received by the front end are passed on to every child.
+"""
+import base64
+import heapq
+import os
+import sys
+import time
+import zlib
+
+import gevent
+import gevent.event
+import gevent.subprocess
+from gevent.fileobject import FileObject
+
+from digaas.config import CONFIG as config
+from digaas.consts import Status
+from digaas import storage
+
+# the directory containing the digaas package, so children can import it
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# lines starting with this are NOTIFYs, not poll requests
+NOTIFY_PREFIX = "notify "
+
+# how long after a request's timeout to keep it for replay, to give the child
+# time to store its result
+REPLAY_GRACE_SECONDS = 60
+
+_shards = []
+_started = gevent.event.Event()
+
+
+class _Shard(object):
+    """The front end's handle on one poller process"""
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+        self.proc = None
+        self.down = True
+        # id -> line of each request handed to the child that may not be
+        # finished, to replay if the child dies
+        self._sent = {}
+        self._forget_at = []     # (time, id) to drop each request from _sent
+        # other lines sent while the child was down
+        self._buffer = []
+
+    def start(self):
+        self.proc = gevent.subprocess.Popen(
+            [config.poll_process_python, '-m', 'digaas.shards', str(self.index), str(self.count)],
+            stdin=gevent.subprocess.PIPE, cwd=ROOT_DIR)
+        print "shards: started poller %s (pid %s)" % (self.index, self.proc.pid)
+
+    def watch(self):
+        while True:
+            retcode = self.proc.wait()
+            self.down = True
+            print "shards: poller %s exited with %s. restarting" % (self.index, retcode)
+            gevent.sleep(1)
+            self.start()
+            self._replay()
+
+    def _replay(self):
+        """Send the restarted child the requests that are still ACCEPTED, and
+        then the lines that were sent while it was down"""
+        finished = set(id for id, poll_req in storage.get_poll_requests(list(self._sent))
+                       if poll_req is None or poll_req.status != Status.ACCEPTED)
+        for id in finished:
+            self._sent.pop(id, None)
+        # anything added during the lookup was just accepted
+        lines = self._sent.values()
+        buffered, self._buffer = self._buffer, []
+        print "shards: replaying %s requests to poller %s" % (len(lines), self.index)
+        self.down = False
+        if not self._write("".join(lines + buffered)):
+            self._buffer.extend(buffered)
+
+    def add(self, poll_reqs, accepted_at):
+        """Hand the requests to the child. While it's down, they wait to be
+        replayed to the restarted child."""
+        now = time.time()
+        while self._forget_at and self._forget_at[0][0] <= now:
+            _, id = heapq.heappop(self._forget_at)
+            self._sent.pop(id, None)
+        lines = []
+        for poll_req in poll_reqs:
+            line = fmt_line(poll_req, accepted_at)
+            self._sent[poll_req.id] = line
+            heapq.heappush(self._forget_at, (
+                accepted_at + poll_req.timeout + REPLAY_GRACE_SECONDS, poll_req.id))
+            lines.append(line)
+        self._write("".join(lines))
+
+    def send(self, line):
+        """Send a line that isn't a poll request. While the child is down, it
+        waits for the restarted child."""
+        if not self._write(line):
+            self._buffer.append(line)
+
+    def _write(self, data):
+        """Write to the child's stdin. Returns False if it's down."""
+        if self.down:
+            return False
+        try:
+            self.proc.stdin.write(data)
+            self.proc.stdin.flush()
+        except (IOError, OSError) as e:
+            print "shards: poller %s is down (%s). holding its lines until it's restarted" \
+                % (self.index, e)
+            self.down = True
+            return False
+        return True
+
+
+def start(count):
+    """Start the poller processes in the background"""
+    gevent.spawn(_start, count)
+
+
+def _start(count):
+    for i in xrange(count):
+        shard = _Shard(i, count)
+        shard.start()
+        shard.down = False
+        gevent.spawn(shard.watch)
+        _shards.append(shard)
+    _started.set()
+
+
+def shard_index(poll_req, count):
+    key = "{0} {1}".format(poll_req.get_nameservers()[0],
+                           poll_req.zone or poll_req.query_name)
+    return (zlib.crc32(key) & 0xffffffff) % count
+
+
+def dispatch(poll_reqs, accepted_at):
+    """Hand the requests off to the poller processes that own their shards"""
+    _started.wait()
+    by_shard = [[] for _ in _shards]
+    for poll_req in poll_reqs:
+        by_shard[shard_index(poll_req, len(_shards))].append(poll_req)
+    for shard, shard_reqs in zip(_shards, by_shard):
+        if shard_reqs:
+            shard.add(shard_reqs, accepted_at)
+
+
+def notify(zone_name, nameserver, serial, received_at):
+    """Pass a NOTIFY on to every poller process. They're rare, and any of
+    them may have watchers for the zone."""
+    _started.wait()
+    line = NOTIFY_PREFIX + storage.fmt_value(zone_name, nameserver, serial, received_at) + "\n"
+    for shard in _shards:
+        shard.send(line)
+
+
+def parse_notify_line(line):
+    """This undoes the line made by notify(). Returns (zone_name, nameserver,
+    serial, received_at)"""
+    zone_name, nameserver, serial, received_at = \
+        line[len(NOTIFY_PREFIX):].rstrip('\n').split(' ')
+    return (zone_name, nameserver, storage.cvt(serial, type=int), float(received_at))
+
+
+def fmt_line(poll_req, accepted_at):
+    # the stored value is binary, so it could hold a newline
+    return "{0} {1}\n".format(storage.fmt_value(poll_req.id, accepted_at),
+                              base64.b64encode(storage.fmt_poll_request_value(poll_req)))
+
+
+def parse_line(line):
+    """This undoes fmt_line. Returns a (PollRequest, accepted_at) tuple"""
+    from digaas import model
+    id, accepted_at, val = line.rstrip('\n').split(' ', 2)
+    poll_req = model.PollRequest(
+        id=id, **storage.parse_poll_request_value(base64.b64decode(val)))
+    return poll_req, float(accepted_at)
+
+
+def _child_main(index, count):
+    # imported here, since poll imports this module
+    from digaas import graphite
+    from digaas import pacing
+    from digaas import poll
+    from digaas import workqueue
+
+    graphite.setup(config.graphite_host, config.graphite_port)
+    # the nameserver qps budgets are shared by every poller
+    pacing.set_share(1.0 / count)
+    scheduler = poll.get_scheduler()
+    if config.poll_queue == 'redis':
+        workqueue.start(scheduler)
+
+    # we exit when the front end closes our stdin
+    stdin = FileObject(sys.stdin, 'rb')
+    for line in iter(stdin.readline, ''):
+        if line.startswith(NOTIFY_PREFIX):
+            try:
+                scheduler.notify(*parse_notify_line(line))
+            except Exception as e:
+                print "shards: poller %s got a bad line %r: %s" % (index, line, e)
+            continue
+        try:
+            poll_req, accepted_at = parse_line(line)
+        except Exception as e:
+            print "shards: poller %s got a bad line %r: %s" % (index, line, e)
+            continue
+        scheduler.add(poll_req, accepted_at)
+
+
+if __name__ == '__main__':
+    _child_main(int(sys.argv[1]), int(sys.argv[2]))
@@ -2,11 +2,11 @@ import os
 import textwrap
 import time
 import traceback
-import uuid
 
 import gevent
 import gevent.subprocess
 
+from digaas import images
 from digaas import storage
 from digaas.consts import Status
 
@@ -37,13 +37,17 @@ def construct_filename(start, end):
         int(start * 1000), int(end * 1000), int(time.time() * 1000))
     return os.path.join(STATS_DIR, filename)
 
-def plot_data(data, filename):
+def plot_data(data, filename, group_by=None):
     # in order to color data points easily, I split up the data files
     # according to three categories:
     #   1. updates - times for serial number updates
     #   2. removes - times for removals of zones/records
     #   3. errors - we enter one datapoint for each poll request that errored out
-    # Datapoints contained in the same category/file will be colored the same
+    # Datapoints contained in the same category/file will be colored the same.
+    #
+    # With group_by="nameserver", the updates and removes are also written to
+    # one file per nameserver, and those are plotted instead, so each
+    # nameserver gets its own color.
     updates_data_file = filename.rstrip('.png') + '.updates.dat'
     removes_data_file = filename.rstrip('.png') + '.removes.dat'
     errors_data_file = filename.rstrip('.png') + '.errors.dat'
@@ -87,31 +91,31 @@ def plot_data(data, filename):
         }}
 
         plot \\
-            "{updates_file}" title "Creates/Updates" with points pointtype 5 linecolor rgb "blue", \\
-            "{removes_file}" title "Deletes" with points pointtype 5 linecolor rgb "red", \\
+            {series}
             "{errors_file}" title "Errors" with points pointtype 5 linecolor rgb "black", \\
             UPDATE_mean title sprintf("Avg create/update time (%0.2f s)", UPDATE_mean) linecolor rgb "blue", \\
             DELETE_mean title sprintf("Avg delete time (%0.2f s)", DELETE_mean) linecolor rgb "red"
         """
-    ).format(
-        updates_file=updates_data_file,
-        removes_file=removes_data_file,
-        errors_file=errors_data_file,
-        output_file=filename)
-
-    with open(gnuplot_file, 'w') as f:
-        f.write(gnuplot_script)
+    )
 
     # write out the datafiles
+    grouped_files = {}  # (operation, nameserver) -> open file
     with open(updates_data_file, 'w') as updates_file, \
          open(removes_data_file, 'w') as removes_file, \
          open(errors_data_file, 'w') as errors_file:
 
         n_updates, n_removes, n_errors = 0, 0, 0
         for item in data:
-            operation, serial, duration = item.split()
+            operation, serial, duration, nameserver = storage.parse_time_range_item(item)
             # print "op = %s, serial = %s, duration = %s" % (operation, serial, duration)
-            if duration == "None" or duration is None:
+            if group_by == 'nameserver' and duration is not None \
+                    and operation in ("update", "remove"):
+                key = (operation, nameserver)
+                if key not in grouped_files:
+                    grouped_files[key] = open("{0}.{1}.{2}s.dat".format(
+                        filename.rstrip('.png'), nameserver, operation), 'w')
+                grouped_files[key].write("{0} {1}\n".format(serial, duration))
+            if duration is None:
                 # python redis client saves None as "None"
                 # since there is no duration use a default of zero
                 errors_file.write("{0} 0\n".format(serial))
@@ -139,6 +143,37 @@ def plot_data(data, filename):
                   "a safety point to {0}".format(errors_data_file))
             errors_file.write("0 0")
 
+    for f in grouped_files.values():
+        f.close()
+
+    # with nothing but errors there are no per-nameserver files, and the plot
+    # needs at least one series before the errors
+    if group_by == 'nameserver' and grouped_files:
+        series = [
+            '"{0}" title "{1} {2}" with points pointtype {3}, \\'.format(
+                # older data doesn't record the nameserver
+                f.name, nameserver or "unknown nameserver",
+                "creates/updates" if operation == "update" else "deletes",
+                5 if operation == "update" else 7)
+            for (operation, nameserver), f in sorted(
+                grouped_files.items(), key=lambda item: (item[0][1], item[0][0]))]
+    else:
+        series = [
+            '"{0}" title "Creates/Updates" with points pointtype 5 linecolor rgb "blue", \\'
+            .format(updates_data_file),
+            '"{0}" title "Deletes" with points pointtype 5 linecolor rgb "red", \\'
+            .format(removes_data_file),
+        ]
+    gnuplot_script = gnuplot_script.format(
+        updates_file=updates_data_file,
+        removes_file=removes_data_file,
+        errors_file=errors_data_file,
+        output_file=filename,
+        series="\n    ".join(series))
+
+    with open(gnuplot_file, 'w') as f:
+        f.write(gnuplot_script)
+
     # invoke gnuplot to generate the plot
     retcode = gevent.subprocess.call(['gnuplot', gnuplot_file])
     if retcode == 0:
@@ -149,12 +184,12 @@ def plot_data(data, filename):
 
 def _handle_stats_request(stats_req):
     filename = construct_filename(stats_req.start_time, stats_req.end_time)
-    data = storage.select_time_range(stats_req.start_time, stats_req.end_time)
+    data = storage.iter_time_range(stats_req.start_time, stats_req.end_time)
     try:
-        plot_data(data, filename)
-        stats_req.image_id = str(uuid.uuid4())
-        # storage.create_image_filename(stats_req.image_id, filename)
-        storage.create_image_bytes(stats_req.image_id, open(filename, 'rb').read())
+        plot_data(data, filename, stats_req.group_by)
+        digest, size = images.store(filename)
+        storage.create_image(digest, size)
+        stats_req.image_id = digest
         stats_req.status = Status.COMPLETED
     except GnuplotException as e:
         print traceback.format_exc()
@@ -1,26 +1,170 @@
+import base64
+import bisect
+import heapq
+import itertools
+import struct
+import time
+import urllib
+import zlib
+
 import redis
 
 from digaas.config import CONFIG
+from digaas import images
 from digaas import model
-from digaas.consts import Condition
-
-print "USING REDIS STORAGE"
+from digaas import storage_memory
+from digaas import storage_redis
+from digaas import storage_sqlite
+from digaas import writebehind
+from digaas.consts import Condition, Status
 
 SERIAL_NOT_LOWER_SET_NAME = 'SerialNotLower_sorted_set'
 ZONE_REMOVED_SET_NAME = 'ZoneRemoved_sorted_set'
+PROPAGATION_TIMES_KEY = 'PropagationTimes:{0}:{1}'
+POLL_QUEUE_NAME = 'PollQueue'
+POLL_LEASES_SET_NAME = 'PollLeases_sorted_set'
+FINISHED_CHANNEL_NAME = 'FinishedPollRequests'
+
+# the sorted sets of datapoints, scored by start_time. The stats read them
+# merged, and the compactor trims them (see digaas.retention).
+TIME_RANGE_SET_NAMES = (SERIAL_NOT_LOWER_SET_NAME, ZONE_REMOVED_SET_NAME)
+
+# Poll request ids are indexed in sorted sets scored by start_time: one for
+# every request, and one per value of each of the POLL_INDEX_FIELDS (like
+# "PollRequestIndex:status:ERROR"). The names of the per-value indexes are kept
+# in POLL_INDEXES_SET_NAME, scored by the latest start_time added, so the
+# compactor can find them to trim.
+POLL_INDEX_ALL_SET_NAME = 'PollRequestIndex:all'
+POLL_INDEX_KEY = 'PollRequestIndex:{0}:{1}'
+POLL_INDEXES_SET_NAME = 'PollRequestIndexes_sorted_set'
+# the most selective first. Conditions are indexed by their kind (see
+# Condition.kind). Query names are hashed, in lower case without the trailing
+# dot, into one of POLL_QUERY_NAME_BUCKETS indexes, so a soak test's worth of
+# zones doesn't make a key each.
+POLL_INDEX_FIELDS = ('query_name', 'nameserver', 'condition', 'status')
+POLL_QUERY_NAME_BUCKETS = 1024
+
+# pop up to ARGV[2] items off the queue, leasing each of them until ARGV[1]
+CLAIM_SCRIPT = """
+local items = {}
+for i = 1, tonumber(ARGV[2]) do
+    local item = redis.call('LPOP', KEYS[1])
+    if not item then break end
+    redis.call('ZADD', KEYS[2], ARGV[1], item)
+    items[#items + 1] = item
+end
+return items
+"""
+
+# extend the leases on items ARGV[2..] until ARGV[1], unless they were
+# reclaimed already, and return the items that were
+RENEW_SCRIPT = """
+local lost = {}
+for i = 2, #ARGV do
+    if redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+        redis.call('ZADD', KEYS[1], ARGV[1], ARGV[i])
+    else
+        lost[#lost + 1] = ARGV[i]
+    end
+end
+return lost
+"""
+# the number of leases to renew per round trip
+RENEW_CHUNK_SIZE = 1000
+
+# put up to ARGV[2] items whose lease expired before ARGV[1] back on the queue
+RECLAIM_SCRIPT = """
+local items = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, item in ipairs(items) do
+    redis.call('ZREM', KEYS[2], item)
+    redis.call('RPUSH', KEYS[1], item)
+end
+return #items
+"""
+
+# the number of keys to fetch per MGET
+MGET_CHUNK_SIZE = 1000
+# the number of datapoints to fetch per ZRANGEBYSCORE
+TIME_RANGE_PAGE_SIZE = 5000
+
+# Poll requests and their time range items are stored in a compact binary
+# encoding, which starts with this version byte. Values written before were
+# space separated text, which never starts with it, and are still read.
+BINARY_V1 = '\x01'
+
+# version, status, flags, serial, start_time, duration, timeout, frequency,
+# query_budget, quorum, first_duration, quorum_duration. A missing float is
+# NaN, and a missing query_budget or quorum is 0. Then come the strings (see
+# _pack_str), the nameservers and the results.
+_POLL_FIELDS = struct.Struct('!BBBqddidIHdd')
+# version, operation, start_time, duration. Then the nameserver.
+_TIME_RANGE_FIELDS = struct.Struct('!BBdd')
+_LENGTH = struct.Struct('!H')
+# the length of a missing string or list. Longer ones are refused by
+# model.PollRequest.validate, which allows up to model.MAX_FIELD_LENGTH.
+_NONE_LENGTH = 0xffff
+_ADAPTIVE_FLAG = 0x1
+_STATUSES = (None, Status.ACCEPTED, Status.COMPLETED, Status.ERROR, Status.INTERNAL_ERROR)
+_STATUS_CODES = dict((status, code) for code, status in enumerate(_STATUSES))
+_OPERATIONS = ("update", "remove")
+_OPERATION_CODES = dict((op, code) for code, op in enumerate(_OPERATIONS))
+_NAN = float('nan')
 
 REDIS_CLIENT = None
 def get_redis_client():
+    """Return the redis client. The work queue and the finished request
+    channel are always in redis, whatever the storage backend."""
     global REDIS_CLIENT
     if REDIS_CLIENT is None:
-        REDIS_CLIENT = redis.StrictRedis(
+        # a bounded pool, so thousands of greenlets don't each open a
+        # connection. redis-py parses replies with hiredis if it's installed.
+        pool = redis.BlockingConnectionPool(
             host=CONFIG.redis_host,
             port=CONFIG.redis_port,
             password=CONFIG.redis_password,
+            max_connections=CONFIG.redis_max_connections,
         )
+        REDIS_CLIENT = redis.StrictRedis(connection_pool=pool)
         REDIS_CLIENT.ping()  # fail fast; raises an exception if bad connection
+        print "USING REDIS PARSER {0}".format(redis.connection.DefaultParser.__name__)
     return REDIS_CLIENT
 
+BACKEND = None
+def get_backend():
+    """Return the storage backend chosen by "storage_backend" in the config"""
+    global BACKEND
+    if BACKEND is None:
+        if CONFIG.storage_backend == 'memory':
+            BACKEND = storage_memory.MemoryBackend()
+        elif CONFIG.storage_backend == 'sqlite':
+            BACKEND = storage_sqlite.SqliteBackend(CONFIG.sqlite_path)
+        else:
+            BACKEND = storage_redis.RedisBackend(get_redis_client())
+        print "USING {0} STORAGE".format(BACKEND.name.upper())
+    return BACKEND
+
+WRITER = None
+def get_writer():
+    global WRITER
+    if WRITER is None:
+        WRITER = writebehind.WriteBehind(
+            get_backend, CONFIG.redis_write_batch, CONFIG.redis_write_interval)
+    return WRITER
+
+def get_finished_ttl():
+    """The seconds to keep a finished request, or None to keep it forever"""
+    return CONFIG.retention_seconds or None
+
+def _accepted_ttl(poll_req):
+    # long enough to finish, in case it's lost before it does
+    if CONFIG.retention_seconds:
+        return CONFIG.retention_seconds + poll_req.timeout
+    return None
+
+def get_write_report():
+    """Return the latest batch size and flush latency report, or None"""
+    return get_writer().report
+
 def fmt_value(*data):
     """Format the given data as a string to store in redis.
 
@@ -45,25 +189,143 @@ def cvt(thing, type=None):
     return thing
 
 def fmt_poll_request_value(poll_req):
-    return fmt_value(
-        poll_req.status,
-        poll_req.query_name,
-        poll_req.rdatatype,
+    """Encode the poll request to store in redis"""
+    parts = [_POLL_FIELDS.pack(
+        ord(BINARY_V1),
+        _STATUS_CODES[poll_req.status],
+        _ADAPTIVE_FLAG if poll_req.adaptive else 0,
         poll_req.serial,
-        poll_req.nameserver,
-        poll_req.start_time,
-        poll_req.duration,
-        poll_req.condition,
+        _float_or_nan(poll_req.start_time),
+        _float_or_nan(poll_req.duration),
         poll_req.timeout,
-        poll_req.frequency)
+        poll_req.frequency,
+        poll_req.query_budget or 0,
+        poll_req.quorum or 0,
+        _float_or_nan(poll_req.first_duration),
+        _float_or_nan(poll_req.quorum_duration))]
+    for s in (poll_req.query_name, poll_req.rdatatype, poll_req.nameserver,
+              poll_req.condition, poll_req.transport, poll_req.zone):
+        _pack_str(parts, s)
+
+    if poll_req.nameservers is None:
+        parts.append(_LENGTH.pack(_NONE_LENGTH))
+    else:
+        _pack_length(parts, len(poll_req.nameservers))
+        for nameserver in poll_req.nameservers:
+            _pack_str(parts, nameserver)
+
+    if poll_req.results is None:
+        parts.append(_LENGTH.pack(_NONE_LENGTH))
+    else:
+        _pack_length(parts, len(poll_req.results))
+        for nameserver, duration in sorted(poll_req.results.items()):
+            _pack_str(parts, nameserver)
+            parts.append(struct.pack('!d', _float_or_nan(duration)))
+    return ''.join(parts)
+
+def _parse_poll_request_binary(val):
+    (_, status, flags, serial, start_time, duration, timeout, frequency,
+     query_budget, quorum, first_duration, quorum_duration) = \
+        _POLL_FIELDS.unpack_from(val)
+    offset = _POLL_FIELDS.size
+    strings = []
+    for _ in xrange(6):
+        s, offset = _unpack_str(val, offset)
+        strings.append(s)
+    query_name, rdatatype, nameserver, condition, transport, zone = strings
+
+    count = _LENGTH.unpack_from(val, offset)[0]
+    offset += _LENGTH.size
+    nameservers = None
+    if count != _NONE_LENGTH:
+        nameservers = []
+        for _ in xrange(count):
+            s, offset = _unpack_str(val, offset)
+            nameservers.append(s)
+
+    count = _LENGTH.unpack_from(val, offset)[0]
+    offset += _LENGTH.size
+    results = None
+    if count != _NONE_LENGTH:
+        results = {}
+        for _ in xrange(count):
+            s, offset = _unpack_str(val, offset)
+            results[s] = _nan_to_none(struct.unpack_from('!d', val, offset)[0])
+            offset += 8
+
+    return {
+        "status":     _STATUSES[status],
+        "query_name": query_name,
+        "rdatatype":  rdatatype,
+        "serial":     serial,
+        "nameserver": nameserver,
+        "start_time": _nan_to_none(start_time),
+        "duration":   _nan_to_none(duration),
+        "condition":  condition,
+        "timeout":    timeout,
+        "frequency":  frequency,
+        "adaptive":   bool(flags & _ADAPTIVE_FLAG),
+        "query_budget": query_budget or None,
+        "transport":  transport,
+        "nameservers": nameservers,
+        "quorum":     quorum or None,
+        "results":    results,
+        "first_duration": _nan_to_none(first_duration),
+        "quorum_duration": _nan_to_none(quorum_duration),
+        "zone":       zone,
+    }
+
+def _pack_str(parts, s):
+    """Append a length prefixed string to parts"""
+    if s is None:
+        parts.append(_LENGTH.pack(_NONE_LENGTH))
+        return
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    _pack_length(parts, len(s))
+    parts.append(s)
+
+def _pack_length(parts, length):
+    if length > model.MAX_FIELD_LENGTH:
+        raise ValueError("Can't store a string or list of length {0}".format(length))
+    parts.append(_LENGTH.pack(length))
+
+def _unpack_str(val, offset):
+    """Return the string at offset, and the offset just past it"""
+    length = _LENGTH.unpack_from(val, offset)[0]
+    offset += _LENGTH.size
+    if length == _NONE_LENGTH:
+        return None, offset
+    return val[offset:offset + length], offset + length
+
+def _float_or_nan(x):
+    return _NAN if x is None else x
+
+def _nan_to_none(x):
+    return None if x != x else x
+
+def parse_results(val):
+    """Parse the "<ns>=<duration>,..." results of a text value"""
+    if val is None:
+        return None
+    results = {}
+    for item in val.split(",") if val else ():
+        nameserver, duration = item.split("=")
+        results[nameserver] = cvt(duration, type=float)
+    return results
 
 def parse_poll_request_value(val):
     """This undoes fmt_poll_request_value.
 
-    :param val: A string, as returned by fmt_poll_request_value()
+    :param val: A string, as returned by fmt_poll_request_value(), or the
+        space separated text that was stored before
     :returns: A dictionary parsed from the given val
     """
+    if val[:1] == BINARY_V1:
+        return _parse_poll_request_binary(val)
     parts = val.split(' ')
+    # values written before a field was added are missing the trailing parts
+    parts += ["None"] * (19 - len(parts))
     return {
         "status":     cvt(parts[0]),
         "query_name": cvt(parts[1]),
@@ -72,9 +334,18 @@ def parse_poll_request_value(val):
         "nameserver": cvt(parts[4]),
         "start_time": cvt(parts[5], type=float),
         "duration":   cvt(parts[6], type=float),
-        "condition":  cvt(parts[7]),
+        "condition":  cvt(parts[7], type=urllib.unquote),
         "timeout":    cvt(parts[8], type=int),
         "frequency":  cvt(parts[9], type=float),
+        "adaptive":   cvt(parts[10]) == "True",
+        "query_budget": cvt(parts[11], type=int),
+        "transport":  cvt(parts[12]),
+        "nameservers": cvt(parts[13], type=lambda x: x.split(",")),
+        "quorum":     cvt(parts[14], type=int),
+        "results":    parse_results(cvt(parts[15])),
+        "first_duration": cvt(parts[16], type=float),
+        "quorum_duration": cvt(parts[17], type=float),
+        "zone":       cvt(parts[18]),
     }
 
 def fmt_stats_request_value(stats_req):
@@ -83,20 +354,76 @@ def fmt_stats_request_value(stats_req):
         stats_req.start_time,
         stats_req.end_time,
         stats_req.image_id,
+        stats_req.group_by,
     )
 
 def parse_stats_request_value(val):
     parts = val.split(' ')
+    parts += ["None"] * (5 - len(parts))
     return {
         "status":     cvt(parts[0]),
         "start_time": cvt(parts[1], type=float),
         "end_time":   cvt(parts[2], type=float),
         "image_id":   cvt(parts[3]),
+        "group_by":   cvt(parts[4]),
     }
 
 def create_poll_request(poll_req):
-    r = get_redis_client()
-    return r.set(poll_req.id, fmt_poll_request_value(poll_req))
+    create_poll_requests([poll_req])
+
+def create_poll_requests(poll_reqs):
+    """Store the poll requests, and wait until they're in redis. Requests
+    created at about the same time share one round trip."""
+    writes = [('set', (poll_req.id, fmt_poll_request_value(poll_req),
+                       _accepted_ttl(poll_req)))
+              for poll_req in poll_reqs]
+    writes.extend(_index_writes(poll_reqs, POLL_INDEX_FIELDS, everything=True))
+    get_writer().submit(writes).get()
+
+def get_poll_index_name(field, value):
+    """Return the name of the index of poll requests with the value of the
+    field, one of the POLL_INDEX_FIELDS"""
+    if field == 'query_name':
+        value = value.lower().rstrip('.')
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        value = (zlib.crc32(value) & 0xffffffff) % POLL_QUERY_NAME_BUCKETS
+    elif field == 'condition':
+        value = Condition.kind(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return POLL_INDEX_KEY.format(field, value)
+
+def _index_writes(poll_reqs, fields, everything=False):
+    """Return the writes that add the poll requests to their indexes on the
+    fields, and to the index of every request if everything is True"""
+    writes = []
+    latest = {}
+    for poll_req in poll_reqs:
+        if everything:
+            writes.append(('zadd', (POLL_INDEX_ALL_SET_NAME, poll_req.start_time, poll_req.id)))
+        for field in fields:
+            if field == 'nameserver':
+                values = poll_req.get_nameservers()
+            else:
+                values = [getattr(poll_req, field)]
+            for value in values:
+                name = get_poll_index_name(field, value)
+                writes.append(('zadd', (name, poll_req.start_time, poll_req.id)))
+                latest[name] = max(latest.get(name, poll_req.start_time), poll_req.start_time)
+    for name, start_time in latest.items():
+        writes.append(('zadd', (POLL_INDEXES_SET_NAME, start_time, name)))
+    if everything and poll_reqs:
+        writes.append(('zadd', (POLL_INDEXES_SET_NAME,
+                                max(poll_req.start_time for poll_req in poll_reqs),
+                                POLL_INDEX_ALL_SET_NAME)))
+    return writes
+
+def iter_poll_index_names():
+    """Yield the names of the poll request indexes, read a page at a time"""
+    for _, _, name in _iter_time_range_set(
+            0, POLL_INDEXES_SET_NAME, (float('-inf'), 0), float('inf')):
+        yield name
 
 def update_poll_request(poll_req):
     # add the start_time + duration to a sorted set for fast querying to generate
@@ -105,53 +432,435 @@ def update_poll_request(poll_req):
     #
     # This uses one sorted set for zone creates/updates and another for zone
     # deletes. The sets are sorted by the start_time passed to digaas by the
-    # user.
-    r = get_redis_client()
-    if poll_req.condition == Condition.SERIAL_NOT_LOWER \
-            or poll_req.condition.startswith(Condition.DATA_EQUALS):
-        r.zadd(SERIAL_NOT_LOWER_SET_NAME, poll_req.start_time,
-            "update {0} {1}".format(poll_req.start_time, poll_req.duration))
-    elif poll_req.condition == Condition.ZONE_REMOVED:
-        r.zadd(ZONE_REMOVED_SET_NAME, poll_req.start_time,
-            "remove {0} {1}".format(poll_req.start_time, poll_req.duration))
-    return create_poll_request(poll_req)
+    # user. A request with several nameservers adds one member per nameserver.
+    #
+    # The writes go out with the next batch, without waiting for it.
+    writes = []
+    if Condition.is_removal(poll_req.condition):
+        set_name, operation = ZONE_REMOVED_SET_NAME, "remove"
+    elif Condition.validate_condition(poll_req.condition):
+        set_name, operation = SERIAL_NOT_LOWER_SET_NAME, "update"
+    else:
+        set_name = None
+    if set_name is not None:
+        for nameserver, duration in poll_req.get_durations():
+            writes.append(('zadd', (set_name, poll_req.start_time, fmt_time_range_item(
+                operation, poll_req.start_time, duration, nameserver))))
+    writes.append(('set', (poll_req.id, fmt_poll_request_value(poll_req),
+                           get_finished_ttl())))
+    # it's no longer ACCEPTED
+    writes.append(('zrem', (get_poll_index_name('status', Status.ACCEPTED), poll_req.id)))
+    writes.extend(_index_writes([poll_req], ('status',)))
+    return get_writer().submit(writes)
 
 def get_poll_request(id):
-    r = get_redis_client()
-    val = r.get(id)
+    # a write that hasn't been flushed yet is the latest value
+    val = get_writer().pending.get(id)
+    if val is None:
+        val = get_backend().get(id)
     if val is not None:
         return model.PollRequest(id=id, **parse_poll_request_value(val))
 
-def create_image_bytes(id, data):
+def enqueue_poll_requests(poll_reqs, accepted_at):
+    """Store the poll requests and add them to the shared work queue, and
+    wait until they're in redis. Each request is stored before it's queued."""
+    writes = [('set', (poll_req.id, fmt_poll_request_value(poll_req),
+                       _accepted_ttl(poll_req)))
+              for poll_req in poll_reqs]
+    writes.extend(_index_writes(poll_reqs, POLL_INDEX_FIELDS, everything=True))
+    writes.append(('rpush', (POLL_QUEUE_NAME,) + tuple(
+        fmt_value(poll_req.id, accepted_at) for poll_req in poll_reqs)))
+    get_writer().submit(writes).get()
+
+def parse_queue_item(item):
+    """Return the (id, accepted_at) in a work queue item"""
+    id, accepted_at = item.split(' ')
+    return id, float(accepted_at)
+
+def claim_poll_requests(count, lease_expiry):
+    """Take up to count items off the work queue, leased until lease_expiry"""
     r = get_redis_client()
-    return r.set(id, data)
+    claim = r.register_script(CLAIM_SCRIPT)
+    return claim(keys=[POLL_QUEUE_NAME, POLL_LEASES_SET_NAME],
+                 args=[fmt_value(lease_expiry), count])
 
-def get_image_bytes(id):
+def renew_leases(items, lease_expiry):
+    """Extend the leases on the items until lease_expiry. A lease that expired
+    and was reclaimed by another node isn't renewed.
+
+    :returns: the items whose leases were lost
+    """
+    r = get_redis_client()
+    renew = r.register_script(RENEW_SCRIPT)
+    lost = []
+    for i in xrange(0, len(items), RENEW_CHUNK_SIZE):
+        lost.extend(renew(keys=[POLL_LEASES_SET_NAME],
+                          args=[fmt_value(lease_expiry)] + items[i:i + RENEW_CHUNK_SIZE]))
+    return lost
+
+def release_lease(item):
+    """Release the lease with the next batch of writes, so after the finished
+    request is stored"""
+    return get_writer().submit([('zrem', (POLL_LEASES_SET_NAME, item))])
+
+def reclaim_expired_leases(now, count):
+    """Requeue up to count items whose lease expired before now. Returns the
+    number of items requeued."""
     r = get_redis_client()
-    val = r.get(id)
-    return cvt(val)
-
-def select_time_range(lo, hi):
-    """Select a bunch of strings which are specifically ordered by start_time.
-    These strings are of the format "<operation> <serial> <duration>" where
-        operation is either 'update' or 'remove'
-        serial is the serial of the zone
-        duration is the recorded propagation time
+    reclaim = r.register_script(RECLAIM_SCRIPT)
+    return reclaim(keys=[POLL_QUEUE_NAME, POLL_LEASES_SET_NAME],
+                   args=[fmt_value(now), count])
+
+def get_poll_requests(ids):
+    """Look up many poll requests, with one MGET per chunk of ids.
+
+    :returns: a generator of (id, PollRequest) tuples, in the order of ids. The
+        PollRequest is None if the id wasn't found, or its value isn't a poll
+        request (like a stats request's).
+    """
+    backend = get_backend()
+    pending = get_writer().pending
+    for i in xrange(0, len(ids), MGET_CHUNK_SIZE):
+        chunk = ids[i:i + MGET_CHUNK_SIZE]
+        for id, val in zip(chunk, backend.mget(chunk)):
+            val = pending.get(id, val)
+            if val is None:
+                yield id, None
+                continue
+            try:
+                poll_req = model.PollRequest(id=id, **parse_poll_request_value(val))
+            except (ValueError, TypeError, IndexError, struct.error) as e:
+                print "storage: {0} is not a poll request: {1!r}".format(id, e)
+                poll_req = None
+            yield id, poll_req
+
+def find_poll_requests(since, until, nameserver=None, statuses=None, condition=None,
+                       query_name=None, cursor=None):
+    """Yield the PollRequests that started between since and until and match
+    every filter given, in start_time order.
+
+    The ids are read from the index of each filter given (several statuses
+    being the union of their indexes) and intersected, a page at a time, and
+    the requests are fetched with one MGET per chunk and checked against the
+    filters.
+
+    :param statuses: a list of statuses to match any of
+    :param condition: match conditions starting with this, so that "data="
+        matches every data= condition
+    :param cursor: a FindCursor from find_poll_requests_cursor() to resume
+        from. It's advanced past each request before it's yielded.
     """
+    if cursor is None:
+        cursor = find_poll_requests_cursor(since)
+    if query_name is not None:
+        query_name = query_name.lower().rstrip('.')
+
+    streams = [[_IndexReader(set_name, until) for set_name in set_names]
+               for set_names in _find_index_names(nameserver, statuses, condition, query_name)]
+    backend = get_backend()
+    pending = get_writer().pending
+    entries = _intersect_indexes(streams, cursor.key)
+    while True:
+        chunk = list(itertools.islice(entries, MGET_CHUNK_SIZE))
+        if not chunk:
+            return
+        vals = backend.mget([id for _, id in chunk])
+        for (start_time, id), val in zip(chunk, vals):
+            cursor.advance(start_time, id)
+            val = pending.get(id, val)
+            if val is None:
+                # it expired
+                continue
+            poll_req = model.PollRequest(id=id, **parse_poll_request_value(val))
+            if nameserver is not None and nameserver not in poll_req.get_nameservers():
+                continue
+            if statuses and poll_req.status not in statuses:
+                continue
+            if condition is not None and not poll_req.condition.startswith(condition):
+                continue
+            if query_name is not None \
+                    and poll_req.query_name.lower().rstrip('.') != query_name:
+                continue
+            yield poll_req
+
+def find_poll_requests_cursor(since, text=None):
+    """Return a cursor for find_poll_requests() starting at since, or parsed
+    from the text of an earlier one. Raises ValueError for an invalid
+    cursor."""
+    if text is not None:
+        return FindCursor.parse(text)
+    return FindCursor((since, ''))
+
+def _find_index_names(nameserver, statuses, condition, query_name):
+    """Return the indexes to intersect to find the poll requests, as a list of
+    lists of index names whose union is read"""
+    names = []
+    if query_name is not None:
+        names.append([get_poll_index_name('query_name', query_name)])
+    if nameserver is not None:
+        names.append([get_poll_index_name('nameserver', nameserver)])
+    if condition is not None:
+        names.append([get_poll_index_name('condition', condition)])
+    if statuses:
+        names.append([get_poll_index_name('status', status) for status in statuses])
+    return names or [[POLL_INDEX_ALL_SET_NAME]]
+
+def _intersect_indexes(streams, key):
+    """Yield the (start_time, id) entries from key on that are in every
+    stream, in order. Each stream is a list of _IndexReaders, for the union of
+    their indexes. Streams skip ahead to the latest entry any of them is at,
+    so a small index keeps a big one from being read in full."""
+    while True:
+        for readers in streams:
+            heads = [head for head in (reader.seek(key) for reader in readers)
+                     if head is not None]
+            if not heads:
+                return
+            head = min(heads)
+            if head != key:
+                key = head
+                break
+        else:
+            yield key
+            key = _after(key)
+
+def _after(key):
+    """Return the smallest (start_time, id) after key"""
+    return (key[0], key[1] + '\0')
+
+class _IndexReader(object):
+    """Reads the (start_time, id) entries of one index up to hi, in order, a
+    page at a time, and skips ahead without reading what it skips"""
+
+    def __init__(self, set_name, hi):
+        self.set_name = set_name
+        self.hi = hi
+        self._page = []     # sorted (start_time, id)
+        self._i = 0         # the position in the page
+        self._lo = None     # the page's query
+        self._skip = 0
+        self._last = False  # whether there's nothing after the page
+
+    def seek(self, key):
+        """Move to the first entry at or after key, and return it, or None if
+        there isn't one"""
+        page = self._page
+        if page and page[-1] >= key:
+            self._i = bisect.bisect_left(page, key, self._i)
+            return page[self._i]
+        if self._last:
+            self._i = len(page)
+            return None
+        # Entries with the same start_time are in a fixed order, so skip the
+        # ones before key with its start_time that we've read.
+        lo = key[0]
+        skip = sum(1 for start_time, _ in page if start_time == lo)
+        if lo == self._lo:
+            skip += self._skip
+        backend = get_backend()
+        while True:
+            page = [(start_time, id) for id, start_time in
+                    backend.zrangebyscore(self.set_name, lo, self.hi, skip, TIME_RANGE_PAGE_SIZE)]
+            self._page, self._lo, self._skip = page, lo, skip
+            self._last = len(page) < TIME_RANGE_PAGE_SIZE
+            self._i = bisect.bisect_left(page, key)
+            if self._i < len(page):
+                return page[self._i]
+            if self._last:
+                return None
+            skip += len(page)
+
+class FindCursor(object):
+    """A position in the poll request indexes, as the (start_time, id) to
+    carry on from"""
+
+    def __init__(self, key):
+        self.key = key
+
+    @classmethod
+    def parse(cls, text):
+        """This undoes __str__. Raises ValueError for an invalid cursor"""
+        try:
+            start_time, id = base64.urlsafe_b64decode(text).split(':', 1)
+            return cls((float(start_time), id))
+        except (ValueError, TypeError):
+            raise ValueError("Invalid cursor '{0}'".format(text))
+
+    def advance(self, start_time, id):
+        self.key = _after((start_time, id))
+
+    def __str__(self):
+        # opaque, so it can go in a url as it is
+        return base64.urlsafe_b64encode("{0!r}:{1}".format(*self.key))
+
+def publish_finished_poll_request(poll_req):
+    """Publish with the next batch of writes, so after the request is stored"""
+    return get_writer().submit([('publish', (
+        FINISHED_CHANNEL_NAME, poll_req.id + ' ' + fmt_poll_request_value(poll_req)))])
+
+def subscribe_finished_poll_requests():
+    """Return a generator of the PollRequests published as they finish"""
     r = get_redis_client()
-    return r.zrangebyscore(SERIAL_NOT_LOWER_SET_NAME, lo, hi) \
-        + r.zrangebyscore(ZONE_REMOVED_SET_NAME, lo, hi)
+    pubsub = r.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(FINISHED_CHANNEL_NAME)
+    for message in pubsub.listen():
+        if message['type'] == 'message':
+            id, val = message['data'].split(' ', 1)
+            yield model.PollRequest(id=id, **parse_poll_request_value(val))
+
+def add_propagation_time(nameserver, condition, duration, max_count):
+    """Remember a propagation time, keeping only the latest max_count"""
+    key = PROPAGATION_TIMES_KEY.format(nameserver, condition)
+    return get_writer().submit([('lpush', (key, fmt_value(duration))),
+                                ('ltrim', (key, 0, max_count - 1))])
+
+def get_propagation_times(nameserver, condition):
+    key = PROPAGATION_TIMES_KEY.format(nameserver, condition)
+    return [float(x) for x in get_backend().lrange(key)]
+
+def create_image(digest, size):
+    """Record a plot stored in the image store, and evict the oldest ones if
+    that puts us over image_storage_max_bytes"""
+    get_backend().add_image(digest, size, time.time())
+    evict_images(0, 100)
+
+def evict_images(before, count):
+    """Delete up to count of the oldest images, while they were stored before
+    the time before, or we're over image_storage_max_bytes. Returns the number
+    deleted."""
+    evicted = get_backend().evict_images(CONFIG.image_storage_max_bytes, before, count)
+    for id in evicted:
+        # older images were stored in redis, under a uuid, and deleted above
+        if images.is_digest(id):
+            images.delete(id)
+    return len(evicted)
+
+def trim_time_range(set_name, before, count):
+    """Remove up to count datapoints for requests that started before the time
+    before from the sorted set. Returns the number removed."""
+    return get_backend().trim_time_range(set_name, before, count)
+
+def expire_values(now, count):
+    """Delete up to count requests whose ttl ran out before now, for the
+    backends that don't expire them by themselves. Returns the number deleted."""
+    return get_backend().expire(now, count)
+
+def get_image_bytes(id):
+    """Return an image stored in redis, before the image store"""
+    return cvt(get_backend().get(id))
+
+def iter_time_range(lo, hi, cursor=None):
+    """Yield the datapoints of the requests that started between lo and hi,
+    merged from the sorted sets in start_time order, a page at a time. Each is
+    an (operation, start_time, duration, nameserver) where operation is either
+    'update' or 'remove', and the duration (if the request timed out) or
+    nameserver (for older items) may be None. Use parse_time_range_item() to
+    split them up, and time_range_item_text() to write them out.
+
+    :param cursor: a TimeRangeCursor to resume from. It's advanced past each
+        item before the item is yielded.
+    :returns: a generator of the items, as stored
+    """
+    if cursor is None:
+        cursor = TimeRangeCursor.starting_at(lo)
+    for start_time, i, item in _merge_time_range_sets(TIME_RANGE_SET_NAMES, hi, cursor):
+        cursor.advance(i, start_time)
+        yield item
+
+def _merge_time_range_sets(set_names, hi, cursor):
+    """Yield (start_time, i, item) for the items in the sorted sets from the
+    cursor's positions up to hi, in start_time order, where i is the index of
+    the set the item is in. This doesn't advance the cursor."""
+    return heapq.merge(*[_iter_time_range_set(i, set_name, cursor.positions[i], hi)
+                         for i, set_name in enumerate(set_names)])
+
+def _iter_time_range_set(i, set_name, position, hi):
+    """Yield (start_time, i, item) for the items in one sorted set from the
+    position up to hi, a page at a time"""
+    backend = get_backend()
+    lo, skip = position
+    while True:
+        page = backend.zrangebyscore(set_name, lo, hi, skip, TIME_RANGE_PAGE_SIZE)
+        for item, start_time in page:
+            yield start_time, i, item
+        if len(page) < TIME_RANGE_PAGE_SIZE:
+            return
+        # carry on after the last item. Items with the same start_time are in
+        # a fixed order, so skip the ones with its start_time we've seen.
+        last = page[-1][1]
+        same = sum(1 for _, start_time in page if start_time == last)
+        skip = same + skip if last == lo else same
+        lo = last
+
+class TimeRangeCursor(object):
+    """A position in each of several sorted sets scored by start_time (by
+    default the TIME_RANGE_SET_NAMES), as the start_time of the last item read
+    and how many items with that start_time were read"""
+
+    def __init__(self, positions):
+        self.positions = positions
+
+    @classmethod
+    def starting_at(cls, lo, count=len(TIME_RANGE_SET_NAMES)):
+        return cls([(lo, 0)] * count)
+
+    @classmethod
+    def parse(cls, text, count=len(TIME_RANGE_SET_NAMES)):
+        """This undoes __str__. Raises ValueError for an invalid cursor"""
+        try:
+            positions = [(float(lo), int(skip)) for lo, skip in
+                         (part.split(':') for part in base64.urlsafe_b64decode(text).split(','))]
+        except (ValueError, TypeError):
+            raise ValueError("Invalid cursor '{0}'".format(text))
+        if len(positions) != count:
+            raise ValueError("Invalid cursor '{0}'".format(text))
+        return cls(positions)
+
+    def advance(self, i, start_time):
+        lo, skip = self.positions[i]
+        self.positions[i] = (lo, skip + 1) if start_time == lo else (start_time, 1)
+
+    def __str__(self):
+        # opaque, so it can go in a url as it is
+        return base64.urlsafe_b64encode(
+            ",".join("{0!r}:{1}".format(lo, skip) for lo, skip in self.positions))
+
+def fmt_time_range_item(operation, start_time, duration, nameserver):
+    """Encode a sorted set member for one nameserver's result"""
+    if isinstance(nameserver, unicode):
+        nameserver = nameserver.encode('utf-8')
+    return _TIME_RANGE_FIELDS.pack(ord(BINARY_V1), _OPERATION_CODES[operation],
+                                   start_time, _float_or_nan(duration)) + nameserver
+
+def parse_time_range_item(item):
+    """Return (operation, start_time, duration, nameserver) from a string
+    returned by iter_time_range(). The duration and nameserver may be None."""
+    if item[:1] == BINARY_V1:
+        _, operation, start_time, duration = _TIME_RANGE_FIELDS.unpack_from(item)
+        return (_OPERATIONS[operation], start_time, _nan_to_none(duration),
+                item[_TIME_RANGE_FIELDS.size:])
+    # the text items written before were "<operation> <start_time> <duration>
+    # <nameserver>", without the nameserver at first
+    parts = item.split()
+    parts += ["None"] * (4 - len(parts))
+    return (parts[0], float(parts[1]), cvt(parts[2], type=float), cvt(parts[3]))
+
+def time_range_item_text(item):
+    """Return the "<operation> <start_time> <duration> <nameserver>" text of an
+    item returned by iter_time_range()"""
+    if item[:1] != BINARY_V1:
+        return item
+    return fmt_value(*parse_time_range_item(item))
 
 def create_stats_request(stats_req):
-    r = get_redis_client()
-    return r.set(stats_req.id, fmt_stats_request_value(stats_req))
+    ttl = get_finished_ttl() if stats_req.status != Status.ACCEPTED else None
+    return get_backend().set(stats_req.id, fmt_stats_request_value(stats_req), ttl)
 
 def update_stats_request(stats_req):
     return create_stats_request(stats_req)
 
 def get_stats_request(id):
-    r = get_redis_client()
-    val = r.get(id)
+    val = get_backend().get(id)
     if val is not None:
         return model.StatsRequest(id=id, **parse_stats_request_value(val))
 
@@ -0,0 +1,149 @@
+"""
+Storage in this process's memory, for single-node runs without a redis
+server. Nothing survives a restart, and only this process sees the data, so
+it needs "poll_processes": 0, "poll_queue": "local" and a single uwsgi
+process.
+
+Every operation runs without yielding, so each is atomic among greenlets.
+"""
+import bisect
+import heapq
+import time
+
+
+class _SortedSet(object):
+    """Members in (score, member) order, like a redis sorted set"""
+
+    def __init__(self):
+        self.items = []     # sorted (score, member)
+        self.scores = {}    # member -> score
+
+    def add(self, score, member):
+        """Returns True if the member is new"""
+        old = self.scores.get(member)
+        if old == score:
+            return False
+        if old is not None:
+            del self.items[bisect.bisect_left(self.items, (old, member))]
+        self.scores[member] = score
+        bisect.insort(self.items, (score, member))
+        return old is None
+
+    def remove(self, member):
+        score = self.scores.pop(member)
+        del self.items[bisect.bisect_left(self.items, (score, member))]
+
+    def range_by_score(self, lo, hi, start, num):
+        i = bisect.bisect_left(self.items, (lo,)) + start
+        return [(member, score) for score, member in self.items[i:i + num] if score <= hi]
+
+    def remove_before(self, before, count):
+        n = min(bisect.bisect_left(self.items, (before,)), count)
+        for _, member in self.items[:n]:
+            del self.scores[member]
+        del self.items[:n]
+        return n
+
+
+class MemoryBackend(object):
+
+    name = 'memory'
+    # it never fails for want of storage
+    transient_errors = ()
+
+    def __init__(self):
+        self.values = {}
+        self.expiry = {}         # key -> expires at, for values with a ttl
+        self._expiry_heap = []   # (expires at, key), maybe out of date
+        self.sorted_sets = {}
+        self.lists = {}
+        self.images = _SortedSet()   # scored by time stored
+        self.image_sizes = {}
+        self.image_bytes = 0
+
+    def write(self, writes):
+        """Make the writes, in order.
+
+        :param writes: a list of (method name, args), like ('set', (key, value))
+        """
+        for name, args in writes:
+            getattr(self, name)(*args)
+
+    def set(self, key, value, ttl=None):
+        self.values[key] = value
+        if ttl:
+            expires_at = time.time() + ttl
+            self.expiry[key] = expires_at
+            heapq.heappush(self._expiry_heap, (expires_at, key))
+        else:
+            self.expiry.pop(key, None)
+
+    def zadd(self, set_name, score, member):
+        self.sorted_sets.setdefault(set_name, _SortedSet()).add(score, member)
+
+    def zrem(self, set_name, member):
+        sorted_set = self.sorted_sets.get(set_name)
+        if sorted_set is not None and member in sorted_set.scores:
+            sorted_set.remove(member)
+
+    def lpush(self, key, value):
+        self.lists.setdefault(key, []).insert(0, value)
+
+    def ltrim(self, key, start, stop):
+        if key in self.lists:
+            self.lists[key][:] = self.lists[key][start:stop + 1]
+
+    def get(self, key):
+        expires_at = self.expiry.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return self.values.get(key)
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def zrangebyscore(self, set_name, lo, hi, start, num):
+        """Return up to num (member, score) scored from lo to hi, skipping
+        the first start of them"""
+        sorted_set = self.sorted_sets.get(set_name)
+        if sorted_set is None:
+            return []
+        return sorted_set.range_by_score(lo, hi, start, num)
+
+    def lrange(self, key):
+        return list(self.lists.get(key, ()))
+
+    def trim_time_range(self, set_name, before, count):
+        sorted_set = self.sorted_sets.get(set_name)
+        if sorted_set is None:
+            return 0
+        return sorted_set.remove_before(before, count)
+
+    def add_image(self, id, size, stored_at):
+        if self.images.add(stored_at, id):
+            self.image_sizes[id] = size
+            self.image_bytes += size
+
+    def evict_images(self, max_bytes, before, count):
+        evicted = []
+        while len(evicted) < count and self.images.items:
+            stored_at, id = self.images.items[0]
+            if (max_bytes is None or self.image_bytes <= max_bytes) and stored_at >= before:
+                break
+            self.images.remove(id)
+            self.image_bytes -= self.image_sizes.pop(id, 0)
+            self.values.pop(id, None)
+            evicted.append(id)
+        return evicted
+
+    def expire(self, now, count):
+        """Delete up to count values whose ttl ran out before now"""
+        n = 0
+        while n < count and self._expiry_heap and self._expiry_heap[0][0] <= now:
+            expires_at, key = heapq.heappop(self._expiry_heap)
+            # unless it was set again since
+            if self.expiry.get(key) == expires_at:
+                del self.expiry[key]
+                del self.values[key]
+                n += 1
+        return n
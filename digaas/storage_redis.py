@@ -0,0 +1,111 @@
+"""
+Storage in redis. This is the default, and the only backend that several
+processes or nodes can share.
+"""
+import redis
+
+# remove up to ARGV[2] members scored before ARGV[1]. They're the lowest
+# ranked, so remove them by rank.
+TRIM_SCRIPT = """
+local n = math.min(redis.call('ZCOUNT', KEYS[1], '-inf', '(' .. ARGV[1]), tonumber(ARGV[2]))
+if n > 0 then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, n - 1)
+end
+return n
+"""
+
+# index image ARGV[1] of ARGV[2] bytes as stored at ARGV[3]. Storing the same
+# image again only updates the time.
+ADD_IMAGE_SCRIPT = """
+if redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1]) == 1 then
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+    redis.call('INCRBY', KEYS[3], ARGV[2])
+end
+"""
+
+# delete up to ARGV[3] of the oldest images, while they were stored before
+# ARGV[2] or there are more than ARGV[1] bytes of them (if ARGV[1] >= 0), and
+# return their ids
+EVICT_IMAGES_SCRIPT = """
+local max_bytes = tonumber(ARGV[1])
+local evicted = {}
+while #evicted < tonumber(ARGV[3]) do
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    if #oldest == 0 then break end
+    local total = tonumber(redis.call('GET', KEYS[3]) or '0')
+    if (max_bytes < 0 or total <= max_bytes) and tonumber(oldest[2]) >= tonumber(ARGV[2]) then
+        break
+    end
+    local size = tonumber(redis.call('HGET', KEYS[2], oldest[1]) or '0')
+    redis.call('DEL', oldest[1])
+    redis.call('ZREM', KEYS[1], oldest[1])
+    redis.call('HDEL', KEYS[2], oldest[1])
+    redis.call('DECRBY', KEYS[3], size)
+    table.insert(evicted, oldest[1])
+end
+return evicted
+"""
+
+IMAGES_SET_NAME = 'Images_sorted_set'
+IMAGE_SIZES_HASH_NAME = 'ImageSizes'
+IMAGE_BYTES_KEY = 'ImageBytes'
+
+
+class RedisBackend(object):
+
+    name = 'redis'
+    # errors that mean redis is unavailable, so a write can be retried
+    transient_errors = (redis.ConnectionError, redis.TimeoutError)
+
+    def __init__(self, client):
+        """
+        :param client: a redis.StrictRedis
+        """
+        self.client = client
+        self._trim = client.register_script(TRIM_SCRIPT)
+        self._add_image = client.register_script(ADD_IMAGE_SCRIPT)
+        self._evict_images = client.register_script(EVICT_IMAGES_SCRIPT)
+
+    def write(self, writes):
+        """Make the writes in one pipeline.
+
+        :param writes: a list of (redis method name, args)
+        """
+        pipe = self.client.pipeline(transaction=False)
+        for name, args in writes:
+            getattr(pipe, name)(*args)
+        pipe.execute()
+
+    def set(self, key, value, ttl=None):
+        self.client.set(key, value, ttl)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def mget(self, keys):
+        return self.client.mget(keys)
+
+    def zrangebyscore(self, set_name, lo, hi, start, num):
+        """Return up to num (member, score) scored from lo to hi, skipping
+        the first start of them"""
+        return self.client.zrangebyscore(set_name, lo, hi, start=start, num=num,
+                                         withscores=True)
+
+    def lrange(self, key):
+        return self.client.lrange(key, 0, -1)
+
+    def trim_time_range(self, set_name, before, count):
+        return self._trim(keys=[set_name], args=[repr(before), count])
+
+    def add_image(self, id, size, stored_at):
+        self._add_image(keys=[IMAGES_SET_NAME, IMAGE_SIZES_HASH_NAME, IMAGE_BYTES_KEY],
+                        args=[id, size, repr(stored_at)])
+
+    def evict_images(self, max_bytes, before, count):
+        return self._evict_images(
+            keys=[IMAGES_SET_NAME, IMAGE_SIZES_HASH_NAME, IMAGE_BYTES_KEY],
+            args=[max_bytes if max_bytes is not None else -1, repr(before), count])
+
+    def expire(self, now, count):
+        # redis expires values by itself
+        return 0
@@ -0,0 +1,174 @@
+"""
+Storage in an embedded SQLite database, for single-node runs without a redis
+server that keep their data across restarts. The database is in WAL mode, and
+each batch from the write-behind (see digaas.writebehind) is committed as one
+transaction, so a burst of finished requests costs one commit.
+
+Like the in-memory backend, it needs "poll_processes": 0, "poll_queue":
+"local" and a single uwsgi process.
+"""
+import os
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    expires_at REAL
+);
+CREATE INDEX IF NOT EXISTS kv_expires_at ON kv (expires_at) WHERE expires_at IS NOT NULL;
+CREATE TABLE IF NOT EXISTS sorted_sets (
+    set_name TEXT NOT NULL,
+    score REAL NOT NULL,
+    member BLOB NOT NULL,
+    PRIMARY KEY (set_name, member)
+);
+CREATE INDEX IF NOT EXISTS sorted_sets_score ON sorted_sets (set_name, score, member);
+CREATE TABLE IF NOT EXISTS lists (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS lists_key ON lists (key, seq);
+CREATE TABLE IF NOT EXISTS images (
+    id TEXT PRIMARY KEY,
+    stored_at REAL NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_stored_at ON images (stored_at);
+"""
+
+
+class DatabaseBusy(sqlite3.OperationalError):
+    """Another connection has the database locked, for now"""
+
+
+def _is_busy(error):
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+
+class SqliteBackend(object):
+
+    name = 'sqlite'
+    # other OperationalErrors, like "disk I/O error" or "no such table", won't
+    # go away by retrying
+    transient_errors = (DatabaseBusy,)
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        self.conn = sqlite3.connect(path)
+        # keys come back as str, not unicode
+        self.conn.text_factory = str
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # WAL is safe from corruption at NORMAL, and only fsyncs at checkpoints
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def write(self, writes):
+        """Make the writes in one transaction.
+
+        :param writes: a list of (method name, args), like ('set', (key, value))
+        """
+        try:
+            with self.conn:
+                for name, args in writes:
+                    getattr(self, '_' + name)(*args)
+        except sqlite3.OperationalError as e:
+            if _is_busy(e):
+                raise DatabaseBusy(*e.args)
+            raise
+
+    def set(self, key, value, ttl=None):
+        self.write([('set', (key, value, ttl))])
+
+    def _set(self, key, value, ttl=None):
+        expires_at = time.time() + ttl if ttl else None
+        self.conn.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                          (key, buffer(value), expires_at))
+
+    def _zadd(self, set_name, score, member):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO sorted_sets (set_name, score, member) VALUES (?, ?, ?)",
+            (set_name, score, buffer(member)))
+
+    def _zrem(self, set_name, member):
+        self.conn.execute("DELETE FROM sorted_sets WHERE set_name = ? AND member = ?",
+                          (set_name, buffer(member)))
+
+    def _lpush(self, key, value):
+        self.conn.execute("INSERT INTO lists (key, value) VALUES (?, ?)",
+                          (key, buffer(str(value))))
+
+    def _ltrim(self, key, start, stop):
+        # the newest item is first, as if it were pushed on the left
+        self.conn.execute(
+            "DELETE FROM lists WHERE key = ? AND seq NOT IN "
+            "(SELECT seq FROM lists WHERE key = ? ORDER BY seq DESC LIMIT ? OFFSET ?)",
+            (key, key, stop - start + 1, start))
+
+    def get(self, key):
+        row = self.conn.execute(
+            "SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)",
+            (key, time.time())).fetchone()
+        return str(row[0]) if row is not None else None
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def zrangebyscore(self, set_name, lo, hi, start, num):
+        """Return up to num (member, score) scored from lo to hi, skipping
+        the first start of them"""
+        rows = self.conn.execute(
+            "SELECT member, score FROM sorted_sets WHERE set_name = ? AND score >= ? "
+            "AND score <= ? ORDER BY score, member LIMIT ? OFFSET ?",
+            (set_name, lo, hi, num, start))
+        return [(str(member), score) for member, score in rows]
+
+    def lrange(self, key):
+        rows = self.conn.execute("SELECT value FROM lists WHERE key = ? ORDER BY seq DESC",
+                                 (key,))
+        return [str(value) for value, in rows]
+
+    def trim_time_range(self, set_name, before, count):
+        with self.conn:
+            return self.conn.execute(
+                "DELETE FROM sorted_sets WHERE set_name = ? AND member IN "
+                "(SELECT member FROM sorted_sets WHERE set_name = ? AND score < ? "
+                "ORDER BY score, member LIMIT ?)",
+                (set_name, set_name, before, count)).rowcount
+
+    def add_image(self, id, size, stored_at):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO images (id, stored_at, size) VALUES (?, ?, ?)",
+                (id, stored_at, size))
+            self.conn.execute("UPDATE images SET stored_at = ? WHERE id = ?", (stored_at, id))
+
+    def evict_images(self, max_bytes, before, count):
+        evicted = []
+        with self.conn:
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM images").fetchone()[0]
+            rows = self.conn.execute(
+                "SELECT id, stored_at, size FROM images ORDER BY stored_at, id").fetchall()
+            for id, stored_at, size in rows:
+                if len(evicted) >= count:
+                    break
+                if (max_bytes is None or total <= max_bytes) and stored_at >= before:
+                    break
+                evicted.append(id)
+                total -= size
+            self.conn.executemany("DELETE FROM images WHERE id = ?",
+                                  [(id,) for id in evicted])
+            self.conn.executemany("DELETE FROM kv WHERE key = ?", [(id,) for id in evicted])
+        return evicted
+
+    def expire(self, now, count):
+        """Delete up to count values whose ttl ran out before now"""
+        with self.conn:
+            return self.conn.execute(
+                "DELETE FROM kv WHERE key IN (SELECT key FROM kv WHERE expires_at <= ? "
+                "LIMIT ?)", (now, count)).rowcount
@@ -0,0 +1,153 @@
+"""
+Persistent, pipelined dns-over-tcp connections (RFC 7766).
+
+Some nameservers drop or rate limit UDP under load, so probes to them can be
+sent over TCP instead. Each nameserver gets a small pool of connections, and
+each connection carries many outstanding queries at once: queries are written
+as soon as they're made, and one reader greenlet per connection matches the
+responses, which may come back in any order, by (message id, question name,
+question type). A connection that the server closes, or that fails, is
+reopened for the next query. Timeouts use the shared timer heap in udpmux.
+"""
+import itertools
+import socket
+import struct
+
+import gevent
+import gevent.event
+import gevent.lock
+import dns.exception
+from monotonic import monotonic
+
+from digaas.config import CONFIG as config
+from digaas import udpmux
+
+# how many connections to try a query on, when they're closed under it
+MAX_ATTEMPTS = 2
+
+
+class _ConnectionClosed(dns.exception.Timeout):
+    pass
+
+
+class TcpConnection(object):
+    """One persistent tcp connection to a nameserver, opened on demand"""
+
+    def __init__(self, nameserver, port, timers):
+        self.address = (nameserver, port)
+        self.timers = timers
+        self.sock = None
+        self.pending = {}  # (id, qname, qtype) -> AsyncResult
+        self.ids = set()
+        self._lock = gevent.lock.Semaphore()
+
+    def query(self, wire, timeout):
+        """Send the query, replacing its message id, and return the wire format
+        of the response. Raises dns.exception.Timeout, including when the
+        connection can't be made or is lost before the response arrives."""
+        deadline = monotonic() + timeout
+        qid = udpmux.allocate_id(self.ids)
+        wire = struct.pack('!H', qid) + wire[2:]
+        key = (qid,) + udpmux.question_key(wire)
+        message = struct.pack('!H', len(wire)) + wire
+        try:
+            self.timers.add(deadline, self, key)
+            for attempt in xrange(MAX_ATTEMPTS):
+                result = self.pending[key] = gevent.event.AsyncResult()
+                # the lock keeps concurrent queries from interleaving their writes
+                with self._lock:
+                    sock = self._connect(deadline)
+                    try:
+                        sock.sendall(message)
+                    except socket.error:
+                        # this fails the query, along with the rest on the connection
+                        self._close(sock)
+                try:
+                    return result.get()
+                except _ConnectionClosed as e:
+                    # the server may close a connection with queries still
+                    # outstanding, so send them again on a new one
+                    if monotonic() >= deadline:
+                        break
+            raise dns.exception.Timeout(str(e))
+        except socket.error as e:
+            raise dns.exception.Timeout("tcp connection to {0} failed: {1}"
+                                        .format(self.address[0], e))
+        finally:
+            self.pending.pop(key, None)
+            self.ids.discard(qid)
+
+    def fail(self, key, exception):
+        result = self.pending.pop(key, None)
+        if result is not None:
+            result.set_exception(exception)
+
+    def _connect(self, deadline):
+        if self.sock is None:
+            sock = socket.create_connection(
+                self.address, timeout=max(0.0, deadline - monotonic()))
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.sock = sock
+            gevent.spawn(self._read_forever, sock)
+        return self.sock
+
+    def _close(self, sock):
+        """Close the connection, and fail the queries that were waiting on it"""
+        if sock is None or sock is not self.sock:
+            return
+        self.sock = None
+        try:
+            sock.close()
+        except socket.error:
+            pass
+        for key in list(self.pending):
+            self.fail(key, _ConnectionClosed("tcp connection to {0} was closed"
+                                             .format(self.address[0])))
+
+    def _read_forever(self, sock):
+        try:
+            while True:
+                length = struct.unpack('!H', _recv_exactly(sock, 2))[0]
+                wire = _recv_exactly(sock, length)
+                try:
+                    key = struct.unpack('!H', wire[:2]) + udpmux.question_key(wire)
+                except (struct.error, IndexError):
+                    continue
+                result = self.pending.pop(key, None)
+                if result is not None:
+                    result.set(wire)
+        except (socket.error, EOFError):
+            pass
+        finally:
+            self._close(sock)
+
+
+def _recv_exactly(sock, count):
+    chunks = []
+    while count:
+        chunk = sock.recv(count)
+        if not chunk:
+            raise EOFError()
+        chunks.append(chunk)
+        count -= len(chunk)
+    return ''.join(chunks)
+
+
+_pools = {}  # (nameserver, port) -> (list of TcpConnection, round robin counter)
+
+
+def get_connection(nameserver, port=53):
+    key = (nameserver, port)
+    pool = _pools.get(key)
+    if pool is None:
+        connections = [TcpConnection(nameserver, port, udpmux.TIMERS)
+                       for _ in xrange(config.tcp_connections_per_nameserver)]
+        pool = _pools[key] = (connections, itertools.cycle(connections))
+    return next(pool[1])
+
+
+def query(nameserver, wire, timeout, port=53):
+    """Send a query to the nameserver on one of its pooled connections and
+    return the wire format of the response. Raises dns.exception.Timeout."""
+    return get_connection(nameserver, port).query(wire, timeout)
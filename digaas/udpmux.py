@@ -0,0 +1,177 @@
+"""
+Long-lived, shared UDP sockets for dns queries.
+
+Opening, binding and closing a socket per query uses up ephemeral ports and
+adds syscalls at high query rates. Instead, each nameserver gets a small pool
+of connected UDP sockets. Every socket has one reader greenlet that matches
+responses to outstanding queries by (message id, question name, question
+type), and all the query timeouts live in one shared timer heap. Queries are
+sent on them by digaas.hedging.
+"""
+import heapq
+import itertools
+import random
+import socket
+import struct
+
+import gevent
+import gevent.event
+import dns.exception
+from monotonic import monotonic
+
+from digaas.config import CONFIG as config
+
+# the reader's wait after a socket error doubles from MIN_ERROR_SLEEP up to
+# MAX_ERROR_SLEEP seconds while the errors keep coming
+MIN_ERROR_SLEEP = 0.01
+MAX_ERROR_SLEEP = 1.0
+
+
+class Timers(object):
+    """Fails queries that haven't been answered by their deadline. One greenlet
+    and one heap serve every socket (and every tcp connection, see tcpmux).
+
+    The owner of a query is anything with a fail(key, exception) method.
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._wakeup = gevent.event.Event()
+        self._runner = None
+
+    def add(self, deadline, owner, key):
+        heapq.heappush(self._heap, (deadline, next(self._counter), owner, key))
+        if self._runner is None:
+            self._runner = gevent.spawn(self._run)
+        elif self._heap[0][2] is owner and self._heap[0][3] == key:
+            self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.clear()
+            timeout = None
+            while self._heap:
+                deadline, _, owner, key = self._heap[0]
+                timeout = deadline - monotonic()
+                if timeout > 0:
+                    break
+                heapq.heappop(self._heap)
+                timeout = None
+                # a no-op if the query was already answered
+                owner.fail(key, dns.exception.Timeout())
+            self._wakeup.wait(timeout)
+
+
+class MuxSocket(object):
+    """A connected UDP socket shared by many outstanding queries"""
+
+    def __init__(self, nameserver, port, timers, ids=None):
+        """
+        :param ids: the set of message ids in use, if it's shared with other
+            sockets to the same nameserver
+        """
+        family = socket.AF_INET6 if ':' in nameserver else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        # connecting means the kernel drops datagrams from anyone else
+        self.sock.connect((nameserver, port))
+        self.timers = timers
+        self.pending = {}  # (id, qname, qtype) -> AsyncResult
+        self.ids = ids if ids is not None else set()
+        self.reader = gevent.spawn(self._read_forever)
+
+    def send(self, wire, deadline, result):
+        """Send the query with a new message id, without waiting. The response
+        is set on the result, or dns.exception.Timeout at the deadline. Several
+        queries may share a result, and the first response wins.
+
+        :returns: the key for the query, to pass to cancel() once it's done
+        """
+        qid = allocate_id(self.ids)
+        wire = struct.pack('!H', qid) + wire[2:]
+        key = (qid,) + question_key(wire)
+        self.pending[key] = result
+        self.timers.add(deadline, self, key)
+        try:
+            self.sock.send(wire)
+        except socket.error:
+            # e.g. a pending icmp error from an earlier query. treat it like a
+            # lost packet, and let the query time out.
+            pass
+        return key
+
+    def cancel(self, key):
+        """Stop waiting for the query's response"""
+        self.pending.pop(key, None)
+        self.ids.discard(key[0])
+
+    def fail(self, key, exception):
+        result = self.pending.pop(key, None)
+        if result is not None and not result.ready():
+            result.set_exception(exception)
+
+    def _read_forever(self):
+        error_sleep = 0
+        while True:
+            try:
+                wire = self.sock.recv(65535)
+            except socket.error:
+                # e.g. ECONNREFUSED after an icmp port unreachable. the
+                # queries it was for will time out. back off, so an error
+                # that doesn't go away doesn't spin.
+                error_sleep = min(MAX_ERROR_SLEEP, error_sleep * 2 or MIN_ERROR_SLEEP)
+                gevent.sleep(error_sleep)
+                continue
+            error_sleep = 0
+            try:
+                key = struct.unpack('!H', wire[:2]) + question_key(wire)
+            except (struct.error, IndexError):
+                continue
+            result = self.pending.pop(key, None)
+            if result is not None and not result.ready():
+                result.set(wire)
+
+
+def allocate_id(ids):
+    """Pick a random message id that isn't in ids, and add it"""
+    if len(ids) >= 0xffff:
+        raise dns.exception.DNSException("Out of message ids")
+    while True:
+        qid = random.randint(0, 0xffff)
+        if qid not in ids:
+            ids.add(qid)
+            return qid
+
+
+def question_key(wire):
+    """Return (qname, qtype) from the question section of a message, where
+    qname is the lowercased wire format of the name"""
+    offset = 12
+    while True:
+        length = ord(wire[offset])
+        if length == 0 or length >= 0xc0:
+            break
+        offset += length + 1
+    if length != 0:
+        # a compressed question name. these never come from us.
+        raise IndexError("compressed question name")
+    qname = wire[12:offset + 1].lower()
+    qtype = struct.unpack_from('!H', wire, offset + 1)[0]
+    return qname, qtype
+
+
+TIMERS = Timers()
+_pools = {}  # (nameserver, port) -> (list of MuxSocket, round robin counter)
+
+
+def get_socket(nameserver, port=53):
+    key = (nameserver, port)
+    pool = _pools.get(key)
+    if pool is None:
+        # the sockets share their message ids, so copies of a query sent on
+        # different sockets (see digaas.hedging) can be told apart
+        ids = set()
+        sockets = [MuxSocket(nameserver, port, TIMERS, ids)
+                   for _ in xrange(config.udp_sockets_per_nameserver)]
+        pool = _pools[key] = (sockets, itertools.cycle(sockets))
+    return next(pool[1])
@@ -0,0 +1,123 @@
+"""
+A durable poll work queue in redis, shared by any number of digaas nodes.
+
+With "poll_queue": "redis" in the config, accepted poll requests are pushed
+onto a queue in redis instead of straight into this process's scheduler. Every
+node runs a consumer that claims requests off the queue under a lease, keeps
+its leases alive with a heartbeat while it polls, and releases each lease when
+the request finishes. If a node dies, its leases expire and any other node
+puts those requests back on the queue, so an ACCEPTED request is never lost.
+
+Lease times are wall clock times, since they're compared across machines.
+"""
+import time
+
+import gevent
+
+from digaas.config import CONFIG as config
+from digaas import storage
+from digaas.consts import Status
+
+# the number of requests to claim per round trip
+CLAIM_BATCH = 100
+# how long to sleep when the queue is empty
+IDLE_SLEEP = 0.05
+# how long to sleep after failing to reach redis
+ERROR_SLEEP = 1
+# the number of expired leases to requeue per round trip
+RECLAIM_BATCH = 1000
+
+# id -> queue item, for every request this node holds a lease on
+_held = {}
+_consumer = None
+
+
+def start(scheduler):
+    """Start consuming the queue into the given poll.Scheduler"""
+    global _consumer
+    if _consumer is None:
+        _consumer = gevent.spawn(_consume, scheduler)
+        gevent.spawn(_heartbeat)
+
+
+def release(id):
+    """Give up our lease on a finished request"""
+    item = _held.pop(id, None)
+    if item is not None:
+        storage.release_lease(item)
+
+
+def reclaim():
+    """Requeue every request whose lease has expired"""
+    total = 0
+    while True:
+        n = storage.reclaim_expired_leases(time.time(), RECLAIM_BATCH)
+        total += n
+        if n < RECLAIM_BATCH:
+            break
+    if total:
+        print "workqueue: requeued %s requests with expired leases" % total
+    return total
+
+
+def _consume(scheduler):
+    last_reclaim = None
+    while True:
+        try:
+            if last_reclaim is None or time.time() - last_reclaim > config.poll_lease_seconds:
+                reclaim()
+                last_reclaim = time.time()
+            busy = _claim(scheduler)
+        except Exception as e:
+            # anything we claimed but didn't take on is requeued when its
+            # lease expires
+            print "workqueue: failed to consume the queue: %s" % e
+            gevent.sleep(ERROR_SLEEP)
+            continue
+        if not busy:
+            gevent.sleep(IDLE_SLEEP)
+
+
+def _claim(scheduler):
+    """Claim a batch of requests and start polling for them. Returns False if
+    there was nothing to claim, or we hold as many as we may."""
+    if len(_held) >= config.poll_queue_max_claimed:
+        return False
+    items = storage.claim_poll_requests(
+        CLAIM_BATCH, time.time() + config.poll_lease_seconds)
+    if not items:
+        return False
+    for item in items:
+        try:
+            id, accepted_at = storage.parse_queue_item(item)
+            poll_req = storage.get_poll_request(id)
+        except Exception as e:
+            # it's requeued when the lease expires
+            print "workqueue: failed to take on %r: %s" % (item, e)
+            continue
+        if poll_req is None or poll_req.status != Status.ACCEPTED:
+            # it finished just before its old lease expired
+            storage.release_lease(item)
+            continue
+        _held[id] = item
+        scheduler.add(poll_req, accepted_at)
+    return True
+
+
+def _heartbeat():
+    while True:
+        gevent.sleep(config.poll_lease_seconds / 3.0)
+        try:
+            lost = storage.renew_leases(_held.values(),
+                                        time.time() + config.poll_lease_seconds)
+        except Exception as e:
+            print "workqueue: failed to renew leases: %s" % e
+            continue
+        if lost:
+            # they were requeued, so another node may hold them now. We can't
+            # release them without releasing its lease.
+            print "workqueue: lost the leases on %s requests" % len(lost)
+            lost = set(lost)
+            for id, item in _held.items():
+                if item in lost:
+                    del _held[id]
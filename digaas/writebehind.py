@@ -0,0 +1,170 @@
+"""
+Batched, pipelined writes to storage.
+
+Every poll request used to cost its own round trips to redis when it was
+accepted and again when it finished, so a burst of completions queued up on
+redis latency one at a time. Instead, writes from every greenlet are collected
+and sent together in one pipeline, every few milliseconds or as soon as enough
+of them are waiting. Callers that need a write to be durable (like the api,
+before it answers 202) wait for the flush that carries it, so concurrent
+requests share a single round trip. The poller doesn't wait at all.
+
+Writes go out in the order they were made, so a finished request's value is
+always written before its lease is released or its event is published. Until
+a SET is stored, its value is kept in `pending`, so reads in this process see
+their own writes.
+
+A batch that fails because storage is unavailable (one of the backend's
+transient_errors) is put back ahead of the newer writes and retried, backing
+off up to MAX_BACKOFF seconds between attempts, so the poller's writes aren't
+lost. Callers waiting on the writes wait until they're stored.
+
+Each batch goes to the storage backend's write(), which is one pipeline in
+redis and one transaction in SQLite.
+"""
+import gevent
+import gevent.event
+from monotonic import monotonic
+
+from digaas import graphite
+
+# how often the flush stats are pushed to graphite
+REPORT_INTERVAL = 10
+
+# the wait before retrying a failed batch doubles from MIN_BACKOFF up to
+# MAX_BACKOFF seconds
+MIN_BACKOFF = 0.05
+MAX_BACKOFF = 5.0
+
+
+class _Window(object):
+    """Counts flushes between reports"""
+    __slots__ = ('flushes', 'writes', 'max_batch', 'latency', 'max_latency', 'errors')
+
+    def __init__(self):
+        self.flushes = 0
+        self.writes = 0
+        self.max_batch = 0
+        self.latency = 0.0
+        self.max_latency = 0.0
+        self.errors = 0
+
+
+class WriteBehind(object):
+
+    def __init__(self, get_backend, max_batch, interval):
+        """
+        :param get_backend: returns the storage backend to write to
+        :param max_batch: flush as soon as this many writes are waiting
+        :param interval: otherwise, flush this many seconds after the first
+            write of a batch
+        """
+        self.get_backend = get_backend
+        self.max_batch = max_batch
+        self.interval = interval
+        self.pending = {}    # key -> value, for every SET not yet written
+        self.report = None   # the last report, as a dict
+        self._writes = []    # (redis method name, args)
+        self._results = []   # an AsyncResult per submit() in the batch
+        self._wakeup = gevent.event.Event()
+        self._full = gevent.event.Event()
+        self._window = _Window()
+        self._flusher = None
+        self._backoff = 0    # seconds to wait before the next flush
+
+    def submit(self, writes):
+        """Queue the writes to go out together in the next flush.
+
+        :param writes: a list of (redis method name, args), like
+            ('set', (key, value))
+        :returns: an AsyncResult that's set once the writes are stored
+        """
+        if self._flusher is None:
+            self._flusher = gevent.spawn(self._flush_forever)
+            gevent.spawn(self._report_forever)
+        for name, args in writes:
+            if name == 'set':
+                self.pending[args[0]] = args[1]
+        self._writes.extend(writes)
+        result = gevent.event.AsyncResult()
+        self._results.append(result)
+        if len(self._writes) >= self.max_batch:
+            self._full.set()
+        self._wakeup.set()
+        return result
+
+    def flush(self):
+        """Write everything that's waiting, in one pipeline. If storage is
+        unavailable, the writes are put back to be retried."""
+        writes, self._writes = self._writes, []
+        results, self._results = self._results, []
+        if not writes:
+            return
+        start = monotonic()
+        backend = self.get_backend()
+        try:
+            backend.write(writes)
+        except backend.transient_errors as e:
+            self._backoff = min(MAX_BACKOFF, self._backoff * 2 or MIN_BACKOFF)
+            print "writebehind: failed to write {0} changes, retrying in {1}s: {2}".format(
+                len(writes), self._backoff, e)
+            self._window.errors += 1
+            # ahead of anything submitted since, to keep the writes in order
+            self._writes[:0] = writes
+            self._results[:0] = results
+            self._wakeup.set()
+            return
+        except Exception as e:
+            # retrying won't help
+            print "writebehind: failed to write {0} changes: {1}".format(len(writes), e)
+            self._window.errors += 1
+            for result in results:
+                result.set_exception(e)
+        else:
+            for result in results:
+                result.set(None)
+        self._backoff = 0
+        for name, args in writes:
+            # unless the key was set again since
+            if name == 'set' and self.pending.get(args[0]) is args[1]:
+                del self.pending[args[0]]
+
+        latency = monotonic() - start
+        window = self._window
+        window.flushes += 1
+        window.writes += len(writes)
+        window.max_batch = max(window.max_batch, len(writes))
+        window.latency += latency
+        window.max_latency = max(window.max_latency, latency)
+
+    def _flush_forever(self):
+        while True:
+            self._wakeup.wait()
+            if self._backoff:
+                gevent.sleep(self._backoff)
+            # give other writers a moment to join the batch
+            self._full.wait(self.interval)
+            self._wakeup.clear()
+            self._full.clear()
+            self.flush()
+
+    def _report_forever(self):
+        while True:
+            gevent.sleep(REPORT_INTERVAL)
+            self._report()
+
+    def _report(self):
+        window, self._window = self._window, _Window()
+        flushes = float(window.flushes) or 1.0
+        self.report = dict(
+            flushes=window.flushes,
+            writes=window.writes,
+            errors=window.errors,
+            mean_batch=window.writes / flushes,
+            max_batch=window.max_batch,
+            mean_latency=window.latency / flushes,
+            max_latency=window.max_latency,
+            pending=len(self._writes),
+        )
+        graphite.push_storage_data(self.report['mean_batch'], self.report['max_batch'],
+                                   self.report['mean_latency'], self.report['max_latency'])
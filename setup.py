@@ -14,6 +14,8 @@ class my_build_py(build_py):
             # mkpath is a distutils helper to create directories
             target_dir = '/etc/digaas'
             self.mkpath(target_dir)
+            # for the sqlite database and the plot images
+            self.mkpath('/var/lib/digaas')
 
             # generate the environment file for the init script
             environment = re.sub(
@@ -37,6 +39,7 @@ setup(
         'gevent',
         'Cython',
         'falcon',
+        'monotonic',
         'redis',
         'uwsgi',
     ],
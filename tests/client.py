@@ -11,6 +11,11 @@ class DigaasClient(object):
     SERIAL_NOT_LOWER = 'serial_not_lower'
     ZONE_REMOVED = 'zone_removed'
     DATA_EQUALS = 'data='
+    RRSET_EQUALS = 'rrset='
+    ABSENT = 'absent'
+
+    # how long to let the server hold each GET while waiting on a poll request
+    LONG_POLL_WAIT = 5
 
     def __init__(self, endpoint):
         self.endpoint = endpoint
@@ -31,7 +36,7 @@ class DigaasClient(object):
         return requests.get(self.endpoint)
 
     def post_poll_request(self, query_name, nameserver, serial, condition, start_time,
-                          timeout, frequency, rdatatype=None):
+                          timeout, frequency, rdatatype=None, transport=None):
         data = dict(
             query_name = query_name,
             nameserver = nameserver,
@@ -42,12 +47,36 @@ class DigaasClient(object):
             frequency  = frequency)
         if rdatatype is not None:
             data['rdatatype'] = rdatatype
+        if transport is not None:
+            data['transport'] = transport
 
         return requests.post(self._poll_requests_url(),
             data=json.dumps(data))
 
-    def get_poll_request(self, id):
-        return requests.get(self._poll_request_url(id))
+    def post_poll_requests(self, poll_requests):
+        """Submit a list of poll request dicts in one call"""
+        return requests.post(self._poll_requests_url() + '/bulk',
+            data=json.dumps(poll_requests))
+
+    def get_poll_request(self, id, wait=None):
+        """If wait is given, the server holds the request for up to that many
+        seconds until the poll request is no longer ACCEPTED"""
+        params = dict(wait=wait) if wait is not None else None
+        return requests.get(self._poll_request_url(id), params=params)
+
+    def lookup_poll_requests(self, ids, status=None):
+        """Get many poll requests in one call, optionally only those with the
+        given status (or list of statuses)"""
+        data = dict(ids=ids)
+        if status is not None:
+            data['status'] = status
+        return requests.post(self._poll_requests_url() + '/lookup',
+            data=json.dumps(data))
+
+    def find_poll_requests(self, **params):
+        """Get the poll requests matching the filters, like nameserver=<ip>,
+        status=<status>, since=<time>, until=<time> and limit=<n>"""
+        return requests.get(self._poll_requests_url(), params=params)
 
     def post_stats_request(self, start, end):
         return requests.post(
@@ -72,24 +101,25 @@ class DigaasClient(object):
         self.wait_for_status(api_call, check, 1, 30)
 
     def wait_for_completed_poll_request(self, id):
-        api_call = lambda: self.get_poll_request(id)
+        api_call = lambda: self.get_poll_request(id, wait=self.LONG_POLL_WAIT)
         def check(resp):
             assert resp.status_code == 200
             if resp.json()['status'] == "COMPLETED":
                 return True
             if resp.json()['status'] in ['ERROR', 'INTERNAL_ERROR']:
                 raise Exception('Found %s status while polling for COMPLETED on id %s' % (resp.json()['status'], id))
-        self.wait_for_status(api_call, check, 1, 30)
+        # the server holds each call until the status changes, so don't sleep
+        self.wait_for_status(api_call, check, 0, 30)
 
     def wait_for_errored_poll_request(self, id):
-        api_call = lambda: self.get_poll_request(id)
+        api_call = lambda: self.get_poll_request(id, wait=self.LONG_POLL_WAIT)
         def check(resp):
             assert resp.status_code == 200
             if resp.json()['status'] == "ERROR":
                 return True
             if resp.json()['status'] in ['COMPLETED', 'INTERNAL_ERROR']:
                 raise Exception('Found %s status while waiting for ERROR on id %s' % (resp.json()['status'], id))
-        self.wait_for_status(api_call, check, 1, 30)
+        self.wait_for_status(api_call, check, 0, 30)
 
     @classmethod
     def wait_for_status(cls, api_call, check, interval, timeout):
@@ -0,0 +1,118 @@
+import time
+import unittest
+
+from monotonic import monotonic
+
+from digaas import cadence
+from digaas import model
+
+NAMESERVER = '192.0.2.1'
+
+
+def make_poll_request(**kwargs):
+    data = dict(
+        query_name = 'example.com',
+        nameserver = NAMESERVER,
+        serial = 1,
+        start_time = time.time(),
+        condition = 'serial_not_lower',
+        timeout = 30,
+        frequency = 1,
+        adaptive = True)
+    data.update(kwargs)
+    return model.PollRequest(**data)
+
+
+class TestPlan(unittest.TestCase):
+
+    def setUp(self):
+        cadence._history.clear()
+        # durations from 1 to 10 seconds, as if loaded from storage just now
+        samples = [1 + i * 0.1 for i in xrange(91)]
+        cadence._history[cadence.history_key(NAMESERVER, 'serial_not_lower')] = \
+            (monotonic(), samples)
+
+    def tearDown(self):
+        cadence._history.clear()
+
+    def test_no_plan_without_enough_history(self):
+        cadence._history.clear()
+        cadence._history[cadence.history_key(NAMESERVER, 'serial_not_lower')] = \
+            (monotonic(), [1.0] * (cadence.MIN_SAMPLES - 1))
+        self.assertIsNone(cadence.plan(make_poll_request(), monotonic()))
+
+    def test_first_probe_is_now(self):
+        now = monotonic()
+        times = cadence.plan(make_poll_request(query_budget=10), now)
+        self.assertEqual(times[0], now)
+        self.assertEqual(times, sorted(times))
+
+    def test_probes_within_budget(self):
+        now = monotonic()
+        for budget in xrange(1, 40):
+            times = cadence.plan(make_poll_request(query_budget=budget), now)
+            self.assertLessEqual(len(times), budget, "budget {0}: {1}".format(budget, times))
+            self.assertEqual(times[0], now)
+
+    def test_default_budget(self):
+        poll_req = make_poll_request(timeout=10, frequency=2)
+        times = cadence.plan(poll_req, monotonic())
+        self.assertLessEqual(len(times), cadence.default_budget(poll_req))
+
+    def test_probes_are_spaced(self):
+        times = cadence.plan(make_poll_request(query_budget=1000), monotonic())
+        for earlier, later in zip(times, times[1:]):
+            self.assertGreaterEqual(later - earlier, cadence.MIN_SPACING)
+
+    def test_tail_probes_before_timeout(self):
+        now = monotonic()
+        poll_req = make_poll_request(query_budget=20, timeout=30)
+        times = cadence.plan(poll_req, now)
+        # some probes go after the slowest time seen, none after the timeout
+        self.assertGreater(times[-1] - now, 10)
+        self.assertLess(times[-1] - now, 30)
+
+    def test_skips_what_already_elapsed(self):
+        now = monotonic()
+        poll_req = make_poll_request(query_budget=10, start_time=time.time() - 5)
+        times = cadence.plan(poll_req, now)
+        self.assertEqual(times[0], now)
+        for t in times[1:]:
+            self.assertGreater(t, now)
+
+
+class TestValidate(unittest.TestCase):
+
+    def data(self, **kwargs):
+        data = dict(
+            query_name = 'example.com',
+            nameserver = NAMESERVER,
+            serial = 1,
+            start_time = time.time(),
+            condition = 'serial_not_lower',
+            timeout = 30,
+            frequency = 1)
+        data.update(kwargs)
+        return data
+
+    def test_valid(self):
+        model.PollRequest.validate(self.data(adaptive=True, query_budget=5))
+        model.PollRequest.validate(self.data(adaptive=False))
+
+    def test_adaptive_must_be_a_bool(self):
+        for adaptive in ('false', 'true', 1, 0):
+            self.assertRaises(ValueError, model.PollRequest.validate,
+                              self.data(adaptive=adaptive))
+
+    def test_query_budget_must_be_a_positive_int(self):
+        for query_budget in (True, False, 0, -1, 2.5, '5'):
+            self.assertRaises(ValueError, model.PollRequest.validate,
+                              self.data(adaptive=True, query_budget=query_budget))
+
+    def test_query_budget_needs_adaptive(self):
+        self.assertRaises(ValueError, model.PollRequest.validate,
+                          self.data(query_budget=5))
+
+
+if __name__ == '__main__':
+    unittest.main()
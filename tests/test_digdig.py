@@ -0,0 +1,171 @@
+import random
+import struct
+import unittest
+
+import dns.message
+import dns.rdatatype
+import dns.rrset
+
+from digaas import digdig
+
+SOA = 'ns1.example.com. hostmaster.example.com. 7 3600 600 86400 300'
+
+
+def make_response(qname, rdatatype, answer=(), authority=(), additional=(), rcode=0):
+    """Return the wire format of a response built by dnspython, which
+    compresses the names it can
+
+    :param answer: (name, rdatatype, [rdata text]) for each rrset
+    """
+    response = dns.message.make_response(dns.message.make_query(qname, rdatatype))
+    response.set_rcode(rcode)
+    for section, rrsets in [(response.answer, answer), (response.authority, authority),
+                            (response.additional, additional)]:
+        for name, rrset_type, texts in rrsets:
+            section.append(dns.rrset.from_text(name, 300, 'IN', rrset_type, *texts))
+    return response.to_wire()
+
+def wire_name(name):
+    """Return the uncompressed wire format of a name given as a list of labels"""
+    return ''.join(chr(len(label)) + label for label in name) + '\0'
+
+def make_raw_response(question, records):
+    """Return a response with each name written exactly as given.
+
+    :param question: the wire format of the question name
+    :param records: (owner wire, rdatatype, rdata wire) for each answer record
+    """
+    wire = struct.pack('!HHHHHH', 1, 0x8180, 1, len(records), 0, 0)
+    wire += question + struct.pack('!HH', 1, 1)
+    for owner, rdatatype, rdata in records:
+        wire += owner + struct.pack('!HHIH', rdatatype, 1, 300, len(rdata)) + rdata
+    return wire
+
+# the offset of the question name, for compression pointers to it
+QNAME_POINTER = '\xc0\x0c'
+
+FAST_CASES = [
+    ('a', make_response('example.com.', 'A', [
+        ('example.com.', 'A', ['192.0.2.1', '192.0.2.2'])]), 'A'),
+    ('aaaa', make_response('example.com.', 'AAAA', [
+        ('example.com.', 'AAAA', ['2001:db8::1', '2001:db8::2:0:0:1'])]), 'AAAA'),
+    ('soa', make_response('example.com.', 'SOA', [('example.com.', 'SOA', [SOA])]), 'SOA'),
+    ('serial of a soa in the answer', make_response('example.com.', 'A', [
+        ('example.com.', 'SOA', [SOA]), ('example.com.', 'A', ['192.0.2.1'])]), 'A'),
+    ('ns with glue', make_response('example.com.', 'NS', [
+        ('example.com.', 'NS', ['ns1.example.com.', 'ns2.example.org.'])], [], [
+        ('ns1.example.com.', 'A', ['192.0.2.53']),
+        ('ns1.example.com.', 'AAAA', ['2001:db8::53'])]), 'NS'),
+    ('cname chain', make_response('www.example.com.', 'A', [
+        ('www.example.com.', 'CNAME', ['web.example.com.']),
+        ('web.example.com.', 'A', ['192.0.2.3'])]), 'A'),
+    ('ptr', make_response('1.2.0.192.in-addr.arpa.', 'PTR', [
+        ('1.2.0.192.in-addr.arpa.', 'PTR', ['host_1.example.com.'])]), 'PTR'),
+    ('nxdomain with a soa in the authority', make_response('gone.example.com.', 'A', [], [
+        ('example.com.', 'SOA', [SOA])], rcode=3), 'A'),
+    ('nodata with a soa in the authority', make_response('example.com.', 'AAAA', [], [
+        ('example.com.', 'SOA', [SOA])]), 'AAAA'),
+    ('soa in the authority of a soa query', make_response('www.example.com.', 'SOA', [], [
+        ('example.com.', 'SOA', [SOA])]), 'SOA'),
+    ('refused', make_response('example.com.', 'A', rcode=5), 'A'),
+    ('pointer to a pointer', make_raw_response(wire_name(['www', 'example', 'com']), [
+        (QNAME_POINTER, dns.rdatatype.CNAME, '\x03web\xc0\x10'),
+        ('\x03web\xc0\x10', dns.rdatatype.CNAME, '\x03foo\xc0\x21')]), 'CNAME'),
+    ('names differing in case', make_raw_response(wire_name(['example', 'com']), [
+        (QNAME_POINTER, dns.rdatatype.NS, wire_name(['ns1', 'example', 'com'])),
+        (wire_name(['EXAMPLE', 'com']), dns.rdatatype.NS, wire_name(['NS2', 'example', 'com']))]),
+     'NS'),
+]
+
+# responses _parse_fast leaves to dnspython
+UNUSUAL_CASES = [
+    ('other types in the answer', make_response('example.com.', 'A', [
+        ('example.com.', 'MX', ['10 mail.example.com.']),
+        ('example.com.', 'A', ['192.0.2.1'])]), 'A'),
+    ('mx', make_response('example.com.', 'MX', [
+        ('example.com.', 'MX', ['10 mail.example.com.'])]), 'MX'),
+    ('duplicate records', make_raw_response(wire_name(['example', 'com']), [
+        (QNAME_POINTER, dns.rdatatype.A, '\xc0\x00\x02\x01'),
+        (wire_name(['example', 'com']), dns.rdatatype.A, '\xc0\x00\x02\x01')]), 'A'),
+    ('duplicate records differing in case', make_raw_response(wire_name(['example', 'com']), [
+        (QNAME_POINTER, dns.rdatatype.NS, wire_name(['ns1', 'example', 'com'])),
+        (wire_name(['EXAMPLE', 'com']), dns.rdatatype.NS, wire_name(['NS1', 'example', 'com'])),
+        (QNAME_POINTER, dns.rdatatype.NS, wire_name(['ns2', 'example', 'com']))]), 'NS'),
+    ('escaped labels', make_raw_response(wire_name(['a b', 'example', 'com']), [
+        (QNAME_POINTER, dns.rdatatype.CNAME, wire_name(['x.y', 'example', 'com'])),
+        (wire_name(['x.y', 'example', 'com']), dns.rdatatype.CNAME,
+         wire_name(['q"\\\xff', 'example', 'com']))]), 'CNAME'),
+    ('forward pointer', make_raw_response(wire_name(['example', 'com']), [
+        (QNAME_POINTER, dns.rdatatype.CNAME, '\xc0\x40')]), 'CNAME'),
+    ('pointer loop', make_raw_response('\x03www\xc0\x0c', [
+        (QNAME_POINTER, dns.rdatatype.A, '\xc0\x00\x02\x01')]), 'A'),
+    ('bad label type', make_raw_response(wire_name(['example', 'com']), [
+        (QNAME_POINTER, dns.rdatatype.CNAME, '\x40' + 'x' * 64 + '\0')]), 'CNAME'),
+    ('short address', make_raw_response(wire_name(['example', 'com']), [
+        (QNAME_POINTER, dns.rdatatype.A, '\xc0\x00\x02')]), 'A'),
+    ('soa too short', make_raw_response(wire_name(['example', 'com']), [
+        (QNAME_POINTER, dns.rdatatype.SOA, QNAME_POINTER + QNAME_POINTER + '\0' * 16)]), 'SOA'),
+    ('trailing junk', make_response('example.com.', 'A', [
+        ('example.com.', 'A', ['192.0.2.1'])]) + '\0', 'A'),
+]
+
+CASES = FAST_CASES + UNUSUAL_CASES
+
+
+def parse(parser, wire, rdatatype):
+    """Return what the parser makes of the wire, with the rdatas sorted, since
+    dnspython groups them into rrsets"""
+    try:
+        answer = parser(wire, dns.rdatatype.from_text(rdatatype))
+    except digdig._Unusual:
+        return 'unusual'
+    except Exception:
+        return 'error'
+    return answer.rcode, answer.count, sorted(answer.rdatas), answer.serial
+
+
+class TestParseAnswer(unittest.TestCase):
+    """_parse_fast must give the same answer as dnspython, or leave it to
+    dnspython"""
+
+    def assertAgree(self, wire, rdatatype, description):
+        fast = parse(digdig._parse_fast, wire, rdatatype)
+        if fast != 'unusual':
+            self.assertEqual(fast, parse(digdig._parse_dnspython, wire, rdatatype),
+                             "{0}: {1!r}".format(description, wire))
+        return fast
+
+    def test_cases(self):
+        for description, wire, rdatatype in CASES:
+            self.assertAgree(wire, rdatatype, description)
+            self.assertEqual(parse(digdig.parse_answer, wire, rdatatype),
+                             parse(digdig._parse_dnspython, wire, rdatatype), description)
+
+    def test_fast_path(self):
+        # the usual responses don't need dnspython
+        for description, wire, rdatatype in FAST_CASES:
+            self.assertNotEqual(parse(digdig._parse_fast, wire, rdatatype), 'unusual',
+                                description)
+
+    def test_left_to_dnspython(self):
+        for description, wire, rdatatype in UNUSUAL_CASES:
+            self.assertEqual(parse(digdig._parse_fast, wire, rdatatype), 'unusual',
+                             description)
+
+    def test_truncated(self):
+        for description, wire, rdatatype in CASES:
+            for end in xrange(len(wire)):
+                self.assertAgree(wire[:end], rdatatype, description)
+
+    def test_fuzz(self):
+        rand = random.Random(0)
+        for description, wire, rdatatype in CASES:
+            for _ in xrange(500):
+                fuzzed = bytearray(wire)
+                for _ in xrange(rand.randint(1, 3)):
+                    fuzzed[rand.randrange(len(fuzzed))] = rand.randrange(256)
+                self.assertAgree(str(fuzzed), rdatatype, description)
+
+
+if __name__ == '__main__':
+    unittest.main()
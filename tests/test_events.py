@@ -0,0 +1,85 @@
+import json
+import time
+import unittest
+
+from digaas import app
+from digaas import events
+from digaas import model
+
+
+def make_poll_request(**kwargs):
+    data = dict(
+        query_name = 'example.com',
+        nameserver = '192.0.2.1',
+        serial = 1,
+        start_time = time.time(),
+        condition = 'serial_not_lower',
+        timeout = 30,
+        frequency = 1,
+        status = 'COMPLETED',
+        duration = 1.0)
+    data.update(kwargs)
+    return model.PollRequest(**data)
+
+
+def parse_events(chunk):
+    """Return the (event, data) of each server-sent event in the chunk"""
+    parsed = []
+    for text in chunk.split('\n\n'):
+        if text:
+            event, data = text.split('\n')
+            parsed.append((event[len('event: '):], json.loads(data[len('data: '):])))
+    return parsed
+
+
+class TestSubscription(unittest.TestCase):
+
+    def tearDown(self):
+        events._subscriptions.clear()
+
+    def test_overflow_is_counted(self):
+        subscription = events.Subscription(3)
+        for _ in xrange(5):
+            subscription.offer(make_poll_request())
+        self.assertEqual(subscription.queue.qsize(), 3)
+        self.assertEqual(subscription.take_dropped(), 2)
+        self.assertEqual(subscription.take_dropped(), 0)
+
+    def test_filters(self):
+        subscription = events.subscribe(10, nameserver='192.0.2.2', condition='data=')
+        for poll_req in [
+                make_poll_request(nameserver='192.0.2.2', condition='data=192.0.2.10'),
+                make_poll_request(nameservers=['192.0.2.1', '192.0.2.2'],
+                                  condition='data=192.0.2.11'),
+                make_poll_request(nameserver='192.0.2.2'),
+                make_poll_request(condition='data=192.0.2.10')]:
+            events.notify(poll_req)
+        self.assertEqual([subscription.queue.get_nowait().condition for _ in xrange(2)],
+                         ['data=192.0.2.10', 'data=192.0.2.11'])
+        self.assertTrue(subscription.queue.empty())
+
+    def test_dropped_reported_when_caught_up(self):
+        subscription = events.subscribe(3)
+        stream = app._stream_events(subscription)
+        poll_reqs = [make_poll_request() for _ in xrange(5)]
+        for poll_req in poll_reqs:
+            events.notify(poll_req)
+
+        # the buffered events, then the number dropped
+        parsed = parse_events(next(stream))
+        self.assertEqual([data['id'] for event, data in parsed[:3]],
+                         [poll_req.id for poll_req in poll_reqs[:3]])
+        self.assertEqual([event for event, data in parsed[:3]], ['finished'] * 3)
+        self.assertEqual(parsed[3:], [('dropped', dict(dropped=2))])
+
+        # once caught up, nothing more is dropped
+        events.notify(poll_reqs[4])
+        parsed = parse_events(next(stream))
+        self.assertEqual(parsed, [('finished', poll_reqs[4].to_dict())])
+
+        stream.close()
+        self.assertNotIn(subscription, events._subscriptions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import random
+import socket
+import struct
+import time
+import unittest
+
+import gevent
+import dns.exception
+import dns.message
+
+from digaas.config import CONFIG
+from digaas import hedging
+
+NAMESERVER = '127.0.0.1'
+
+
+class FakeNameserver(object):
+    """Answers udp queries by echoing them back as responses.
+
+    :param answer: called with the number of the query (from 0), returns the
+        seconds to wait before answering it, or None to drop it
+    """
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((NAMESERVER, 0))
+        self.port = self.sock.getsockname()[1]
+        self.received = []  # (time, message id)
+        self.reader = gevent.spawn(self._serve)
+
+    def close(self):
+        self.reader.kill()
+        self.sock.close()
+
+    def _serve(self):
+        while True:
+            wire, addr = self.sock.recvfrom(65535)
+            delay = self.answer(len(self.received))
+            self.received.append((time.time(), struct.unpack('!H', wire[:2])[0]))
+            if delay is not None:
+                gevent.spawn_later(delay, self.sock.sendto, wire[:2] + '\x81\x80' + wire[4:],
+                                   addr)
+
+
+class TestHedging(unittest.TestCase):
+
+    def setUp(self):
+        self.wire = dns.message.make_query('example.com.', 'SOA').to_wire()
+        self._hedges, CONFIG.dns_query_hedges = CONFIG.dns_query_hedges, 1
+        hedging._estimators.clear()
+        hedging._windows.clear()
+        # hedge 50ms after sending
+        estimator = hedging.get_estimator(NAMESERVER)
+        estimator.srtt, estimator.rttvar = 0.05, 0.0
+        self.nameserver = None
+
+    def tearDown(self):
+        CONFIG.dns_query_hedges = self._hedges
+        if self.nameserver is not None:
+            self.nameserver.close()
+
+    def query(self, answer, timeout=1.0):
+        self.nameserver = FakeNameserver(answer)
+        return hedging.query(NAMESERVER, self.wire, timeout, self.nameserver.port)
+
+    def test_no_hedge_when_answered(self):
+        self.query(lambda n: 0)
+        self.assertEqual(len(self.nameserver.received), 1)
+        window = hedging._windows[NAMESERVER]
+        self.assertEqual((window.queries, window.hedges, window.hedge_wins), (1, 0, 0))
+
+    def test_hedge_wins(self):
+        # the first copy is lost, so the hedge is answered
+        resp = self.query(lambda n: 0 if n == 1 else None)
+        self.assertEqual(resp[4:], self.wire[4:])
+        (first, first_id), (second, second_id) = self.nameserver.received
+        self.assertNotEqual(first_id, second_id)
+        self.assertEqual(struct.unpack('!H', resp[:2])[0], second_id)
+        self.assertGreaterEqual(second - first, 0.04)
+        self.assertLess(second - first, 0.2)
+        window = hedging._windows[NAMESERVER]
+        self.assertEqual((window.hedges, window.hedge_wins), (1, 1))
+        # sampled from when the hedge was sent, so less than the 50ms before
+        self.assertLess(hedging.get_estimator(NAMESERVER).srtt, 0.05)
+
+    def test_first_copy_wins_late(self):
+        # the first copy is answered after the hedge went out
+        self.query(lambda n: 0.1 if n == 0 else None)
+        self.assertEqual(len(self.nameserver.received), 2)
+        window = hedging._windows[NAMESERVER]
+        self.assertEqual((window.hedges, window.hedge_wins), (1, 0))
+        # sampled from when the first copy was sent
+        self.assertGreater(hedging.get_estimator(NAMESERVER).srtt, 0.05)
+
+    def test_copies_get_different_ids_on_different_sockets(self):
+        # both copies would get message id 7, if their sockets didn't share ids
+        ids = iter([7, 7, 8])
+        randint, random.randint = random.randint, lambda a, b: next(ids)
+        try:
+            self.query(lambda n: 0 if n == 1 else None)
+        finally:
+            random.randint = randint
+        self.assertEqual([qid for _, qid in self.nameserver.received], [7, 8])
+        window = hedging._windows[NAMESERVER]
+        self.assertEqual(window.hedge_wins, 1)
+
+    def test_timeout(self):
+        self.assertRaises(dns.exception.Timeout, self.query, lambda n: None, 0.2)
+        self.assertEqual(len(self.nameserver.received), 2)
+        self.assertEqual(hedging._windows[NAMESERVER].timeouts, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
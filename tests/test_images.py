@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import falcon.testing
+
+from digaas import app
+from digaas import images
+from digaas import storage
+from digaas import storage_memory
+from digaas import storage_sqlite
+from digaas.config import CONFIG
+
+PLOT = '\x89PNG\r\n\x1a\n' + 'a plot' * 100
+OTHER_PLOT = '\x89PNG\r\n\x1a\n' + 'a PLOT' * 100
+
+
+class ImageTestCase(unittest.TestCase):
+    """Stores images in a temporary image store"""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self._image_dir = images._image_dir
+        images._image_dir = os.path.join(self.tmp_dir, 'images')
+        os.mkdir(images._image_dir)
+        self._backend, storage.BACKEND = storage.BACKEND, storage_memory.MemoryBackend()
+        self._max_bytes = CONFIG.image_storage_max_bytes
+
+    def tearDown(self):
+        images._image_dir = self._image_dir
+        storage.BACKEND = self._backend
+        CONFIG.image_storage_max_bytes = self._max_bytes
+        shutil.rmtree(self.tmp_dir)
+
+    def store(self, data):
+        """Store a plot like digaas.stats does, and return its digest"""
+        fd, filename = tempfile.mkstemp(dir=self.tmp_dir)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        digest, size = images.store(filename)
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(size, len(data))
+        storage.create_image(digest, size)
+        return digest
+
+    def stored_files(self):
+        return sorted(name for _, _, names in os.walk(images._image_dir) for name in names)
+
+
+class TestImageResource(ImageTestCase):
+
+    def setUp(self):
+        super(TestImageResource, self).setUp()
+        self.client = falcon.testing.TestClient(app.app)
+        self.digest = self.store(PLOT)
+        self.path = '/images/{0}'.format(self.digest)
+
+    def test_get(self):
+        result = self.client.simulate_get(self.path)
+        self.assertEqual(result.status, falcon.HTTP_200)
+        self.assertEqual(result.content, PLOT)
+        self.assertEqual(result.headers['Content-Type'], 'image/png')
+        self.assertEqual(result.headers['ETag'], '"{0}"'.format(self.digest))
+        self.assertIn('immutable', result.headers['Cache-Control'])
+
+    def test_if_none_match(self):
+        etag = self.client.simulate_get(self.path).headers['ETag']
+        for if_none_match in [etag, 'W/"other", ' + etag, '*']:
+            result = self.client.simulate_get(self.path, headers={'If-None-Match': if_none_match})
+            self.assertEqual(result.status, falcon.HTTP_304, if_none_match)
+            self.assertEqual(result.content, '')
+            self.assertEqual(result.headers['ETag'], etag)
+
+    def test_if_none_match_another_image(self):
+        result = self.client.simulate_get(self.path, headers={'If-None-Match': '"{0}"'.format(
+            'f' * 64)})
+        self.assertEqual(result.status, falcon.HTTP_200)
+        self.assertEqual(result.content, PLOT)
+
+    def test_not_stored(self):
+        result = self.client.simulate_get('/images/{0}'.format('0' * 64))
+        self.assertEqual(result.status, falcon.HTTP_404)
+
+
+class TestImageStore(ImageTestCase):
+
+    def test_same_plot_stored_once(self):
+        digest = self.store(PLOT)
+        self.assertEqual(self.store(PLOT), digest)
+        self.assertEqual(self.stored_files(), [digest + '.png'])
+        self.assertEqual(storage.BACKEND.image_bytes, len(PLOT))
+
+    def test_same_plot_counted_once(self):
+        # room for one plot, unless it's counted twice
+        CONFIG.image_storage_max_bytes = len(PLOT)
+        for backend in [storage_memory.MemoryBackend(),
+                        storage_sqlite.SqliteBackend(os.path.join(self.tmp_dir, 'digaas.db'))]:
+            storage.BACKEND = backend
+            digest = self.store(PLOT)
+            self.store(PLOT)
+            self.assertIsNotNone(images.open_image(digest), backend.name)
+            # another plot takes its place
+            other = self.store(OTHER_PLOT)
+            self.assertIsNone(images.open_image(digest), backend.name)
+            self.assertEqual(self.stored_files(), [other + '.png'], backend.name)
+            images.delete(other)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import unittest
+
+from digaas import pacing
+from digaas.config import CONFIG
+
+
+class TestTokenBucket(unittest.TestCase):
+    """Drives buckets on a clock of our own"""
+
+    def setUp(self):
+        self.now = 1000.0
+        self._monotonic, pacing.monotonic = pacing.monotonic, lambda: self.now
+
+    def tearDown(self):
+        pacing.monotonic = self._monotonic
+
+    def test_burst_then_rate(self):
+        bucket = pacing.TokenBucket(10, 2)
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertEqual(bucket.reserve(), 0.0)
+        # then each caller waits its turn, in the order they asked
+        self.assertAlmostEqual(bucket.reserve(), 0.1)
+        self.assertAlmostEqual(bucket.reserve(), 0.2)
+        self.assertAlmostEqual(bucket.reserve(), 0.3)
+
+    def test_refill(self):
+        bucket = pacing.TokenBucket(10, 2)
+        for _ in xrange(4):
+            bucket.reserve()
+        # the two reservations are paid back, and a token and a half refilled
+        self.now += 0.35
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertAlmostEqual(bucket.reserve(), 0.05)
+
+    def test_refill_stops_at_burst(self):
+        bucket = pacing.TokenBucket(10, 2)
+        self.now += 60
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1)
+
+
+class TestBudgets(unittest.TestCase):
+
+    def setUp(self):
+        self._qps, CONFIG.nameserver_qps = CONFIG.nameserver_qps, {
+            '192.0.2.1': 100, 'default': 20}
+        self._share = pacing._share
+        pacing._buckets.clear()
+
+    def tearDown(self):
+        CONFIG.nameserver_qps = self._qps
+        pacing.set_share(self._share)
+
+    def test_budgets(self):
+        self.assertEqual(pacing.get_bucket('192.0.2.1').rate, 100)
+        self.assertEqual(pacing.get_bucket('192.0.2.1').burst, 10)
+        self.assertEqual(pacing.get_bucket('192.0.2.2').rate, 20)
+        self.assertEqual(pacing.get_bucket('192.0.2.2').burst, 2)
+
+    def test_unpaced(self):
+        CONFIG.nameserver_qps = {}
+        self.assertIsNone(pacing.get_bucket('192.0.2.1'))
+        self.assertEqual(pacing.phase_offset('192.0.2.1', 60), 0.0)
+
+    def test_share(self):
+        pacing.set_share(0.25)
+        self.assertEqual(pacing.get_bucket('192.0.2.1').rate, 25)
+        # at least a token, however small the share
+        self.assertEqual(pacing.get_bucket('192.0.2.2').burst, 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
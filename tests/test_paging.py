@@ -0,0 +1,184 @@
+import itertools
+import json
+import unittest
+import zlib
+
+import falcon.testing
+
+from digaas import app
+from digaas import model
+from digaas import storage
+from digaas import storage_memory
+from digaas import writebehind
+from digaas.consts import Status
+
+# small pages, so every walk below crosses several of them
+PAGE_SIZE = 3
+
+
+def make_poll_request(start_time, **kwargs):
+    data = dict(
+        query_name = 'example.com',
+        nameserver = '192.0.2.1',
+        serial = 1,
+        start_time = start_time,
+        condition = 'serial_not_lower',
+        timeout = 30,
+        frequency = 1,
+        status = Status.ACCEPTED)
+    data.update(kwargs)
+    return model.PollRequest(**data)
+
+
+class PagingTestCase(unittest.TestCase):
+    """Stores requests in the memory backend, many of them with the same
+    start_time"""
+
+    def setUp(self):
+        self._storage = storage.BACKEND, storage.WRITER, storage.TIME_RANGE_PAGE_SIZE
+        storage.BACKEND = storage_memory.MemoryBackend()
+        storage.WRITER = writebehind.WriteBehind(storage.get_backend, 1000, 0.001)
+        storage.TIME_RANGE_PAGE_SIZE = PAGE_SIZE
+
+        start_times = [100.0] * 8 + [101.0, 102.0, 102.0] + [103.0] * 4
+        self.poll_reqs = [make_poll_request(start_time, nameserver='192.0.2.{0}'.format(i % 2))
+                          for i, start_time in enumerate(start_times)]
+        storage.create_poll_requests(self.poll_reqs)
+        for i, poll_req in enumerate(self.poll_reqs):
+            if i % 3:
+                poll_req.status = Status.COMPLETED
+                poll_req.duration = float(i)
+            else:
+                poll_req.status = Status.ERROR
+            if i % 4 == 0:
+                poll_req.condition = 'zone_removed'
+            storage.update_poll_request(poll_req)
+        storage.WRITER.submit([]).get()
+
+    def tearDown(self):
+        storage.BACKEND, storage.WRITER, storage.TIME_RANGE_PAGE_SIZE = self._storage
+
+    def in_order(self, poll_reqs):
+        return sorted(poll_reqs, key=lambda poll_req: (poll_req.start_time, poll_req.id))
+
+
+class TestStoragePaging(PagingTestCase):
+
+    def test_time_range_cursor_round_trip(self):
+        everything = list(storage.iter_time_range(0, 1000))
+        self.assertEqual(len(everything), len(self.poll_reqs))
+        start_times = [storage.parse_time_range_item(item)[1] for item in everything]
+        self.assertEqual(start_times, sorted(start_times))
+        for limit in xrange(1, len(everything) + 1):
+            items = []
+            cursor = None
+            while True:
+                cursor = storage.TimeRangeCursor.parse(
+                    str(cursor or storage.TimeRangeCursor.starting_at(0)))
+                page = list(itertools.islice(storage.iter_time_range(0, 1000, cursor), limit))
+                items.extend(page)
+                if len(page) < limit:
+                    break
+            self.assertEqual(items, everything, "limit={0}".format(limit))
+
+    def test_time_range_stops_at_hi(self):
+        items = list(storage.iter_time_range(100.0, 102.0))
+        self.assertEqual(len(items), 11)
+
+    def test_find_cursor_round_trip(self):
+        for statuses in [None, [Status.COMPLETED], [Status.ERROR, Status.COMPLETED]]:
+            expected = self.in_order(poll_req for poll_req in self.poll_reqs
+                                     if statuses is None or poll_req.status in statuses)
+            for limit in xrange(1, len(self.poll_reqs) + 1):
+                found = []
+                text = None
+                while True:
+                    cursor = storage.find_poll_requests_cursor(0, text)
+                    page = list(itertools.islice(storage.find_poll_requests(
+                        0, 1000, statuses=statuses, cursor=cursor), limit))
+                    found.extend(page)
+                    text = str(cursor)
+                    if len(page) < limit:
+                        break
+                self.assertEqual([poll_req.id for poll_req in found],
+                                 [poll_req.id for poll_req in expected],
+                                 "statuses={0} limit={1}".format(statuses, limit))
+
+    def test_invalid_cursors(self):
+        for text in ['not base64!', 'bm90IGEgY3Vyc29y']:
+            self.assertRaises(ValueError, storage.FindCursor.parse, text)
+            self.assertRaises(ValueError, storage.TimeRangeCursor.parse, text)
+
+
+class TestHandlerPaging(PagingTestCase):
+
+    def setUp(self):
+        super(TestHandlerPaging, self).setUp()
+        self.client = falcon.testing.TestClient(app.app)
+
+    def get_pages(self, path, params, read):
+        """Follow X-Next-Cursor from page to page, and return what read()
+        makes of each page, added together"""
+        pages = []
+        params = dict(params)
+        while True:
+            result = self.client.simulate_get(path, params=params)
+            self.assertEqual(result.status, falcon.HTTP_200)
+            pages.append(read(result))
+            cursor = result.headers.get('X-Next-Cursor')
+            if cursor is None:
+                return sum(pages, [])
+            params['cursor'] = cursor
+
+    def test_stats_file_limit(self):
+        params = dict(start_time=0, end_time=1000)
+        everything = self.client.simulate_get('/stats-file', params=params).text.splitlines()
+        self.assertEqual(len(everything), len(self.poll_reqs))
+        for limit in [1, 2, 5, len(self.poll_reqs)]:
+            params['limit'] = limit
+            lines = self.get_pages('/stats-file', params, lambda result: result.text.splitlines())
+            self.assertEqual(lines, everything, "limit={0}".format(limit))
+
+    def test_find_limit(self):
+        expected = [poll_req.id for poll_req in self.in_order(self.poll_reqs)]
+        for limit in [1, 2, 5, len(self.poll_reqs)]:
+            ids = self.get_pages('/poll_requests', dict(limit=limit),
+                                 lambda result: [r['id'] for r in json.loads(result.text)])
+            self.assertEqual(ids, expected, "limit={0}".format(limit))
+
+    def test_find_default_limit(self):
+        result = self.client.simulate_get('/poll_requests')
+        self.assertEqual(len(json.loads(result.text)), len(self.poll_reqs))
+        self.assertNotIn('X-Next-Cursor', result.headers)
+
+    def test_bad_limits_and_cursors(self):
+        for path, params in [
+                ('/stats-file', dict(start_time=0, end_time=1000, limit=0)),
+                ('/stats-file', dict(start_time=0, end_time=1000, cursor='bad!')),
+                ('/stats-file', dict(start_time=0, end_time=1000, limit=1,
+                                     group_by='nameserver')),
+                ('/poll_requests', dict(limit=app.MAX_FIND_LIMIT + 1)),
+                ('/poll_requests', dict(cursor='bad!'))]:
+            result = self.client.simulate_get(path, params=params)
+            self.assertEqual(result.status, falcon.HTTP_400, (path, params))
+
+    def test_stats_file_gzip(self):
+        params = dict(start_time=0, end_time=1000)
+        plain = self.client.simulate_get('/stats-file', params=params)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        gzipped = self.client.simulate_get('/stats-file', params=params,
+                                           headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(gzipped.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(zlib.decompress(gzipped.content, 16 + zlib.MAX_WBITS), plain.content)
+
+    def test_stats_file_gzip_page(self):
+        params = dict(start_time=0, end_time=1000, limit=2)
+        plain = self.client.simulate_get('/stats-file', params=params)
+        gzipped = self.client.simulate_get('/stats-file', params=params,
+                                           headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(zlib.decompress(gzipped.content, 16 + zlib.MAX_WBITS), plain.content)
+        self.assertEqual(gzipped.headers['X-Next-Cursor'], plain.headers['X-Next-Cursor'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+import random
+import time
+import unittest
+
+import gevent
+import dns.rcode
+
+from digaas import digdig
+from digaas import model
+from digaas import poll
+from digaas.consts import Status
+
+NAMESERVER = '192.0.2.1'
+
+
+def make_poll_request(**kwargs):
+    data = dict(
+        query_name = 'example.com',
+        nameserver = NAMESERVER,
+        serial = 1,
+        start_time = time.time(),
+        condition = 'serial_not_lower',
+        timeout = 30,
+        frequency = 1)
+    data.update(kwargs)
+    return model.PollRequest(**data)
+
+
+class PollTestCase(unittest.TestCase):
+    """Answers queries from self.answer instead of a nameserver, and records
+    finished requests instead of storing them"""
+
+    def setUp(self):
+        self.queries = []
+        self.answer = digdig.Answer(dns.rcode.NOERROR, 1, [], 0)
+        self.completed = []
+        self._query, digdig.query = digdig.query, self.query
+        self._complete, poll._complete = poll._complete, self.complete
+
+    def tearDown(self):
+        digdig.query = self._query
+        poll._complete = self._complete
+
+    def query(self, name, nameserver, rdatatype, timeout, transport):
+        self.queries.append((name, nameserver, rdatatype, transport))
+        return self.answer() if callable(self.answer) else self.answer
+
+    def complete(self, poll_req, end_time):
+        poll.finish_request(poll_req, end_time)
+        self.completed.append(poll_req)
+
+    def answer_serial(self, serial):
+        self.answer = digdig.Answer(dns.rcode.NOERROR, 1, [], serial)
+
+
+class TestWatcher(PollTestCase):
+    """Drives a watcher by hand, on a clock of our own"""
+
+    def setUp(self):
+        super(TestWatcher, self).setUp()
+        self.now = 1000.0
+        self._monotonic, poll.monotonic = poll.monotonic, lambda: self.now
+        self.watcher = poll.Watcher(('example.com', NAMESERVER, 'SOA', 'udp'))
+
+    def tearDown(self):
+        poll.monotonic = self._monotonic
+        super(TestWatcher, self).tearDown()
+
+    def add(self, poll_req, watcher=None):
+        task = poll._PollTask(poll_req, self.now, self.now + poll_req.timeout, NAMESERVER)
+        (watcher or self.watcher).add(task, self.now)
+        return task
+
+    def test_one_query_per_tick(self):
+        for _ in xrange(50):
+            self.add(make_poll_request(serial=10))
+        self.watcher.probe()
+        self.assertEqual(len(self.queries), 1)
+        self.now += 0.5
+        self.watcher.probe()
+        self.assertEqual(len(self.queries), 1)
+        self.now += 0.5
+        self.assertEqual(self.watcher.next_due, self.now)
+        self.watcher.probe()
+        self.assertEqual(len(self.queries), 2)
+        self.assertEqual(self.queries[0], ('example.com', NAMESERVER, 'SOA', 'udp'))
+        self.assertEqual(self.completed, [])
+        self.assertEqual(self.watcher.size, 50)
+
+    def test_ticks_at_the_smallest_frequency(self):
+        self.add(make_poll_request(serial=10, frequency=5))
+        self.add(make_poll_request(serial=10, frequency=2))
+        self.watcher.probe()
+        self.now += 2
+        self.watcher.probe()
+        self.assertEqual(len(self.queries), 2)
+
+    def test_finishes_in_serial_order(self):
+        serials = range(1, 11)
+        random.Random(0).shuffle(serials)
+        for serial in serials:
+            self.add(make_poll_request(serial=serial))
+
+        self.answer_serial(4)
+        self.watcher.probe()
+        self.assertEqual([r.serial for r in self.completed], [1, 2, 3, 4])
+        self.now += 1
+        self.answer_serial(10)
+        self.watcher.probe()
+        self.assertEqual([r.serial for r in self.completed], range(1, 11))
+        self.assertEqual(len(self.queries), 2)
+        for poll_req in self.completed:
+            self.assertEqual(poll_req.status, Status.COMPLETED)
+        self.assertEqual(self.watcher.size, 0)
+        self.assertIsNone(self.watcher.next_due)
+
+    def test_timeout_gives_error(self):
+        self.add(make_poll_request(serial=10, timeout=3))
+        self.add(make_poll_request(serial=10, timeout=5))
+        self.watcher.probe()
+        self.now += 3
+        self.watcher.probe()
+        self.assertEqual(len(self.completed), 1)
+        self.assertEqual(self.completed[0].status, Status.ERROR)
+        self.assertIsNone(self.completed[0].duration)
+        self.now += 2
+        self.watcher.probe()
+        self.assertEqual(len(self.completed), 2)
+        # there's nothing left to query for
+        self.assertEqual(len(self.queries), 2)
+
+    def test_finished_tasks_are_skipped(self):
+        early = self.add(make_poll_request(serial=1, timeout=5))
+        self.add(make_poll_request(serial=10, timeout=10))
+        self.answer_serial(1)
+        self.watcher.probe()
+        self.assertTrue(early.done)
+        # still on the deadline heap, until it reaches the top
+        self.assertIn(early, [task for _, _, task in self.watcher._deadlines])
+        self.now += 5
+        self.watcher.probe()
+        self.assertEqual(len(self.completed), 1)
+        self.assertEqual(self.watcher.size, 1)
+
+    def test_late_joiner_is_probed_now(self):
+        self.add(make_poll_request(serial=10, frequency=10))
+        self.watcher.probe()
+        self.now += 3
+        self.assertEqual(self.watcher.next_due, 1010.0)
+        self.add(make_poll_request(serial=10, frequency=10))
+        self.assertEqual(self.watcher.next_due, self.now)
+        self.watcher.probe()
+        self.assertEqual(len(self.queries), 2)
+
+    def test_record_requests_share_an_answer(self):
+        watcher = poll.Watcher(('www.example.com', NAMESERVER, 'A', 'udp'))
+        for _ in xrange(5):
+            self.add(make_poll_request(query_name='www.example.com', rdatatype='A',
+                                       condition='data=192.0.2.10'), watcher)
+        self.add(make_poll_request(query_name='www.example.com', rdatatype='A',
+                                   condition='data=192.0.2.11'), watcher)
+        # each distinct expectation is checked once
+        self.assertEqual(len(watcher._data), 2)
+        self.answer = digdig.Answer(dns.rcode.NOERROR, 1, ['192.0.2.10'], None)
+        watcher.probe()
+        self.assertEqual(len(self.queries), 1)
+        self.assertEqual(len(self.completed), 5)
+        self.assertEqual(watcher.size, 1)
+
+
+class TestScheduler(PollTestCase):
+
+    def setUp(self):
+        super(TestScheduler, self).setUp()
+        self.scheduler = poll.Scheduler(10)
+
+    def wait_for(self, n, timeout=5):
+        deadline = time.time() + timeout
+        while len(self.completed) < n and time.time() < deadline:
+            gevent.sleep(0.01)
+        self.assertEqual(len(self.completed), n)
+
+    def test_coalesced_requests(self):
+        # the zone's serial goes up by one with every query
+        def answer():
+            return digdig.Answer(dns.rcode.NOERROR, 1, [], len(self.queries))
+        self.answer = answer
+        for serial in [5, 3, 1, 4, 2] * 4:
+            self.scheduler.add(make_poll_request(serial=serial, frequency=0.05))
+        self.wait_for(20)
+        self.assertEqual(len(self.queries), 5)
+        self.assertEqual([r.serial for r in self.completed], sorted([1, 2, 3, 4, 5] * 4))
+        self.assertEqual(set(self.queries), set([('example.com', NAMESERVER, 'SOA', 'udp')]))
+        self.assertEqual(self.scheduler._watchers, {})
+
+    def test_timeout_gives_error(self):
+        self.scheduler.add(make_poll_request(serial=10, frequency=0.05, timeout=0))
+        self.wait_for(1)
+        self.assertEqual(self.completed[0].status, Status.ERROR)
+
+    def test_late_joiner_is_probed_now(self):
+        self.answer_serial(1)
+        self.scheduler.add(make_poll_request(serial=5, frequency=60))
+        gevent.sleep(0.05)
+        self.assertEqual(len(self.queries), 1)
+        self.scheduler.add(make_poll_request(serial=1, frequency=60))
+        self.wait_for(1)
+        self.assertEqual(len(self.queries), 2)
+        self.assertEqual(self.completed[0].serial, 1)
+
+    def test_bad_condition_gives_error(self):
+        self.scheduler.add(make_poll_request(query_name='www.example.com', rdatatype='A',
+                                             condition='data=not-an-ip'))
+        self.assertEqual(self.completed[0].status, Status.ERROR)
+        self.assertEqual(self.queries, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -218,6 +218,73 @@ class TestPolling(unittest.TestCase):
         self.assertEqual(resp.json()['status'], 'COMPLETED')
         self.assertEqual(resp.json()['id'], id)
 
+    def test_poll_for_record_data_by_zone_transfer(self):
+        zone_name = datagen.random_zone_name()
+        serial = 123456
+        ip = datagen.random_ip()
+        tools.add_new_zone_to_bind(zone_name, serial=serial, ip=ip)
+
+        new_ip = datagen.random_ip()
+        assert new_ip != ip
+        resp = self.client.post_poll_requests([dict(
+            query_name = zone_name,
+            zone = zone_name,
+            nameserver = NAMESERVER,
+            serial = 0,
+            condition = 'data=%s' % new_ip,
+            rdatatype = 'A',
+            start_time = time.time(),
+            timeout = 15,
+            frequency = 1)])
+        self.assertEqual(resp.status_code, 202)
+        id = resp.json()[0]['id']
+
+        # the serial has to change for the zone to be transferred again
+        min_duration = 2
+        time.sleep(min_duration)
+        tools.update_zone(zone_name, serial + 1, new_ip)
+
+        self.client.wait_for_completed_poll_request(id)
+        resp = self.client.get_poll_request(id)
+        self.assertGreater(resp.json()['duration'], min_duration)
+        self.assertEqual(resp.json()['zone'], zone_name)
+        self.assertEqual(resp.json()['status'], 'COMPLETED')
+
+    def test_poll_for_existing_record_by_zone_transfer(self):
+        zone_name = datagen.random_zone_name()
+        serial = 123456
+        ip = datagen.random_ip()
+        tools.add_new_zone_to_bind(zone_name, serial=serial, ip=ip)
+
+        def post(ip):
+            resp = self.client.post_poll_requests([dict(
+                query_name = zone_name,
+                zone = zone_name,
+                nameserver = NAMESERVER,
+                serial = 0,
+                condition = 'data=%s' % ip,
+                rdatatype = 'A',
+                start_time = time.time(),
+                timeout = 15,
+                frequency = 1)])
+            self.assertEqual(resp.status_code, 202)
+            return resp.json()[0]['id']
+
+        # keep the zone's watcher alive with a request that won't finish
+        new_ip = datagen.random_ip()
+        assert new_ip != ip
+        waiting_id = post(new_ip)
+        time.sleep(2)
+
+        # the zone was transferred already, and its serial won't change, but
+        # the record is there
+        id = post(ip)
+        self.client.wait_for_completed_poll_request(id)
+        resp = self.client.get_poll_request(id)
+        self.assertEqual(resp.json()['status'], 'COMPLETED')
+        self.assertEqual(self.client.get_poll_request(waiting_id).json()['status'],
+                         'ACCEPTED')
+
     def test_timeout_on_polling_for_specific_record_data(self):
         # add a random zone to the nameserver with a known serial
         zone_name = datagen.random_zone_name()
@@ -257,3 +324,238 @@ class TestPolling(unittest.TestCase):
         self.assertEqual(resp.json()['rdatatype'], "A")
         self.assertEqual(resp.json()['status'], 'ERROR')
         self.assertEqual(resp.json()['id'], id)
+
+    def test_poll_for_rrset_and_absent_records(self):
+        zone_name = datagen.random_zone_name()
+        tools.add_new_zone_to_bind(zone_name)
+
+        # both of these are already true. names are compared without case.
+        common = dict(
+            nameserver = NAMESERVER,
+            serial = 0,
+            start_time = time.time(),
+            timeout = 15,
+            frequency = 1)
+        resp = self.client.post_poll_requests([
+            dict(common, query_name = zone_name, rdatatype = 'NS',
+                 condition = self.client.RRSET_EQUALS + 'NS1.' + zone_name.upper()),
+            dict(common, query_name = 'missing.' + zone_name, rdatatype = 'A',
+                 condition = self.client.ABSENT),
+        ])
+        self.assertEqual(resp.status_code, 202)
+
+        for item in resp.json():
+            self.client.wait_for_completed_poll_request(item['id'])
+            resp = self.client.get_poll_request(item['id'])
+            self.assertEqual(resp.json()['status'], 'COMPLETED')
+
+    def test_invalid_record_data(self):
+        resp = self.client.post_poll_request(
+            query_name = datagen.random_zone_name(),
+            nameserver = NAMESERVER,
+            serial = 0,
+            condition = 'data=not-an-ip',
+            rdatatype = 'A',
+            start_time = time.time(),
+            timeout = 15,
+            frequency = 1)
+        self.assertEqual(resp.status_code, 400)
+
+    @unittest.skipUnless(tools.NOTIFY_PORT, "set DIGAAS_NOTIFY_PORT to digaas's notify_port")
+    def test_notify_finishes_poll_request(self):
+        zone_name = datagen.random_zone_name()
+        serial = 123456
+        tools.add_new_zone_to_bind(zone_name, serial=serial)
+
+        # with this frequency, only the NOTIFY can finish it in time
+        resp = self.client.post_poll_request(
+            query_name = zone_name,
+            nameserver = NAMESERVER,
+            serial = serial + 1,
+            condition = self.client.SERIAL_NOT_LOWER,
+            start_time = time.time(),
+            timeout = 30,
+            frequency = 20)
+        self.assertEqual(resp.status_code, 202)
+        id = resp.json()['id']
+
+        time.sleep(2)
+        tools.touch_zone(zone_name)
+        notify_time = time.time()
+        tools.send_notify(zone_name, serial + 1, tools.NOTIFY_PORT)
+
+        resp = self.client.get_poll_request(id, wait=5)
+        self.assertEqual(resp.json()['status'], 'COMPLETED')
+        self.assertAlmostEqual(resp.json()['start_time'] + resp.json()['duration'],
+                               notify_time, delta=0.5)
+
+    def test_poll_several_nameservers(self):
+        zone_name = datagen.random_zone_name()
+        serial = 123456
+        tools.add_new_zone_to_bind(zone_name, serial=serial)
+
+        resp = self.client.post_poll_requests([dict(
+            query_name = zone_name,
+            nameservers = [NAMESERVER],
+            quorum = 1,
+            serial = serial + 1,
+            condition = self.client.SERIAL_NOT_LOWER,
+            start_time = time.time(),
+            timeout = 15,
+            frequency = 1)])
+        self.assertEqual(resp.status_code, 202)
+        id = resp.json()[0]['id']
+
+        min_duration = 2
+        time.sleep(min_duration)
+        tools.touch_zone(zone_name)
+
+        self.client.wait_for_completed_poll_request(id)
+        resp = self.client.get_poll_request(id)
+        self.assertEqual(resp.json()['status'], 'COMPLETED')
+        self.assertEqual(resp.json()['nameservers'], [NAMESERVER])
+        self.assertGreater(resp.json()['results'][NAMESERVER], min_duration)
+        self.assertEqual(resp.json()['duration'], resp.json()['results'][NAMESERVER])
+        self.assertEqual(resp.json()['first_duration'], resp.json()['duration'])
+        self.assertEqual(resp.json()['quorum_duration'], resp.json()['duration'])
+
+    def test_poll_over_tcp(self):
+        zone_name = datagen.random_zone_name()
+        serial = 123456
+        tools.add_new_zone_to_bind(zone_name, serial=serial)
+
+        resp = self.client.post_poll_request(
+            query_name = zone_name,
+            nameserver = NAMESERVER,
+            serial = serial + 1,
+            condition = self.client.SERIAL_NOT_LOWER,
+            start_time = time.time(),
+            timeout = 15,
+            frequency = 1,
+            transport = 'tcp')
+        self.assertEqual(resp.status_code, 202)
+        id = resp.json()['id']
+
+        min_duration = 2
+        time.sleep(min_duration)
+        tools.touch_zone(zone_name)
+
+        self.client.wait_for_completed_poll_request(id)
+        resp = self.client.get_poll_request(id)
+        self.assertGreater(resp.json()['duration'], min_duration)
+        self.assertEqual(resp.json()['transport'], 'tcp')
+        self.assertEqual(resp.json()['status'], 'COMPLETED')
+
+    def test_invalid_transport(self):
+        resp = self.client.post_poll_request(
+            query_name = datagen.random_zone_name(),
+            nameserver = NAMESERVER,
+            serial = 1,
+            condition = self.client.SERIAL_NOT_LOWER,
+            start_time = time.time(),
+            timeout = 15,
+            frequency = 1,
+            transport = 'carrier_pigeon')
+        self.assertEqual(resp.status_code, 400)
+
+    def test_bulk_poll_requests(self):
+        # add a random zone to the nameserver with a known serial
+        zone_name = datagen.random_zone_name()
+        serial = 123456
+        tools.add_new_zone_to_bind(zone_name, serial=serial)
+
+        # submit one request that's already satisfied, and one invalid request
+        valid = dict(
+            query_name = zone_name,
+            nameserver = NAMESERVER,
+            serial = serial,
+            condition = self.client.SERIAL_NOT_LOWER,
+            start_time = time.time(),
+            timeout = 15,
+            frequency = 1)
+        invalid = dict(valid, condition='not_a_condition')
+        resp = self.client.post_poll_requests([valid, invalid])
+        self.assertEqual(resp.status_code, 202)
+        self.assertEqual(len(resp.json()), 2)
+        self.assertIn('id', resp.json()[0])
+        self.assertIn('not_a_condition', resp.json()[1]['message'])
+        id = resp.json()[0]['id']
+
+        # wait for the digaas to finish polling
+        self.client.wait_for_completed_poll_request(id)
+        resp = self.client.get_poll_request(id)
+        self.assertEqual(resp.json()['query_name'], zone_name)
+        self.assertEqual(resp.json()['serial'], serial)
+        self.assertEqual(resp.json()['status'], 'COMPLETED')
+
+    def test_lookup_poll_requests(self):
+        zone_name = datagen.random_zone_name()
+        serial = 123456
+        tools.add_new_zone_to_bind(zone_name, serial=serial)
+
+        # one request that completes right away, and one that never will
+        resp = self.client.post_poll_requests([
+            dict(query_name=zone_name, nameserver=NAMESERVER, serial=serial,
+                 condition=self.client.SERIAL_NOT_LOWER, start_time=time.time(),
+                 timeout=15, frequency=1),
+            dict(query_name=zone_name, nameserver=NAMESERVER, serial=serial + 1,
+                 condition=self.client.SERIAL_NOT_LOWER, start_time=time.time(),
+                 timeout=15, frequency=1),
+        ])
+        self.assertEqual(resp.status_code, 202)
+        done_id, pending_id = [item['id'] for item in resp.json()]
+        self.client.wait_for_completed_poll_request(done_id)
+
+        resp = self.client.lookup_poll_requests([done_id, pending_id, 'nope'])
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([item['id'] for item in resp.json()],
+                         [done_id, pending_id, 'nope'])
+        self.assertEqual(resp.json()[0]['status'], 'COMPLETED')
+        self.assertEqual(resp.json()[1]['status'], 'ACCEPTED')
+        self.assertIn('not found', resp.json()[2]['message'])
+
+        # only the unfinished requests
+        resp = self.client.lookup_poll_requests([done_id, pending_id, 'nope'],
+                                                status='ACCEPTED')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([item['id'] for item in resp.json()], [pending_id])
+
+    def test_find_poll_requests(self):
+        zone_name = datagen.random_zone_name()
+        serial = 123456
+        tools.add_new_zone_to_bind(zone_name, serial=serial)
+
+        # one request that completes right away, and one that never will
+        start_time = time.time()
+        resp = self.client.post_poll_requests([
+            dict(query_name=zone_name, nameserver=NAMESERVER, serial=serial,
+                 condition=self.client.SERIAL_NOT_LOWER, start_time=start_time,
+                 timeout=15, frequency=1),
+            dict(query_name=zone_name, nameserver=NAMESERVER, serial=serial + 1,
+                 condition=self.client.SERIAL_NOT_LOWER, start_time=start_time + 1,
+                 timeout=15, frequency=1),
+        ])
+        self.assertEqual(resp.status_code, 202)
+        done_id, pending_id = [item['id'] for item in resp.json()]
+        self.client.wait_for_completed_poll_request(done_id)
+
+        resp = self.client.find_poll_requests(query_name=zone_name)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([item['id'] for item in resp.json()], [done_id, pending_id])
+
+        resp = self.client.find_poll_requests(nameserver=NAMESERVER, status='ACCEPTED',
+                                              since=start_time)
+        self.assertEqual(resp.status_code, 200)
+        ids = [item['id'] for item in resp.json()]
+        self.assertIn(pending_id, ids)
+        self.assertNotIn(done_id, ids)
+
+        # a page at a time
+        resp = self.client.find_poll_requests(query_name=zone_name, limit=1)
+        self.assertEqual([item['id'] for item in resp.json()], [done_id])
+        resp = self.client.find_poll_requests(query_name=zone_name, limit=1,
+                                              cursor=resp.headers['X-Next-Cursor'])
+        self.assertEqual([item['id'] for item in resp.json()], [pending_id])
+
+        resp = self.client.find_poll_requests(limit=0)
+        self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,167 @@
+import StringIO
+import time
+import unittest
+
+import gevent.event
+
+from digaas import model
+from digaas import shards
+from digaas import storage
+from digaas import storage_memory
+from digaas import writebehind
+from digaas.consts import Status
+
+
+def make_poll_request(**kwargs):
+    data = dict(
+        query_name = 'example.com',
+        nameserver = '192.0.2.1',
+        serial = 1,
+        start_time = time.time(),
+        condition = 'serial_not_lower',
+        timeout = 30,
+        frequency = 1,
+        status = Status.ACCEPTED)
+    data.update(kwargs)
+    return model.PollRequest(**data)
+
+
+class RecordingShard(object):
+
+    def __init__(self):
+        self.added = []
+
+    def add(self, poll_reqs, accepted_at):
+        self.added.append((poll_reqs, accepted_at))
+
+
+class FakeProcess(object):
+
+    def __init__(self):
+        self.stdin = StringIO.StringIO()
+
+
+class TestSharding(unittest.TestCase):
+
+    def setUp(self):
+        self._shards = shards._shards, shards._started
+        shards._shards = [RecordingShard() for _ in xrange(4)]
+        shards._started = gevent.event.Event()
+        shards._started.set()
+
+    def tearDown(self):
+        shards._shards, shards._started = self._shards
+
+    def test_same_watcher_same_shard(self):
+        index = shards.shard_index(make_poll_request(), 4)
+        for poll_req in [make_poll_request(serial=7, condition='zone_removed'),
+                         make_poll_request(nameservers=['192.0.2.1', '192.0.2.2'])]:
+            self.assertEqual(shards.shard_index(poll_req, 4), index)
+
+    def test_zone_requests_share_a_shard(self):
+        index = shards.shard_index(make_poll_request(zone='example.com'), 4)
+        for i in xrange(20):
+            poll_req = make_poll_request(query_name='host{0}.example.com'.format(i),
+                                         rdatatype='A', condition='data=192.0.2.10',
+                                         zone='example.com')
+            self.assertEqual(shards.shard_index(poll_req, 4), index)
+
+    def test_spread(self):
+        indexes = set(shards.shard_index(make_poll_request(
+            query_name='zone{0}.example.com'.format(i), nameserver='192.0.2.{0}'.format(i % 3)), 4)
+            for i in xrange(100))
+        self.assertEqual(indexes, set(xrange(4)))
+
+    def test_dispatch(self):
+        poll_reqs = [make_poll_request(query_name='zone{0}.example.com'.format(i))
+                     for i in xrange(20)]
+        shards.dispatch(poll_reqs, 1000.0)
+        for i, shard in enumerate(shards._shards):
+            expected = [poll_req for poll_req in poll_reqs if shards.shard_index(poll_req, 4) == i]
+            self.assertEqual(shard.added, [(expected, 1000.0)] if expected else [])
+
+
+class TestLines(unittest.TestCase):
+
+    def test_line_round_trip(self):
+        accepted_at = time.time()
+        for poll_req in [
+                make_poll_request(),
+                # values that would break a line, if they weren't encoded
+                make_poll_request(query_name='caf\xc3\xa9.example.com', serial=10,
+                                  start_time=1000.1, status=Status.COMPLETED, duration=0.1),
+                make_poll_request(nameservers=['192.0.2.1', '192.0.2.10'],
+                                  results={'192.0.2.1': 1.0, '192.0.2.10': None}),
+                make_poll_request(query_name='www.example.com', rdatatype='A',
+                                  condition='data=192.0.2.10', zone='example.com',
+                                  transport='tcp')]:
+            line = shards.fmt_line(poll_req, accepted_at)
+            self.assertTrue(line.endswith('\n'))
+            self.assertEqual(line.count('\n'), 1)
+            parsed, parsed_accepted_at = shards.parse_line(line)
+            self.assertEqual(parsed_accepted_at, accepted_at)
+            self.assertEqual(parsed.to_dict(), poll_req.to_dict())
+
+    def test_newline_in_the_stored_value(self):
+        # the serial packs to a newline
+        poll_req = make_poll_request(serial=10)
+        self.assertIn('\n', storage.fmt_poll_request_value(poll_req))
+        parsed, _ = shards.parse_line(shards.fmt_line(poll_req, 1000.0))
+        self.assertEqual(parsed.serial, 10)
+
+    def test_notify_line_round_trip(self):
+        line = shards.NOTIFY_PREFIX + storage.fmt_value('example.com', '192.0.2.1', 7, 1000.5) \
+            + '\n'
+        self.assertEqual(shards.parse_notify_line(line), ('example.com', '192.0.2.1', 7, 1000.5))
+
+
+class TestReplay(unittest.TestCase):
+    """A restarted child gets the requests that are still ACCEPTED, and then
+    what was sent while it was down"""
+
+    def setUp(self):
+        self._storage = storage.BACKEND, storage.WRITER
+        storage.BACKEND = storage_memory.MemoryBackend()
+        storage.WRITER = writebehind.WriteBehind(storage.get_backend, 1000, 0.001)
+        self.shard = shards._Shard(0, 1)
+        self.shard.proc = FakeProcess()
+        self.shard.down = False
+
+    def tearDown(self):
+        storage.BACKEND, storage.WRITER = self._storage
+
+    def written(self):
+        return [shards.parse_line(line)[0].id
+                for line in self.shard.proc.stdin.getvalue().splitlines()
+                if not line.startswith(shards.NOTIFY_PREFIX)]
+
+    def test_replay(self):
+        poll_reqs = [make_poll_request() for _ in xrange(3)]
+        storage.create_poll_requests(poll_reqs)
+        self.shard.add(poll_reqs[:2], time.time())
+        self.assertEqual(self.written(), [poll_req.id for poll_req in poll_reqs[:2]])
+
+        # the child dies after finishing the first request
+        self.shard.down = True
+        poll_reqs[0].status = Status.COMPLETED
+        storage.update_poll_request(poll_reqs[0])
+        self.shard.add(poll_reqs[2:], time.time())
+        notify_line = shards.NOTIFY_PREFIX + 'example.com 192.0.2.1 2 1000.0\n'
+        self.shard.send(notify_line)
+
+        self.shard.proc = FakeProcess()
+        self.shard._replay()
+        self.assertFalse(self.shard.down)
+        self.assertEqual(sorted(self.written()), sorted(r.id for r in poll_reqs[1:]))
+        self.assertTrue(self.shard.proc.stdin.getvalue().endswith(notify_line))
+        self.assertNotIn(poll_reqs[0].id, self.shard._sent)
+
+    def test_expired_requests_are_forgotten(self):
+        poll_req = make_poll_request(timeout=1)
+        self.shard.add([poll_req], time.time() - 1 - shards.REPLAY_GRACE_SECONDS)
+        self.shard.add([], time.time())
+        self.assertEqual(self.shard._sent, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
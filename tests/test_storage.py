@@ -0,0 +1,325 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import redis
+
+from digaas.config import CONFIG
+from digaas import model
+from digaas import storage
+from digaas import storage_memory
+from digaas import storage_redis
+from digaas import storage_sqlite
+
+# the redis database the tests may wipe, apart from the one digaas uses
+REDIS_TEST_DB = 15
+
+
+class TestBackendParity(unittest.TestCase):
+    """Makes the same writes to each storage backend, and checks they all read
+    back the same. Redis is only included if a server is running."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.backends = [
+            storage_memory.MemoryBackend(),
+            storage_sqlite.SqliteBackend(os.path.join(self.tmp_dir, 'digaas.db')),
+        ]
+        client = redis.StrictRedis(host=CONFIG.redis_host or '127.0.0.1',
+                                   port=CONFIG.redis_port or 6379,
+                                   password=CONFIG.redis_password, db=REDIS_TEST_DB)
+        try:
+            client.flushdb()
+        except redis.ConnectionError:
+            pass
+        else:
+            self.backends.append(storage_redis.RedisBackend(client))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, writes):
+        for backend in self.backends:
+            backend.write(writes)
+
+    def assertSame(self, read):
+        """Check read(backend) is the same for every backend, and return it"""
+        results = [(backend.name, read(backend)) for backend in self.backends]
+        for name, result in results[1:]:
+            self.assertEqual(result, results[0][1], "{0} read {1!r}, but {2} read {3!r}"
+                             .format(name, result, results[0][0], results[0][1]))
+        return results[0][1]
+
+    def test_zrangebyscore_pages_through_equal_scores(self):
+        # runs of 7 members with the same score, so pages end inside them
+        self.write([('zadd', ('set', 1000.0 + i // 7, 'member-%03d' % (i * 37 % 100)))
+                    for i in xrange(100)])
+        self.write([('zrem', ('set', 'member-%03d' % i)) for i in xrange(0, 100, 10)])
+
+        def read_pages(backend):
+            items = []
+            start = 0
+            while True:
+                page = list(backend.zrangebyscore('set', 1002, 1010, start, 4))
+                items.extend(page)
+                if len(page) < 4:
+                    return items
+                start += len(page)
+
+        items = self.assertSame(read_pages)
+        self.assertEqual(items, sorted(items, key=lambda item: (item[1], item[0])))
+        self.assertEqual(len(items), 63 - 6)
+        self.assertEqual(items, self.assertSame(
+            lambda backend: list(backend.zrangebyscore('set', 1002, 1010, 0, 1000))))
+
+    def test_zadd_moves_a_member(self):
+        self.write([('zadd', ('set', 1.0, 'a')), ('zadd', ('set', 2.0, 'b')),
+                    ('zadd', ('set', 3.0, 'a'))])
+        self.assertEqual(self.assertSame(
+            lambda backend: list(backend.zrangebyscore('set', 0, 10, 0, 10))),
+            [('b', 2.0), ('a', 3.0)])
+
+    def test_trim_time_range(self):
+        self.write([('zadd', ('set', float(i // 3), 'member-%02d' % i)) for i in xrange(30)])
+        # a chunk at a time, like the compactor
+        self.assertEqual(self.assertSame(lambda backend: backend.trim_time_range('set', 5, 4)), 4)
+        self.assertEqual(self.assertSame(lambda backend: backend.trim_time_range('set', 5, 100)), 11)
+        self.assertEqual(self.assertSame(lambda backend: backend.trim_time_range('set', 5, 100)), 0)
+        self.assertEqual(self.assertSame(lambda backend: backend.trim_time_range('none', 5, 100)), 0)
+        items = self.assertSame(lambda backend: list(backend.zrangebyscore('set', 0, 100, 0, 100)))
+        self.assertEqual(len(items), 15)
+        self.assertEqual(items[0], ('member-15', 5.0))
+
+    def test_evict_images(self):
+        for i in xrange(10):
+            for backend in self.backends:
+                backend.set('image-%d' % i, 'png')
+                backend.add_image('image-%d' % i, 100, 1000.0 + i)
+        # storing an image again only updates its time
+        for backend in self.backends:
+            backend.add_image('image-0', 100, 1020.0)
+
+        # the oldest, while they're over the size limit
+        self.assertEqual(self.assertSame(lambda backend: backend.evict_images(750, 0, 100)),
+                         ['image-1', 'image-2', 'image-3'])
+        # the ones stored before a time, a chunk at a time
+        self.assertEqual(self.assertSame(lambda backend: backend.evict_images(None, 1006, 1)),
+                         ['image-4'])
+        self.assertEqual(self.assertSame(lambda backend: backend.evict_images(None, 1006, 100)),
+                         ['image-5'])
+        self.assertEqual(self.assertSame(lambda backend: backend.evict_images(None, 1006, 100)),
+                         [])
+        self.assertEqual(
+            self.assertSame(lambda backend: backend.mget(['image-%d' % i for i in xrange(10)])),
+            ['png', None, None, None, None, None, 'png', 'png', 'png', 'png'])
+
+    def test_expire(self):
+        self.write([('set', ('short', 'a', 1)), ('set', ('long', 'b', 60)),
+                    ('set', ('forever', 'c', None)),
+                    # set again without a ttl, so it never expires
+                    ('set', ('reset', 'd', 1)), ('set', ('reset', 'e', None))])
+        time.sleep(1.1)
+        # redis expires values by itself. The others expire them here, but
+        # don't return them once their ttl runs out either way.
+        self.assertSame(lambda backend: backend.mget(['short', 'long', 'forever', 'reset']))
+        for backend in self.backends:
+            backend.expire(time.time(), 100)
+        self.assertEqual(
+            self.assertSame(lambda backend: backend.mget(['short', 'long', 'forever', 'reset'])),
+            [None, 'b', 'c', 'e'])
+
+    def test_ltrim_lrange(self):
+        self.write([('lpush', ('list', str(i))) for i in xrange(10)])
+        self.assertEqual(self.assertSame(lambda backend: backend.lrange('list')),
+                         [str(i) for i in xrange(9, -1, -1)])
+        self.write([('ltrim', ('list', 0, 3))])
+        self.assertEqual(self.assertSame(lambda backend: backend.lrange('list')),
+                         ['9', '8', '7', '6'])
+        self.write([('lpush', ('list', '10')), ('ltrim', ('list', 0, 3))])
+        self.assertEqual(self.assertSame(lambda backend: backend.lrange('list')),
+                         ['10', '9', '8', '7'])
+        self.assertEqual(self.assertSame(lambda backend: backend.lrange('none')), [])
+
+
+class TestSqliteErrors(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'digaas.db')
+        self.backend = storage_sqlite.SqliteBackend(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_locked_is_transient(self):
+        # don't wait out the default busy timeout
+        self.backend.conn = sqlite3.connect(self.path, timeout=0)
+        other = sqlite3.connect(self.path)
+        other.execute("BEGIN EXCLUSIVE")
+        try:
+            with self.assertRaises(self.backend.transient_errors):
+                self.backend.write([('set', ('key', 'value'))])
+        finally:
+            other.rollback()
+        self.backend.write([('set', ('key', 'value'))])
+        self.assertEqual(self.backend.get('key'), 'value')
+
+    def test_other_errors_are_not_transient(self):
+        self.backend.conn.execute("DROP TABLE kv")
+        try:
+            self.backend.write([('set', ('key', 'value'))])
+        except self.backend.transient_errors:
+            self.fail("a missing table was taken as transient")
+        except sqlite3.OperationalError:
+            pass
+        else:
+            self.fail("the write didn't fail")
+
+
+class TestPollRequestEncoding(unittest.TestCase):
+
+    def round_trip(self, poll_req):
+        val = storage.fmt_poll_request_value(poll_req)
+        self.assertEqual(val[:1], storage.BINARY_V1)
+        return model.PollRequest(id=poll_req.id, **storage.parse_poll_request_value(val))
+
+    def test_round_trip(self):
+        poll_req = model.PollRequest(
+            u'www.example.com.', None, 0, 1420070400.123456789,
+            u'rrset=10 mx1.example.com.|20 mx2.example.com.', 30, 0.5, rdatatype='MX', duration=2.25, status='COMPLETED', adaptive=True,
+            query_budget=12, transport='tcp', nameservers=[u'192.0.2.1', '192.0.2.2'],
+            quorum=1, results={'192.0.2.1': 1.5, '192.0.2.2': None}, first_duration=1.5,
+            zone=u'example.com.')
+        parsed = self.round_trip(poll_req)
+        self.assertEqual(parsed.to_dict(), poll_req.to_dict())
+
+    def test_round_trip_missing_fields(self):
+        poll_req = model.PollRequest('example.com', '192.0.2.1', 2 ** 32 - 1, 1420070400.5,
+                                     'serial_not_lower', 30, 1, status='ACCEPTED')
+        parsed = self.round_trip(poll_req)
+        self.assertEqual(parsed.to_dict(), poll_req.to_dict())
+        self.assertIsNone(parsed.duration)
+        self.assertIsNone(parsed.nameservers)
+        self.assertIsNone(parsed.results)
+        self.assertIsNone(parsed.query_budget)
+
+    def test_round_trip_unicode(self):
+        poll_req = model.PollRequest(u'caf\xe9.example.com', u'192.0.2.1', 1, 1420070400.0,
+                                     u'data=caf\xe9', 30, 1, rdatatype='TXT', status='ERROR')
+        parsed = self.round_trip(poll_req)
+        self.assertEqual(parsed.query_name.decode('utf-8'), poll_req.query_name)
+        self.assertEqual(parsed.condition.decode('utf-8'), poll_req.condition)
+
+    def test_round_trip_longest_fields(self):
+        poll_req = model.PollRequest('a' * model.MAX_FIELD_LENGTH, '192.0.2.1', 1, 1420070400.0,
+                                     'serial_not_lower', 30, 1)
+        parsed = self.round_trip(poll_req)
+        self.assertEqual(parsed.query_name, poll_req.query_name)
+
+    def test_fields_too_long_to_store(self):
+        data = dict(query_name='example.com', nameserver='192.0.2.1', serial=1,
+                    start_time=1420070400.0, condition='serial_not_lower', timeout=30,
+                    frequency=1)
+        model.PollRequest.validate(data)
+        too_long = [
+            dict(query_name='a' * (model.MAX_FIELD_LENGTH + 1)),
+            # it's the utf-8 that's stored
+            dict(query_name=u'\xe9' * (model.MAX_FIELD_LENGTH // 2 + 1)),
+            dict(nameserver='1' * 0xffff),
+            dict(nameserver=None, nameservers=['192.0.2.%d' % i for i in xrange(0x10000)]),
+            dict(nameserver=None, nameservers=['1' * 0x10000]),
+        ]
+        for changes in too_long:
+            bad = dict(data, **changes)
+            self.assertRaises(ValueError, model.PollRequest.validate, bad)
+            self.assertRaises(ValueError, storage.fmt_poll_request_value,
+                              model.PollRequest.from_dict(bad))
+
+    def test_parse_binary(self):
+        poll_req = model.PollRequest('example.com', '192.0.2.1', 5, 1420070400.5,
+                                     'zone_removed', 30, 2, status='INTERNAL_ERROR')
+        data = storage._parse_poll_request_binary(storage.fmt_poll_request_value(poll_req))
+        self.assertEqual(data['status'], 'INTERNAL_ERROR')
+        self.assertEqual(data['serial'], 5)
+        self.assertEqual(data['start_time'], 1420070400.5)
+        self.assertEqual(data['frequency'], 2.0)
+        self.assertFalse(data['adaptive'])
+
+    def test_parse_legacy_text(self):
+        # the fields of the oldest values
+        data = storage.parse_poll_request_value(
+            'COMPLETED example.com None 5 192.0.2.1 1420070400.5 2.25 serial_not_lower 30 1.0')
+        self.assertEqual(data['status'], 'COMPLETED')
+        self.assertEqual(data['query_name'], 'example.com')
+        self.assertIsNone(data['rdatatype'])
+        self.assertEqual(data['serial'], 5)
+        self.assertEqual(data['duration'], 2.25)
+        self.assertEqual(data['condition'], 'serial_not_lower')
+        self.assertFalse(data['adaptive'])
+        self.assertIsNone(data['nameservers'])
+        self.assertIsNone(data['zone'])
+        model.PollRequest(id='legacy', **data)
+
+    def test_parse_legacy_text_quoted_condition(self):
+        data = storage.parse_poll_request_value(
+            'ACCEPTED example.com MX 0 None 1420070400.5 None '
+            'rrset%3D10%20mx1.example.com.%7C20%20mx2.example.com. 30 1.0 True 8 tcp '
+            '192.0.2.1,192.0.2.2 1 192.0.2.1=1.5,192.0.2.2=None 1.5 None')
+        self.assertEqual(data['condition'], 'rrset=10 mx1.example.com.|20 mx2.example.com.')
+        self.assertTrue(data['adaptive'])
+        self.assertEqual(data['query_budget'], 8)
+        self.assertEqual(data['transport'], 'tcp')
+        self.assertEqual(data['nameservers'], ['192.0.2.1', '192.0.2.2'])
+        self.assertEqual(data['results'], {'192.0.2.1': 1.5, '192.0.2.2': None})
+        self.assertEqual(data['first_duration'], 1.5)
+        self.assertIsNone(data['quorum_duration'])
+
+    def test_parse_legacy_text_unparseable_condition(self):
+        # values stored before conditions were checked still read back
+        data = storage.parse_poll_request_value(
+            'ACCEPTED example.com A 0 192.0.2.1 1420070400.5 None data%3Dnot-an-ip 30 1.0')
+        poll_req = model.PollRequest(id='legacy', **data)
+        self.assertEqual(poll_req.condition, 'data=not-an-ip')
+        self.assertRaises(ValueError, lambda: poll_req.predicate)
+
+
+class TestTimeRangeItemEncoding(unittest.TestCase):
+
+    def test_round_trip(self):
+        for args in [('update', 1420070400.123456789, 2.5, '192.0.2.1'),
+                     ('remove', 1420070400.0, None, '192.0.2.1'),
+                     ('update', 1420070400.0, 0.0, '')]:
+            item = storage.fmt_time_range_item(*args)
+            self.assertEqual(item[:1], storage.BINARY_V1)
+            self.assertEqual(storage.parse_time_range_item(item), args)
+
+    def test_round_trip_unicode_nameserver(self):
+        item = storage.fmt_time_range_item('update', 1420070400.0, 1.0, u'192.0.2.1')
+        self.assertIsInstance(item, str)
+        self.assertEqual(storage.parse_time_range_item(item)[3], '192.0.2.1')
+
+    def test_text(self):
+        item = storage.fmt_time_range_item('remove', 1420070400.5, None, '192.0.2.1')
+        self.assertEqual(storage.time_range_item_text(item), 'remove 1420070400.5 None 192.0.2.1')
+
+    def test_parse_legacy_text(self):
+        self.assertEqual(storage.parse_time_range_item('update 1420070400.5 2.5 192.0.2.1'),
+                         ('update', 1420070400.5, 2.5, '192.0.2.1'))
+        self.assertEqual(storage.parse_time_range_item('remove 1420070400.5 None 192.0.2.1'),
+                         ('remove', 1420070400.5, None, '192.0.2.1'))
+
+    def test_parse_legacy_text_without_nameserver(self):
+        self.assertEqual(storage.parse_time_range_item('update 1420070400.5 2.5'),
+                         ('update', 1420070400.5, 2.5, None))
+        self.assertEqual(storage.parse_time_range_item('remove 1420070400.5 None'),
+                         ('remove', 1420070400.5, None, None))
+        # legacy items are written out as they are
+        self.assertEqual(storage.time_range_item_text('update 1420070400.5 2.5'),
+                         'update 1420070400.5 2.5')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import socket
+import struct
+import unittest
+
+import gevent
+import gevent.event
+import dns.exception
+import dns.message
+from monotonic import monotonic
+
+from digaas import udpmux
+
+NAMESERVER = '127.0.0.1'
+
+
+def make_query(name, rdatatype, qid=0):
+    wire = dns.message.make_query(name, rdatatype).to_wire()
+    return struct.pack('!H', qid) + wire[2:]
+
+def make_response(query, qid=None, name=None, rdatatype=None):
+    """Return a response to the query, with the message id or question changed"""
+    if name is not None or rdatatype is not None:
+        message = dns.message.from_wire(query)
+        question = message.question[0]
+        query = make_query(name or question.name.to_text(),
+                           rdatatype or question.rdtype, message.id)
+    if qid is not None:
+        query = struct.pack('!H', qid) + query[2:]
+    return query[:2] + '\x81\x80' + query[4:]
+
+
+class TestMuxSocket(unittest.TestCase):
+
+    def setUp(self):
+        # the nameserver's socket, which we answer queries from by hand
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind((NAMESERVER, 0))
+        self.timers = udpmux.Timers()
+        self.sock = udpmux.MuxSocket(NAMESERVER, self.server.getsockname()[1], self.timers)
+
+    def tearDown(self):
+        self.sock.reader.kill()
+        self.sock.sock.close()
+        self.server.close()
+
+    def send(self, name, rdatatype='A', timeout=1.0):
+        result = gevent.event.AsyncResult()
+        key = self.sock.send(make_query(name, rdatatype), monotonic() + timeout, result)
+        wire, addr = self.server.recvfrom(65535)
+        return result, key, wire, addr
+
+    def test_matches_the_response(self):
+        result, key, wire, addr = self.send('example.com.')
+        self.assertEqual(key, (struct.unpack('!H', wire[:2])[0],) + udpmux.question_key(wire))
+        self.server.sendto(make_response(wire), addr)
+        self.assertEqual(result.get(timeout=1), make_response(wire))
+        self.assertEqual(self.sock.pending, {})
+
+    def test_ignores_mismatched_responses(self):
+        result, key, wire, addr = self.send('example.com.')
+        qid = key[0]
+        for response in [make_response(wire, qid=(qid + 1) % 0x10000),
+                         make_response(wire, name='example.org.'),
+                         make_response(wire, rdatatype='AAAA'),
+                         # too short to match anything
+                         wire[:5]]:
+            self.server.sendto(response, addr)
+        gevent.sleep(0.05)
+        self.assertFalse(result.ready())
+        # names match without regard to case
+        self.server.sendto(make_response(wire, name='EXAMPLE.com.'), addr)
+        self.assertEqual(result.get(timeout=1), make_response(wire, name='EXAMPLE.com.'))
+
+    def test_concurrent_queries(self):
+        queries = [self.send(name) for name in ('a.example.com.', 'b.example.com.')]
+        self.assertNotEqual(queries[0][1][0], queries[1][1][0])
+        for result, key, wire, addr in reversed(queries):
+            self.server.sendto(make_response(wire), addr)
+        for result, key, wire, addr in queries:
+            self.assertEqual(result.get(timeout=1), make_response(wire))
+
+    def test_cancel(self):
+        result, key, wire, addr = self.send('example.com.')
+        self.sock.cancel(key)
+        self.assertNotIn(key[0], self.sock.ids)
+        self.server.sendto(make_response(wire), addr)
+        gevent.sleep(0.05)
+        self.assertFalse(result.ready())
+
+    def test_shared_timer_heap(self):
+        other_server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        other_server.bind((NAMESERVER, 0))
+        other = udpmux.MuxSocket(NAMESERVER, other_server.getsockname()[1], self.timers)
+        try:
+            start = monotonic()
+            answered, key, wire, addr = self.send('example.org.', timeout=0.1)
+            late = gevent.event.AsyncResult()
+            other.send(make_query('example.com.', 'A'), start + 0.2, late)
+            early = gevent.event.AsyncResult()
+            self.sock.send(make_query('example.com.', 'A'), start + 0.1, early)
+            self.server.sendto(make_response(wire), addr)
+
+            self.assertRaises(dns.exception.Timeout, early.get, timeout=1)
+            self.assertFalse(late.ready())
+            self.assertRaises(dns.exception.Timeout, late.get, timeout=1)
+            self.assertGreaterEqual(monotonic() - start, 0.2)
+            # the answered query isn't failed when its deadline passes
+            self.assertEqual(answered.get(), make_response(wire))
+            self.assertEqual(self.timers._heap, [])
+        finally:
+            other.reader.kill()
+            other.sock.close()
+            other_server.close()
+
+
+class TestAllocateId(unittest.TestCase):
+
+    def test_unique(self):
+        ids = set()
+        for _ in xrange(1000):
+            udpmux.allocate_id(ids)
+        self.assertEqual(len(ids), 1000)
+
+    def test_out_of_ids(self):
+        ids = set(xrange(0xffff))
+        self.assertRaises(dns.exception.DNSException, udpmux.allocate_id, ids)
+
+
+if __name__ == '__main__':
+    unittest.main()
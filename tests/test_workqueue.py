@@ -0,0 +1,160 @@
+import time
+import unittest
+
+import redis
+
+from digaas.config import CONFIG
+from digaas import model
+from digaas import storage
+from digaas import storage_redis
+from digaas import workqueue
+from digaas import writebehind
+from digaas.consts import Status
+
+# the redis database the tests may wipe, apart from the one digaas uses
+REDIS_TEST_DB = 15
+
+
+def make_poll_request(**kwargs):
+    data = dict(
+        query_name = 'example.com',
+        nameserver = '192.0.2.1',
+        serial = 1,
+        start_time = time.time(),
+        condition = 'serial_not_lower',
+        timeout = 30,
+        frequency = 1,
+        status = Status.ACCEPTED)
+    data.update(kwargs)
+    return model.PollRequest(**data)
+
+
+class RecordingScheduler(object):
+
+    def __init__(self):
+        self.added = []
+
+    def add(self, poll_req, accepted_at=None):
+        self.added.append((poll_req, accepted_at))
+
+
+class TestWorkQueue(unittest.TestCase):
+    """Runs the queue's scripts in a redis server, if one is running"""
+
+    def setUp(self):
+        self.client = redis.StrictRedis(host=CONFIG.redis_host or '127.0.0.1',
+                                        port=CONFIG.redis_port or 6379,
+                                        password=CONFIG.redis_password, db=REDIS_TEST_DB)
+        try:
+            self.client.flushdb()
+        except redis.ConnectionError:
+            raise unittest.SkipTest("redis isn't running")
+        self._storage = storage.REDIS_CLIENT, storage.BACKEND, storage.WRITER
+        storage.REDIS_CLIENT = self.client
+        storage.BACKEND = storage_redis.RedisBackend(self.client)
+        storage.WRITER = writebehind.WriteBehind(storage.get_backend, 1000, 0.001)
+        workqueue._held.clear()
+        self.now = time.time()
+
+    def tearDown(self):
+        storage.REDIS_CLIENT, storage.BACKEND, storage.WRITER = self._storage
+        workqueue._held.clear()
+
+    def enqueue(self, n, accepted_at=None):
+        poll_reqs = [make_poll_request() for _ in xrange(n)]
+        storage.enqueue_poll_requests(poll_reqs, accepted_at or self.now)
+        return poll_reqs
+
+    def leases(self):
+        return self.client.zrange(storage.POLL_LEASES_SET_NAME, 0, -1, withscores=True)
+
+    def test_claim(self):
+        poll_reqs = self.enqueue(3)
+        items = storage.claim_poll_requests(2, self.now + 30)
+        self.assertEqual([storage.parse_queue_item(item) for item in items],
+                         [(poll_req.id, self.now) for poll_req in poll_reqs[:2]])
+        self.assertEqual(sorted(self.leases()), sorted((item, self.now + 30) for item in items))
+        self.assertEqual(len(storage.claim_poll_requests(10, self.now + 30)), 1)
+        self.assertEqual(storage.claim_poll_requests(10, self.now + 30), [])
+
+    def test_reclaim_expired_leases(self):
+        self.enqueue(3)
+        expired = storage.claim_poll_requests(2, self.now - 1)
+        live = storage.claim_poll_requests(1, self.now + 30)
+        self.assertEqual(storage.reclaim_expired_leases(self.now, 1), 1)
+        self.assertEqual(workqueue.reclaim(), 1)
+        self.assertEqual(self.leases(), [(live[0], self.now + 30)])
+        self.assertEqual(storage.claim_poll_requests(10, self.now + 30), expired)
+
+    def test_requeued_request_keeps_its_timeout(self):
+        accepted_at = self.now - 20
+        poll_req, = self.enqueue(1, accepted_at)
+        lease_seconds, CONFIG.poll_lease_seconds = CONFIG.poll_lease_seconds, -1
+        try:
+            # this node claims it and dies, and its lease expires
+            workqueue._claim(RecordingScheduler())
+            workqueue._held.clear()
+        finally:
+            CONFIG.poll_lease_seconds = lease_seconds
+        workqueue.reclaim()
+
+        scheduler = RecordingScheduler()
+        self.assertTrue(workqueue._claim(scheduler))
+        (claimed, claimed_accepted_at), = scheduler.added
+        self.assertEqual(claimed.id, poll_req.id)
+        # the timeout still counts from when the request was first accepted
+        self.assertEqual(claimed_accepted_at, accepted_at)
+        self.assertIn(poll_req.id, workqueue._held)
+
+    def test_renew_leases(self):
+        self.enqueue(2)
+        items = storage.claim_poll_requests(2, self.now + 1)
+        self.assertEqual(storage.renew_leases(items[:1], self.now + 30), [])
+        # only the lease that wasn't renewed expires
+        self.assertEqual(storage.reclaim_expired_leases(self.now + 2, 100), 1)
+        self.assertEqual(self.leases(), [(items[0], self.now + 30)])
+
+    def test_renew_skips_reclaimed_leases(self):
+        self.enqueue(2)
+        items = storage.claim_poll_requests(2, self.now - 1)
+        storage.reclaim_expired_leases(self.now, 1)
+        self.assertEqual(storage.renew_leases(items, self.now + 30), items[:1])
+        # the lost lease isn't taken back
+        self.assertEqual(self.leases(), [(items[1], self.now + 30)])
+
+    def test_release_after_the_result_is_written(self):
+        poll_req, = self.enqueue(1)
+        workqueue._claim(RecordingScheduler())
+        item, = workqueue._held.values()
+
+        poll_req.status = Status.COMPLETED
+        poll_req.duration = 1.0
+        storage.update_poll_request(poll_req)
+        workqueue.release(poll_req.id)
+        self.assertNotIn(poll_req.id, workqueue._held)
+        # nothing is written until the batch goes out
+        self.assertEqual(len(self.leases()), 1)
+        writes = [name for name, args in storage.WRITER._writes]
+        self.assertLess(writes.index('set'), writes.index('zrem'))
+
+        storage.WRITER.submit([]).get()
+        self.assertEqual(self.leases(), [])
+        stored = model.PollRequest(id=poll_req.id, **storage.parse_poll_request_value(
+            self.client.get(poll_req.id)))
+        self.assertEqual(stored.status, Status.COMPLETED)
+        self.assertEqual(item, storage.fmt_value(poll_req.id, self.now))
+
+    def test_finished_requests_are_released(self):
+        poll_req, = self.enqueue(1)
+        poll_req.status = Status.COMPLETED
+        storage.update_poll_request(poll_req)
+        scheduler = RecordingScheduler()
+        workqueue._claim(scheduler)
+        storage.WRITER.submit([]).get()
+        self.assertEqual(scheduler.added, [])
+        self.assertEqual(self.leases(), [])
+        self.assertEqual(workqueue._held, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
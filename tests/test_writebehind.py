@@ -0,0 +1,152 @@
+import time
+import unittest
+
+import gevent
+
+from digaas import model
+from digaas import storage
+from digaas import storage_memory
+from digaas import writebehind
+from digaas.consts import Status
+
+
+class FlakyBackend(storage_memory.MemoryBackend):
+    """A memory backend that's unavailable for the next self.failures
+    batches, and records the batches it stores"""
+
+    transient_errors = (IOError,)
+
+    def __init__(self):
+        super(FlakyBackend, self).__init__()
+        self.failures = 0
+        self.batches = []
+
+    def write(self, writes):
+        if self.failures:
+            self.failures -= 1
+            raise IOError("storage is down")
+        self.batches.append(list(writes))
+        super(FlakyBackend, self).write(writes)
+
+
+def set_write(key, value):
+    return ('set', (key, value))
+
+
+class TestWriteBehind(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = FlakyBackend()
+
+    def make_writer(self, max_batch, interval):
+        return writebehind.WriteBehind(lambda: self.backend, max_batch, interval)
+
+    def test_flush_on_batch_size(self):
+        writer = self.make_writer(3, 10)
+        first = writer.submit([set_write('a', '1'), set_write('b', '2')])
+        gevent.sleep(0.05)
+        self.assertFalse(first.ready())
+        second = writer.submit([set_write('c', '3')])
+        # long before the interval is up
+        second.get(timeout=1)
+        self.assertTrue(first.ready())
+        self.assertEqual(len(self.backend.batches), 1)
+        self.assertEqual(self.backend.mget(['a', 'b', 'c']), ['1', '2', '3'])
+
+    def test_flush_on_interval(self):
+        writer = self.make_writer(1000, 0.1)
+        start = time.time()
+        result = writer.submit([set_write('a', '1')])
+        gevent.sleep(0.01)
+        writer.submit([set_write('b', '2')])
+        result.get(timeout=1)
+        self.assertGreaterEqual(time.time() - start, 0.09)
+        # both went out together
+        self.assertEqual(self.backend.batches, [[set_write('a', '1'), set_write('b', '2')]])
+
+    def test_failed_batch_goes_ahead_of_newer_writes(self):
+        writer = self.make_writer(1000, 10)
+        self.backend.failures = 1
+        older = writer.submit([set_write('a', 'old'), ('zadd', ('s', 1, 'a'))])
+        writer.flush()
+        self.assertFalse(older.ready())
+        self.assertEqual(writer._backoff, writebehind.MIN_BACKOFF)
+        self.assertEqual(writer.pending, {'a': 'old'})
+
+        newer = writer.submit([set_write('a', 'new')])
+        writer.flush()
+        self.assertEqual(self.backend.batches, [[set_write('a', 'old'), ('zadd', ('s', 1, 'a')),
+                                                 set_write('a', 'new')]])
+        self.assertEqual(self.backend.get('a'), 'new')
+        self.assertTrue(older.ready() and newer.ready())
+        self.assertEqual(writer._backoff, 0)
+        self.assertEqual(writer.pending, {})
+
+    def test_retried_until_stored(self):
+        writer = self.make_writer(1000, 0.001)
+        self.backend.failures = 2
+        result = writer.submit([set_write('a', '1')])
+        result.get(timeout=2)
+        self.assertEqual(self.backend.get('a'), '1')
+        self.assertEqual(writer._window.errors, 2)
+
+    def test_other_errors_are_not_retried(self):
+        writer = self.make_writer(1000, 10)
+        result = writer.submit([('no_such_method', ())])
+        writer.flush()
+        self.assertRaises(AttributeError, result.get, timeout=0)
+        self.assertEqual(writer._writes, [])
+
+
+class TestReadYourWrites(unittest.TestCase):
+    """Reads see the writes that are waiting to go out, even while storage is
+    down"""
+
+    def setUp(self):
+        self._storage = storage.BACKEND, storage.WRITER
+        self.backend = storage.BACKEND = FlakyBackend()
+        self.writer = storage.WRITER = writebehind.WriteBehind(storage.get_backend, 1000, 10)
+        self.poll_req = model.PollRequest(
+            query_name='example.com', nameserver='192.0.2.1', serial=1,
+            start_time=time.time(), condition='serial_not_lower', timeout=30,
+            frequency=1, status=Status.ACCEPTED)
+        self.backend.set(self.poll_req.id, storage.fmt_poll_request_value(self.poll_req))
+
+    def tearDown(self):
+        storage.BACKEND, storage.WRITER = self._storage
+
+    def finish(self):
+        self.poll_req.status = Status.COMPLETED
+        self.poll_req.duration = 1.5
+        storage.update_poll_request(self.poll_req)
+
+    def assertFinished(self, poll_req):
+        self.assertEqual(poll_req.status, Status.COMPLETED)
+        self.assertEqual(poll_req.duration, 1.5)
+
+    def test_get_poll_request(self):
+        self.backend.failures = 1
+        self.finish()
+        self.writer.flush()
+        stored = model.PollRequest(id=self.poll_req.id, **storage.parse_poll_request_value(
+            self.backend.get(self.poll_req.id)))
+        self.assertEqual(stored.status, Status.ACCEPTED)
+        self.assertFinished(storage.get_poll_request(self.poll_req.id))
+
+        self.writer.flush()
+        self.assertEqual(self.writer.pending, {})
+        self.assertFinished(storage.get_poll_request(self.poll_req.id))
+
+    def test_get_poll_requests(self):
+        self.backend.failures = 1
+        self.finish()
+        self.writer.flush()
+        (id, poll_req), (missing, nothing) = storage.get_poll_requests(
+            [self.poll_req.id, 'no-such-id'])
+        self.assertEqual(id, self.poll_req.id)
+        self.assertFinished(poll_req)
+        self.assertEqual((missing, nothing), ('no-such-id', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
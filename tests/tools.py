@@ -3,10 +3,18 @@ import os
 import textwrap
 import subprocess
 
+import dns.flags
+import dns.message
+import dns.opcode
+import dns.query
+import dns.rrset
+
 from digaas.digdig import dig
 import rndc
 
 NAMESERVER = '127.0.0.1'
+# the port digaas listens for NOTIFY on ("notify_port" in the config), if any
+NOTIFY_PORT = int(os.environ.get('DIGAAS_NOTIFY_PORT', 0)) or None
 ZONE_FILE_DIR = '/var/cache/bind'
 DEBUG = False
 
@@ -91,6 +99,16 @@ def touch_zone(zone_name):
     write_zone_file(zone_file, new_zone_file_text)
     rndc.reload(zone_name)
 
+def send_notify(zone_name, serial, port):
+    """Send digaas a NOTIFY for the zone, as if it came from the nameserver"""
+    message = dns.message.make_query(zone_name, 'SOA')
+    message.set_opcode(dns.opcode.NOTIFY)
+    message.flags &= ~dns.flags.RD
+    message.answer.append(dns.rrset.from_text(
+        zone_name, 300, 'IN', 'SOA',
+        'ns1.{0} admin.{0} {1} 1000 1001 1002 1003'.format(zone_name, serial)))
+    dns.query.udp(message, '127.0.0.1', timeout=2, port=port, source=NAMESERVER)
+
 def update_zone(zone_name, serial, ip):
     zone_file_text = generate_zone_file(zone_name, serial=serial, ip=ip)
     zone_file = get_zone_filename(zone_name)